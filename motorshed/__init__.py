@@ -1,2 +1,23 @@
 from . import algos
-from . import (config, example_parameters, osrm, overpass, render_mpl, util)
+from . import (
+    animation,
+    compositing,
+    config,
+    example_parameters,
+    graph_cache,
+    isochrones,
+    local_routing,
+    lod,
+    osm_extract,
+    osrm,
+    output,
+    overpass,
+    pipeline,
+    png_stream,
+    render_mpl,
+    render_np,
+    routing_store,
+    tiling,
+    util,
+    web_tiles,
+)
@@ -1 +1 @@
-from . import (brute_force, gen2)
\ No newline at end of file
+from . import (brute_force, compact, gen2)
@@ -0,0 +1,167 @@
+"""A compact, integer-indexed representation of the edges dataframe (Ge), for the
+gen2 stages that need to walk the graph quickly.
+
+OSM node IDs are big, sparse numbers, so looking edges up by (u, v) means hashing
+(pandas MultiIndexes, `.loc`, `index.intersection`, ...). Instead, every node gets
+a dense ID (0..N-1, in order of OSM ID), and every edge is just its row number in
+Ge. `create_initial_dataframes` builds the CompactGraph once and attaches it to Ge
+(as `Ge.attrs["graph"]`, see `graph_of`), and puts the dense node IDs of each edge
+in Ge, as the 'ui' and 'vi' columns. Everything else is numpy arrays:
+
+    node_ids[i]                    OSM ID of node i (the ID translation table)
+    ui[e], vi[e]                   nodes of edge e
+    out_edges[indptr[i]:indptr[i+1]]   edges out of node i (CSR style)
+    successor[e]                   the edge that traffic goes to after edge e, or
+                                   SINK / UNROUTED (this replaces 'w' and 'v2',
+                                   which are only filled in for the dataframes)
+"""
+
+import numpy as np
+
+# Dense IDs fit in 32 bits (unless you're routing the whole planet).
+ID_DTYPE = np.int32
+
+# Special values of successor[e]:
+SINK = -1  # Traffic ends here (the center node, or a route that leaves the map)
+UNROUTED = -2  # We don't know (yet)
+
+
+def dense_node_ids(u, v, node_ids=None):
+    """Number the nodes 0..N-1, in order of OSM ID. `node_ids` are all of the nodes
+    (default: the nodes of the edges (u, v)). Returns (node_ids, ui, vi): the
+    translation table, and the dense IDs of u and v."""
+    u = np.asarray(u, dtype=np.int64)
+    v = np.asarray(v, dtype=np.int64)
+    if node_ids is None:
+        node_ids, inverse = np.unique(np.concatenate([u, v]), return_inverse=True)
+        inverse = inverse.astype(ID_DTYPE)
+        return node_ids, inverse[: len(u)], inverse[len(u) :]
+
+    node_ids = np.unique(np.asarray(node_ids, dtype=np.int64))
+    ui = np.searchsorted(node_ids, u).astype(ID_DTYPE)
+    vi = np.searchsorted(node_ids, v).astype(ID_DTYPE)
+    return node_ids, ui, vi
+
+
+class CompactGraph:
+    """Integer-indexed adjacency for the edges of Ge. Edge e is row e of Ge; see the
+    module docstring for the arrays. It never changes once it's built, so it's
+    shared (rather than copied) when pandas copies Ge and its attrs."""
+
+    def __init__(self, node_ids, ui, vi):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.ui = np.asarray(ui, dtype=ID_DTYPE)
+        self.vi = np.asarray(vi, dtype=ID_DTYPE)
+        self.n_nodes = len(self.node_ids)
+        self.n_edges = len(self.ui)
+
+        # Out-edges of every node, CSR style.
+        self.out_edges = np.argsort(self.ui, kind="stable").astype(ID_DTYPE)
+        self.indptr = np.searchsorted(
+            self.ui[self.out_edges], np.arange(self.n_nodes + 1)
+        )
+        self.out_degree = np.diff(self.indptr)
+
+        # Sorted (ui, vi) keys, to look up edges by their nodes.
+        keys = self._keys(self.ui, self.vi)
+        self._key_order = np.argsort(keys)
+        self._sorted_keys = keys[self._key_order]
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @classmethod
+    def from_frame(cls, Ge):
+        """Build the CompactGraph of the edges dataframe Ge from scratch. Ge can be
+        indexed by (u, v) or have them as columns."""
+        if "u" in Ge.columns:
+            u, v = Ge["u"].to_numpy(np.int64), Ge["v"].to_numpy(np.int64)
+        else:
+            u = Ge.index.get_level_values("u").to_numpy(np.int64)
+            v = Ge.index.get_level_values("v").to_numpy(np.int64)
+        return cls(*dense_node_ids(u, v))
+
+    def edges_like(self, ui, vi):
+        """A CompactGraph of other edges (e.g., a subset of these) between the same
+        nodes, sharing the translation table."""
+        return CompactGraph(self.node_ids, ui, vi)
+
+    def _keys(self, ui, vi):
+        return np.asarray(ui, dtype=np.int64) * self.n_nodes + vi
+
+    def node_index(self, node_ids):
+        """Dense IDs of the OSM node IDs `node_ids`; -1 where they aren't in the
+        graph."""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if not self.n_nodes:
+            return np.full(node_ids.shape, -1, dtype=ID_DTYPE)
+        pos = np.minimum(np.searchsorted(self.node_ids, node_ids), self.n_nodes - 1)
+        return np.where(self.node_ids[pos] == node_ids, pos, -1).astype(ID_DTYPE)
+
+    def find_edges(self, ui, vi):
+        """Edge numbers of the edges (ui, vi) (dense node IDs); -1 where there's
+        no such edge."""
+        ui, vi = np.asarray(ui), np.asarray(vi)
+        if not self.n_edges:
+            return np.full(ui.shape, -1, dtype=ID_DTYPE)
+        keys = self._keys(ui, vi)
+        pos = np.minimum(np.searchsorted(self._sorted_keys, keys), self.n_edges - 1)
+        found = (self._sorted_keys[pos] == keys) & (ui >= 0) & (vi >= 0)
+        return np.where(found, self._key_order[pos], -1).astype(ID_DTYPE)
+
+    def successors(self, w, v2=None):
+        """The successor of each edge, from the 'w' and 'v2' columns (OSM IDs; v2
+        defaults to the edge's v): the edge (v2, w), UNROUTED where w is 0, and
+        SINK where w is -1 or (v2, w) isn't an edge."""
+        w = np.asarray(w, dtype=np.int64)
+        vi = self.vi if v2 is None else self.node_index(v2)
+        successor = self.find_edges(vi, np.where(w > 0, self.node_index(w), -1))
+        successor[(successor < 0) & (w != 0)] = SINK
+        successor[w == 0] = UNROUTED
+        return successor
+
+    def next_nodes(self, successor):
+        """The 'w' (OSM ID) of each edge, given its successor: 0 where it's
+        UNROUTED, and -1 where it's a SINK."""
+        successor = np.asarray(successor)
+        w = self.node_ids[self.vi[np.maximum(successor, 0)]]
+        return np.where(successor >= 0, w, np.where(successor == SINK, -1, 0))
+
+
+def graph_of(Ge):
+    """The CompactGraph of the edges dataframe Ge: the one that's attached to it, if
+    it still matches its rows (i.e., they haven't been filtered or re-ordered since),
+    or else a new one."""
+    graph = Ge.attrs.get("graph")
+    if (
+        graph is not None
+        and "ui" in Ge.columns
+        and graph.n_edges == len(Ge)
+        and np.array_equal(graph.ui, Ge["ui"].to_numpy())
+        and np.array_equal(graph.vi, Ge["vi"].to_numpy())
+    ):
+        return graph
+    return CompactGraph.from_frame(Ge)
+
+
+def successors_of(Ge, graph=None):
+    """The successor of every edge of Ge: its 'successor' column, if it has one
+    (that still matches its rows), or else from its 'w' (and 'v2') columns."""
+    graph = graph or graph_of(Ge)
+    # (The successors are edge numbers, so they're only good for the rows that
+    #  the attached graph was built for.)
+    if "successor" in Ge.columns and Ge.attrs.get("graph") is graph:
+        return Ge["successor"].to_numpy(ID_DTYPE).copy()
+    return graph.successors(Ge.w, v2=Ge["v2"] if "v2" in Ge.columns else None)
+
+
+def set_successors(Ge, graph, successor):
+    """Store the routing (in place) in Ge: the 'successor' column, and the 'w' and
+    'v2' columns that go with it, for the dataframe users (rendering, export)."""
+    Ge.attrs["graph"] = graph
+    Ge["successor"] = np.asarray(successor, dtype=ID_DTYPE)
+    Ge["w"] = graph.next_nodes(successor)
+    Ge["v2"] = graph.node_ids[graph.vi]
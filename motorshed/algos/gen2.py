@@ -9,14 +9,47 @@ import osmnx as ox
 import pandas as pd
 from contexttimer import Timer
 
-from motorshed import osrm
-
-
-def create_initial_dataframes(G, towards_origin=True):
+from motorshed import config, graph_cache, local_routing, osrm
+from motorshed.algos import compact
+
+# Integer codes for the kinds of roads (Ge's 'road_class'), so that the later stages
+#  don't have to compare strings. Any other 'highway' tag (including lists of them)
+#  is OTHER_ROAD.
+ROAD_CLASSES = (
+    "motorway",
+    "motorway_link",
+    "trunk",
+    "trunk_link",
+    "primary",
+    "primary_link",
+    "secondary",
+    "secondary_link",
+    "tertiary",
+    "tertiary_link",
+    "unclassified",
+    "residential",
+    "living_street",
+    "service",
+)
+OTHER_ROAD = len(ROAD_CLASSES)
+ROAD_CLASS = {name: code for code, name in enumerate(ROAD_CLASSES)}
+
+# The only columns that the later stages (and rendering) use, for lean dataframes
+#  (see `create_initial_dataframes`); the rest of the osmnx columns are dropped.
+LEAN_NODE_COLUMNS = ["x", "y", "lat", "lon", "highway", "transit_time"]
+LEAN_EDGE_COLUMNS = ["u", "v", "key", "length", "highway", "maxspeed", "oneway"]
+
+
+def create_initial_dataframes(G, towards_origin=True, lean=None):
     """
-    Convert graph G into two geodataframes Gn and Ge (nodes and edges)
-    that are easier to do calculations on. Add a few useful columns, and
-    make sure that data types are correct.
+    Convert graph G (a networkx graph, or a `graph_cache.ColumnarGraph`) into two
+    geodataframes Gn and Ge (nodes and edges) that are easier to do calculations on.
+    Add a few useful columns, and make sure that data types are correct.
+
+    With `lean` (default: `config.LEAN_DATAFRAMES`), they're made to take as little
+    memory as possible: only the columns that are used later on are kept (see
+    LEAN_NODE_COLUMNS and LEAN_EDGE_COLUMNS, plus the ones added here), and
+    coordinates, times and lengths are float32.
 
     ###
     # Gn columns:  (NODES)
@@ -49,37 +82,64 @@ def create_initial_dataframes(G, towards_origin=True):
     # bridge              object    is a bridge?
     # w                    int64    where traffic is routed to -- Next edge is (v, w)
     # v2                   int64    if the routing says (u,v,w), but (v,w) doesn't exist, then just propagate traffic from (u,v) to (v2,w)
+    # ui                   int32    dense ID of u (see `compact`)
+    # vi                   int32    dense ID of v
+    # road_class            int8    ROAD_CLASSES code of highway
+    # speed_mps          float64    estimated speed, from maxspeed or the highway type
     # dtype: object
     """
+    if lean is None:
+        lean = config.LEAN_DATAFRAMES
+    real = np.float32 if lean else float
+
     with Timer(prefix="Create initial dataframes"):
 
         # Graph -> geodataframes
-        Gn, Ge = ox.graph_to_gdfs(G, node_geometry=False, fill_edge_geometry=False)
-        Gn, Ge = Gn.copy(), Ge.copy()  # make sure original graph is unchanged.
+        if isinstance(G, graph_cache.ColumnarGraph):
+            # Straight from the (memory-mapped) columns, without networkx. They're
+            #  read-only, so the original graph can't be changed anyway.
+            if lean:
+                Gn, Ge = G.to_gdfs(LEAN_NODE_COLUMNS, LEAN_EDGE_COLUMNS)
+            else:
+                Gn, Ge = G.to_gdfs()
+        else:
+            Gn, Ge = ox.graph_to_gdfs(G, node_geometry=False, fill_edge_geometry=False)
+            Gn, Ge = Gn.copy(), Ge.copy()  # make sure original graph is unchanged.
+        if "u" not in Ge.columns:
+            # Newer versions of osmnx put (u, v, key) in the index.
+            Ge = Ge.reset_index()
+        if lean:
+            Gn = pd.DataFrame(Gn[[c for c in LEAN_NODE_COLUMNS if c in Gn.columns]])
+            Ge = pd.DataFrame(Ge[[c for c in LEAN_EDGE_COLUMNS if c in Ge.columns]])
 
         ## Fix up Gn  ( NODES dataframe )
+        if "transit_time" not in Gn.columns:
+            # Transit times haven't been calculated (yet); e.g., when the same
+            #  dataframes are re-used for several center nodes.
+            Gn["transit_time"] = np.nan
         Gn["w"] = 0
         Gn["calculated"] = False
         # Coerce types of geodataframe to what we want
         for f, t in (
-            ("transit_time", float),
+            ("transit_time", real),
             ("calculated", bool),
-            ("lat", float),
-            ("lon", float),
+            ("lat", real),
+            ("lon", real),
             ("osmid", int),
-            ("x", float),
-            ("y", float),
+            ("x", real),
+            ("y", real),
             ("highway", str),
         ):
-            Gn[f] = Gn[f].astype(t)
+            if f in Gn.columns:
+                Gn[f] = Gn[f].astype(t)
+        if "highway" in Gn.columns:
+            Gn["highway"] = Gn["highway"].astype("category")
 
         ## Fix up Ge ( EDGES dataframe )
         # Reverse if needed
+        Ge["reversed"] = False
         if not towards_origin:
-            Ge[["u", "v"]] = Ge[["v", "u"]]
-            Ge["reversed"] = True
-        else:
-            Ge["reversed"] = False
+            Ge = reverse_edges(Ge)
 
         Ge["w"] = 0  # Next edge is (v, w)
         Ge["v2"] = 0
@@ -87,16 +147,57 @@ def create_initial_dataframes(G, towards_origin=True):
         # Coerce types of geodataframe to what we want
         for f, t in (
             ("through_traffic", int),
-            ("u", np.long),
-            ("v", np.long),
-            ("v2", np.long),
+            ("u", np.int64),
+            ("v", np.int64),
+            ("v2", np.int64),
+            ("length", real),
         ):
             Ge[f] = Ge[f].astype(t)
-        Ge.highway = Ge.highway.map(str)
+        # (There are only a few kinds of roads, so the strings are only dealt with
+        #  once each, as categories.)
+        Ge["highway"] = Ge.highway.map(str).astype("category")
+        Ge["road_class"] = road_classes(Ge.highway)
+        # Speeds, for estimating transit times.
+        Ge["speed_mps"] = local_routing.estimate_speeds_mps(
+            Ge.highway, Ge["maxspeed"] if "maxspeed" in Ge.columns else np.nan
+        ).astype(real)
+        if lean:
+            Ge = Ge.drop(columns=["maxspeed"], errors="ignore")
+
+        # Dense node and edge IDs (see `compact`), so that the later stages can
+        #  work on integer arrays instead of looking edges up by their OSM IDs.
+        node_ids, ui, vi = compact.dense_node_ids(Ge.u, Ge.v, node_ids=Gn.index)
+        Ge["ui"], Ge["vi"] = ui, vi
+        Ge.attrs["graph"] = compact.CompactGraph(node_ids, ui, vi)
 
     return Gn, Ge
 
 
+def road_classes(highway):
+    """The ROAD_CLASSES code (int8) of each 'highway' tag, or OTHER_ROAD."""
+    highway = pd.Series(highway).astype("category")
+    codes = pd.Index(ROAD_CLASSES).get_indexer(highway.cat.categories.astype(str))
+    codes[codes < 0] = OTHER_ROAD
+    # (Missing tags have category code -1, i.e., the OTHER_ROAD at the end.)
+    codes = np.append(codes, OTHER_ROAD).astype(np.int8)
+    return codes[highway.cat.codes.to_numpy()]
+
+
+def reverse_edges(Ge):
+    """Flip the direction of the edges dataframe from `create_initial_dataframes`,
+    e.g. to get the 'away from origin' edges from the 'towards origin' ones without
+    re-creating them from the graph. Returns a copy."""
+    Ge = Ge.copy()
+    Ge[["u", "v"]] = Ge[["v", "u"]]
+    if "ui" in Ge.columns:
+        Ge[["ui", "vi"]] = Ge[["vi", "ui"]]
+        graph = Ge.attrs.get("graph")
+        if graph is not None:
+            Ge.attrs["graph"] = graph.edges_like(graph.vi, graph.ui)
+    Ge["reversed"] = ~Ge["reversed"]
+    return Ge
+
+
 def initial_routing(Ge, Gn):
     """Use the transit times from the table API (must already have been run) to do an easy,
     initial routing that can safe us from querying the slower routing API. Basically,
@@ -106,363 +207,546 @@ def initial_routing(Ge, Gn):
     """
 
     with Timer(prefix="Initial routing using heuristics"):
+        graph = compact.graph_of(Ge)
+
         # Grab edge's start & end time from nodes.
-        Ge["start_time"] = Gn.loc[Ge.u].transit_time.values
-        Ge["end_time"] = Gn.loc[Ge.v].transit_time.values
+        transit_time = np.full(graph.n_nodes, np.nan)
+        node_i = graph.node_index(Gn.index)
+        has_edges = node_i >= 0
+        transit_time[node_i[has_edges]] = Gn.transit_time.to_numpy(float)[has_edges]
+        Ge["start_time"] = transit_time[graph.ui]
+        Ge["end_time"] = transit_time[graph.vi]
         # dt is how much transit times changes when this edge is traversed.
         #   If negative, then we made progress.
         Ge["dt"] = Ge["end_time"] - Ge["start_time"]
 
-        # Create multiindex
+        # Keep only the longest of any parallel edges (in order of (u, v)).
         ### Q: should we sort 'length'? or keep all copies?  << done >>
         ###   Might this cause problems later w/ missing segments?
-        Ge = Ge.sort_values("length", ascending=False).groupby(["u", "v"]).first()
+        order = np.lexsort((-Ge["length"].to_numpy(float), graph.vi, graph.ui))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (np.diff(graph.ui[order]) != 0) | (np.diff(graph.vi[order]) != 0)
+        keep = order[first]
+        Ge = Ge.iloc[keep].reset_index(drop=True)
+        graph = graph.edges_like(graph.ui[keep], graph.vi[keep])
+        Ge["ui"], Ge["vi"] = graph.ui, graph.vi
 
         # Ignore streets that we know will have traffic b/c they: footways; and service roads.
         #  (unless we are later routed through them by the OSRM API)
-        Ge["ignore"] = False
-        Ge.ignore = (
-            Ge.ignore
+        #  (That's decided for each kind of road once, not for each edge.)
+        highway = Ge.highway.astype("category")
+        ignored = highway.cat.categories.astype(str).str.contains(
             # | (Ge.dt > 0)  # take us further away;
-            | Ge.highway.str.contains("footway")  # shouldn't route here
-            | Ge.highway.str.contains("service")  # shouldn't route here
-            | Ge.highway.str.contains("path")  # shouldn't route here
-            | Ge.highway.str.contains("driveway")  # shouldn't route here
+            "footway|service|path|driveway"  # shouldn't route here
         )
+        Ge["ignore"] = np.append(ignored, False)[highway.cat.codes.to_numpy()]
 
         # Calculate how efficiently each possible route gets us towards our goal.
-        Ge["speed_mps"] = (
-            Ge.maxspeed.str.replace(" mph", "").astype(float).fillna(25) * 1609 / 3600
-        )
+        if "speed_mps" not in Ge.columns:
+            Ge["speed_mps"] = local_routing.estimate_speeds_mps(Ge.highway, Ge.maxspeed)
         Ge["est_transit_time_s"] = Ge["length"] / Ge["speed_mps"]
         Ge["efficiency"] = Ge["dt"] / Ge["est_transit_time_s"]
 
-        # Gives us back an unambiguous dummy index (integers, 0..len(Ge)) but keeps u,v as cols
-        # that we can query more flexibly than if they are in the index
-        Ge = Ge.reset_index()
-
-        # Calculate the 'best' next step for each route, based on efficiency, but
+        # Calculate the 'best' next step out of each node, based on efficiency, but
         #  only allowing choices that get us closer (to avoid cycles)
-        best_edges = (
-            Ge.query("dt<0")
-            .sort_values("efficiency", ascending=True)
-            .groupby("u")
-            .v.first()
-        )
-
-        # Now we have a u->v (n1->n2) mapping¬, like:
-        # u
-        # 25240726       250117169
-        # 25240774       250142020
-        #                  ...
-        # 5089035979     194721949
-        # Name: v, Length: 245, dtype: int64
+        efficiency = Ge.efficiency.to_numpy(float)
+        ok = np.flatnonzero(Ge.dt.to_numpy(float) < 0)
+        ok = ok[np.lexsort((efficiency[ok], graph.ui[ok]))]
+        best = ok[_group_starts(graph.ui[ok])]
+        best_edge = np.full(graph.n_nodes, compact.UNROUTED, dtype=compact.ID_DTYPE)
+        best_edge[graph.ui[best]] = best
 
-        # We create a new column, 'w', which contains the 'next step' of (u,v) if
-        #  we know it... and is 0 otherwise.
-        Ge["w"] = Ge.v.map(best_edges).fillna(0).astype(np.long)
+        # The successor of (u,v) is the best step out of v (v,w), if we know it...
+        #  and UNROUTED otherwise. ('w' is filled in from it, as before.)
+        successor = best_edge[graph.vi]
 
-        # Special value -1 for 'w' means it's the final traffic sink.
-        Ge.loc[Ge.end_time == 0, "w"] = -1
-
-        # We make a copy of 'v' that is used to keep track of how to 'skip' to
-        #  a later segment if the following segment (v,w) doesn't exist (anwer:
-        #  just route traffic to (v2,w) and accept there there will be a 'gap'
-        #  on screen.
-        Ge["v2"] = Ge["v"].astype("int")
+        # The center node is the final traffic sink.
+        successor[Ge.end_time.to_numpy(float) == 0] = compact.SINK
 
         # Re-index Ge as (u,v) for fast access.
         Ge = Ge.set_index(["u", "v"])
+        compact.set_successors(Ge, graph, successor)
 
         return Ge, Gn
 
 
-def followup_heuristic_routing(Ge, Gn):
-    """ Route edges that aren't clear by recursively searching for alternative
-    routes that eventually get us closer. I think this is needed because the
-    table API can give bogus results. But, if this doesn't work, we'll just
-    use the OSRM Routing API directly in the next step."""
+def followup_heuristic_routing(Ge, Gn, max_depth=3):
+    """Route edges that aren't clear by searching for alternative
+    routes (up to `max_depth` steps ahead) that eventually get us closer. I think
+    this is needed because the table API can give bogus results. But, if this
+    doesn't work, we'll just use the OSRM Routing API directly in the next step.
+
+    The edges are routed just like they'd be one at a time, farthest away (by
+    end_time) first: each one searches 1 step ahead, then 2 steps, etc., for the
+    options that get us closer, takes the most efficient one (most progress (dt)
+    per meter; the first one found, if it's a tie), and the steps along it are
+    routed accordingly, before the next edge is searched.
+
+    To do that quickly, the edges are searched together, in rounds, as a batched
+    search on integer edge arrays. In each round, every edge that's left finds its
+    option, as things are at the start of the round, and keeps it only if no edge
+    ahead of it could still route any of the steps that it looked at (see
+    `_settled`); the others search again in the next round. (Routing a step only
+    ever takes options away, so an edge that finds none now never will.)"""
     with Timer(prefix="Follow-up routing using heuristics"):
+        graph = compact.graph_of(Ge)
+        successor = compact.successors_of(Ge, graph)
+        end_time = Ge.end_time.to_numpy(float)
+        length = Ge["length"].to_numpy(float)
+        ignore = Ge.ignore.to_numpy(bool)
+        unrouted = successor == compact.UNROUTED
         print(
-            f"Need to fix {len(Ge.query('w==0 and ignore==False'))} ambiguous edges (Currently: {len(Ge.query('ignore==True'))} ignored, {len(Ge.query('w!=0 and ignore==False'))} resolved, {len(Ge)} total)"
-        )
-
-        def get_options(s, depth):
-            """ Recursive enumeration of all routes we can take away from
-            this spot. We'll then pick the best one. This is SLOW and should
-             be improved or skipped."""
-            u, v = s.name
-            if depth <= 0:
-                return [[s]]
-            options = []
-            #     if s.w:
-            try:
-                # next_options = Ge.query('u==@v and v==@s.w') if s.w else Ge.query('u==@v')
-                # here, should we ignore footpaths, etc?
-                if s.w:
-                    next_options = Ge.loc[([v], [s.w]), :]
-                else:
-                    next_options = Ge.loc[[v], :]
-            except KeyError:
-                return [[s]]
-            #     else:
-            #         next_options = Ge.loc[(v, slice(None))]#.query('u==@v')
-            for (up, vp), sp in next_options.iterrows():
-                options += [[s] + spp for spp in get_options(sp, depth - 1)]
-            return options
-
-        def option_length(option):
-            return sum([o.length for o in option])
-
-        # Loop through every un-calculated edge.
-        df_to_fix = Ge.query("w==0 and ignore==False").sort_values(
-            "end_time", ascending=False
+            f"Need to fix {(unrouted & ~ignore).sum()} ambiguous edges (Currently: {ignore.sum()} ignored, {(~unrouted & ~ignore).sum()} resolved, {len(Ge)} total)"
         )
-        for i, ((u, v), s) in enumerate(df_to_fix.iterrows()):
-            if Ge.loc[(u, v), "w"] != 0:
-                continue  # might have been filled in by previous loops; skip! :)
-
-            if i % 100 == 0:
-                print(f"{i}/{len(df_to_fix)}")
-
-            # Search out farther and farther hoping that we find
-            #  a route that gets us closer than we are now.
-            for n in range(1, 4, 1):
-                options = get_options(s, n)
-                if not len(options):
-                    break
-
-                df = pd.DataFrame.from_dict(
-                    {
-                        i: {"dt": o[-1].end_time - s.end_time, "l": option_length(o)}
-                        for i, o in enumerate(options)
-                    },
-                    orient="index",
-                )
 
-                df = df.query("dt<0")
-                df.loc[:, "efficiency"] = df.dt / df.l
-                df = df.sort_values("efficiency")
-                if not len(df):
-                    continue
+        # The edges to fix, farthest away first.
+        to_fix = np.flatnonzero(unrouted & ~ignore)
+        to_fix = to_fix[np.argsort(-end_time[to_fix], kind="stable")]
 
-                # cool - we found a path that gets us closer. Let's route
-                #  accordingly.
-                option = options[
-                    df.index[0]
-                ]  # grab the best otion as decided by sorting df
-                for i, step in enumerate(option[:-1]):
-                    assert (step.w == 0) or (step.w == option[i + 1].name[1])
-                    Ge.loc[step.name, "w"] = option[i + 1].name[1]
-                #             print('Found new sub-path w/ depth %d: \n%s' % (n, str(df.iloc[0])))
+        n_rounds = 0
+        while True:
+            # (they might have been filled in already)
+            to_fix = to_fix[successor[to_fix] == compact.UNROUTED]
+            if not len(to_fix):
                 break
-            else:
-                print(RuntimeWarning("Couldn" "t find workable option by n==%d" % n))
-                ### Should we do an OSRM route lookup here?
-                ## Might be efficient, especially if we started with the
-                ## furthest-away ambiguous edge...
+            n_rounds += 1
+
+            best, looked_at = _best_options(
+                graph, successor, to_fix, max_depth, end_time, length
+            )
+            found = best[:, 0] >= 0
+            settled = _settled(graph, successor, to_fix, found, looked_at, max_depth)
+
+            # Route along the options of the settled edges. (No two of them have
+            #  a step to route in common.)
+            steps, next_steps = best[settled, :-1], best[settled, 1:]
+            along = next_steps >= 0
+            successor[steps[along]] = next_steps[along]
+
+            # (The ones that didn't find any are done with, too.)
+            to_fix = to_fix[found & ~settled]
+
+        n_failed = ((successor == compact.UNROUTED) & ~ignore).sum()
+        print("Searched in %d round(s)." % n_rounds)
+        if n_failed:
+            print(
+                RuntimeWarning(
+                    "Couldn't find workable option by n==%d for %d edges"
+                    % (max_depth, n_failed)
+                )
+            )
+        compact.set_successors(Ge, graph, successor)
 
     return Ge, Gn
 
 
+def _best_options(graph, successor, roots, max_depth, end_time, length):
+    """The option that each edge in `roots` takes (see
+    `followup_heuristic_routing`), searching 1 step ahead, then 2, etc. Returns
+    (best, looked_at): each one's option ([root, step 1, ...], max_depth + 1 long,
+    padded with -1; all -1 if it didn't find one), and the (root number, edge) of
+    every step whose successor was looked at to find them (see `_settled`)."""
+    best = np.full((len(roots), max_depth + 1), -1, dtype=np.int64)
+    looked_at = []
+    searching = np.arange(len(roots))
+    for depth in range(1, max_depth + 1):
+        # Every option 'depth' steps ahead, from each edge that's still searching
+        paths, origin = _enumerate_options(graph, successor, roots[searching], depth)
+        origin = searching[origin]
+        last = _last_steps(paths)
+
+        # Keep the options that get us closer, and pick the most efficient one
+        #  for each edge (the first one, if it's a tie).
+        dt = end_time[last] - end_time[paths[:, 0]]
+        total_length = np.where(paths >= 0, length[paths], 0).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            efficiency = dt / total_length
+        ok = np.flatnonzero(dt < 0)
+        ok = ok[np.lexsort((efficiency[ok], origin[ok]))]
+        ok = ok[_group_starts(origin[ok])]
+        best[origin[ok], : depth + 1] = paths[ok]
+
+        # The ones that found one looked at every step of their options (but the
+        #  last ones).
+        done = np.isin(origin, origin[ok])
+        looked_at.append(_steps_of(paths[done, :-1], origin[done]))
+        searching = np.setdiff1d(searching, origin[ok])
+        if not len(searching):
+            break
+    return best, np.concatenate(looked_at)
+
+
+def _settled(graph, successor, roots, found, looked_at, max_depth):
+    """Which of the `roots` (in the order that they'd be routed in, one at a time)
+    found the same option (see `_best_options`) that they would have, one at a
+    time: the ones that found one, and didn't look at any (unrouted) step that a
+    root ahead of them that also found one could still route. (A root can only
+    ever route the steps of its options, and it only ever has fewer of them, so
+    that's any step of its options now, but the last ones.)"""
+    searched = np.flatnonzero(found)
+    paths, origin = _enumerate_options(graph, successor, roots[searched], max_depth - 1)
+    number, step = _steps_of(paths, searched[origin]).T
+    free = successor[step] == compact.UNROUTED
+    first = np.full(graph.n_edges, len(roots))
+    np.minimum.at(first, step[free], number[free])
+
+    number, step = looked_at.T
+    free = successor[step] == compact.UNROUTED
+    settled = found.copy()
+    settled[number[free & (first[step] < number)]] = False
+    return settled
+
+
+def _steps_of(paths, origin):
+    """The (origin, edge) of every (non-padding) step of the routes in `paths`."""
+    is_step = paths >= 0
+    return np.stack(
+        [np.broadcast_to(origin[:, None], paths.shape)[is_step], paths[is_step]],
+        axis=1,
+    )
+
+
+def _enumerate_options(graph, successor, roots, depth):
+    """All of the routes up to `depth` steps ahead of each edge in `roots`, one
+    per row: [root, step 1, step 2, ...], padded with -1 when a route can't go any
+    further. A step follows the edge's successor if it is known, or else tries
+    every edge out of 'v' (in order). Returns (paths, origin): the routes, in the
+    order that a depth-first search would find them, and which root each one is
+    from."""
+    paths = roots[:, None]
+    origin = np.arange(len(roots))
+    last = roots
+    for d in range(depth):
+        free = successor[last] == compact.UNROUTED
+        n_children = np.where(
+            free, graph.out_degree[graph.vi[last]], successor[last] >= 0
+        )
+        # (Routes that can't go any further are kept as they are.)
+        n_children[paths[:, -1] < 0] = 0
+        n_rows = np.maximum(n_children, 1)
+
+        parent = np.repeat(np.arange(len(paths)), n_rows)
+        offset = np.arange(len(parent)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+        out_edge = graph.out_edges[
+            np.minimum(graph.indptr[graph.vi[last[parent]]] + offset, graph.n_edges - 1)
+        ]
+        child = np.where(free[parent], out_edge, successor[last[parent]])
+        child = np.where(n_children[parent] > 0, child, -1)
+
+        paths = np.hstack([paths[parent], child[:, None]])
+        origin = origin[parent]
+        last = np.where(child >= 0, child, last[parent])
+    return paths, origin
+
+
+def _group_starts(sorted_values):
+    """Mask of the first of each run of equal values in a sorted array."""
+    starts = np.ones(len(sorted_values), dtype=bool)
+    starts[1:] = sorted_values[1:] != sorted_values[:-1]
+    return starts
+
+
+def _last_steps(paths):
+    """The last (non-padding) step of each route."""
+    n_steps = (paths >= 0).sum(axis=1)
+    return paths[np.arange(len(paths)), n_steps - 1]
+
+
 def followup_osrm_routing_parallel(
-    G, Ge, Gn, center_node, min_iter=5, max_iter=100, towards_origin=True
+    G,
+    Ge,
+    Gn,
+    center_node,
+    max_iter=100,
+    towards_origin=True,
+    client=None,
+    batch_size=None,
 ):
-    """ Use OSRM routing API calls to fix any remaining unsolved edges.
-    This version uses parallelized/simultaneous OSRM calls to speed things up."""
-
-    # How many routings to do before re-scanning for candidate nodes, which
-    #  may have been resolved in the meantime
-    BATCH_SIZE = 25
-    # How many calls to do in parallel.
-    N_WORKERS = 5
-
-    # Spin up a thread pool for parallelization of the OSRM calls.
-    with concurrent.futures.ThreadPoolExecutor(max_workers=N_WORKERS) as executor:
-
-        with Timer(prefix="Fix missing bits with OSRM"):
-            for i in range(max_iter):
-                df_unsolved = Ge.query("w==0 and ignore==False")
-                print("There are %d unsolved edges." % len(df_unsolved))
-
-                # We get as many unresolved nodes as we can.
-                df_to_solve = df_unsolved.sample(min(BATCH_SIZE, len(df_unsolved)))
-
-                # And if we need others, we choose them randomly.
-                n_extra_needed = BATCH_SIZE - len(df_to_solve)
-                if n_extra_needed:
-                    df_to_solve = df_to_solve.append(
-                        Ge.query("w > 0 and ignore==False").sample(n_extra_needed)
+    """Use OSRM routing API calls to fix any remaining unsolved edges.
+    This version uses parallelized/simultaneous OSRM calls to speed things up.
+    `client` is the osrm.OSRMClient to use (default: `osrm.get_client()`).
+
+    One route resolves every edge along it, so we route from the unsolved edges
+    that are farthest upstream (by end_time) first: their routes cover as many of
+    the others as possible. Each round sends `batch_size` routes (default: as many
+    as the client has in flight), one per node 'v' (which also solves every other
+    unsolved edge into v), and then drops whatever got solved from the (sorted)
+    unsolved list. We stop as soon as nothing is left, after `max_iter` rounds,
+    or when a route didn't solve the edges that it was for (they're given up on).
+    The number of calls vs. edges solved is printed, and kept in
+    Ge.attrs["osrm_routing"]."""
+
+    # The OSRM calls are done in parallel, in the client's (pooled) thread pool.
+    client = client or osrm.get_client()
+    executor = client.executor
+    batch_size = batch_size or client.max_in_flight
+
+    graph = compact.graph_of(Ge)
+    successor = compact.successors_of(Ge, graph)
+
+    # The unsolved edges, farthest upstream first. This is the only scan of Ge; from
+    #  here on, edges only ever leave the list.
+    unsolved = np.flatnonzero(
+        (successor == compact.UNROUTED) & ~Ge.ignore.to_numpy(bool)
+    )
+    end_time = Ge.end_time.to_numpy(float)
+    unsolved = unsolved[np.argsort(-end_time[unsolved], kind="stable")]
+    n_unsolved = len(unsolved)
+    n_calls = 0
+
+    with Timer(prefix="Fix missing bits with OSRM"):
+        for i in range(max_iter):
+            unsolved = unsolved[successor[unsolved] == compact.UNROUTED]
+            if not len(unsolved):
+                break
+            print("There are %d unsolved edges." % len(unsolved))
+
+            # The first `batch_size` different nodes 'v' of the unsolved edges.
+            vi, first = np.unique(graph.vi[unsolved], return_index=True)
+            vi = vi[np.argsort(first)][:batch_size]
+            to_solve = unsolved[np.isin(graph.vi[unsolved], vi)]
+
+            # OK - these are the nodes we need to route to/from
+            node_ids = graph.node_ids[vi]
+            n_calls += len(node_ids)
+
+            # Submit the OSRM requests.
+            if towards_origin:
+                future_to_node = {
+                    executor.submit(
+                        osrm.osrm, G, G.nodes[node_id], center_node, client=client
+                    ): node_id
+                    for node_id in node_ids
+                }
+            else:
+                future_to_node = {
+                    executor.submit(
+                        osrm.osrm, G, center_node, G.nodes[node_id], client=client
+                    ): node_id
+                    for node_id in node_ids
+                }
+
+            # Now grab all of the results and turn them into (u,v,w) triplets of
+            #  dense node IDs.
+            routings = []
+            for future in concurrent.futures.as_completed(future_to_node):
+                v = future_to_node[future]
+                try:
+                    route, transit_time, r = future.result()
+                except Exception as exc:
+                    print(exc)
+                    continue
+
+                # (Only the nodes that are in Ge.)
+                route = graph.node_index(route)
+                route = route[route >= 0]
+                if not towards_origin:
+                    route = route[::-1]
+
+                vi = graph.node_index([v])
+                if not len(route) or route[0] != vi[0]:
+                    route = np.concatenate([vi, route])
+                for ui in graph.ui[to_solve[graph.vi[to_solve] == vi[0]]]:
+                    rroute = np.concatenate([[ui], route])
+                    routings.append(
+                        np.stack([rroute[:-2], rroute[1:-1], rroute[2:]], axis=1)
                     )
 
-                # OK - these are the nodes we need to route to/from
-                node_ids = df_to_solve.index.get_level_values("v").unique()
-                nodes = set(Ge.index.get_level_values(1)).union(
-                    Ge.index.get_level_values(0)
-                )
+            # The edges (u,v) and (v,w) of each triplet, from all of the OSRM
+            #  requests we just did. Get rid of any (u,v) pairs that aren't in the
+            #  edges array Ge; if (v,w) isn't, traffic leaves the map after (u,v).
+            routings = np.concatenate(routings or [np.zeros((0, 3), np.int64)])
+            edges = graph.find_edges(routings[:, 0], routings[:, 1])
+            next_edges = graph.find_edges(routings[:, 1], routings[:, 2])
+            next_edges[next_edges < 0] = compact.SINK
+            edges, next_edges = edges[edges >= 0], next_edges[edges >= 0]
+
+            # de-dup, taking most common 'w' if there are multiples. (especially on high-traffic routes,
+            #  we probably will have a lot of duplicates from our parallel requests)
+            pairs, counts = np.unique(
+                np.stack([edges, next_edges], axis=1), axis=0, return_counts=True
+            )
+            pairs = pairs[np.lexsort((pairs[:, 1], -counts, pairs[:, 0]))]
+            pairs = pairs[_group_starts(pairs[:, 0])]
+            edges, next_edges = pairs[:, 0], pairs[:, 1]
+
+            n_new_solved = (successor[edges] == compact.UNROUTED).sum()
+            print(f"Solved {n_new_solved} new edges.")
+            successor[edges] = next_edges
+
+            # Don't ask again for edges that their own route didn't solve (e.g.,
+            #  the request failed); they'd just fail again.
+            given_up = to_solve[successor[to_solve] == compact.UNROUTED]
+            unsolved = unsolved[~np.isin(unsolved, given_up)]
+
+    n_left = ((successor == compact.UNROUTED) & ~Ge.ignore.to_numpy(bool)).sum()
+    n_solved = n_unsolved - n_left
+    print(
+        "Made %d OSRM route calls; solved %d edges (%.1f per call), %d left unsolved."
+        % (n_calls, n_solved, n_solved / max(n_calls, 1), n_left)
+    )
+    print(client.stats)
+
+    compact.set_successors(Ge, graph, successor)
+    Ge.attrs["osrm_routing"] = dict(calls=n_calls, solved=n_solved, unsolved=n_left)
 
-                # Submit the OSRM requests.
-                if towards_origin:
-                    future_to_node = {
-                        executor.submit(
-                            osrm.osrm, G, G.nodes[node_id], center_node
-                        ): node_id
-                        for node_id in node_ids
-                    }
-                else:
-                    future_to_node = {
-                        executor.submit(
-                            osrm.osrm, G, center_node, G.nodes[node_id]
-                        ): node_id
-                        for node_id in node_ids
-                    }
-
-                # Now grab all of the results and put them into an array.
-                routings = []
-                for future in concurrent.futures.as_completed(future_to_node):
-                    v = future_to_node[future]
-                    try:
-                        route, transit_time, r = future.result()
-                    except Exception as exc:
-                        print(exc)
-                        continue
-
-                    for uu, vv in df_to_solve.loc[pd.IndexSlice[:, [v]], :].index:
-                        rroute = list(filter(lambda e: e in nodes, route))
-                        if not towards_origin:
-                            rroute = rroute[::-1]
-                        if rroute[0] != vv:
-                            rroute = [vv] + rroute
-                        rroute = [uu] + rroute
-
-                        # Add to 'routings' as (u,v,w) triplets.
-                        routings += [rroute[i : i + 3] for i in range(len(rroute) - 2)]
-
-                # A dataframe of all the triplets from all of the OSRM requests we just did
-                dfroutings = pd.DataFrame(routings, columns=["u", "v", "w"])
-
-                # de-dup, taking most common 'w' if there are multiples. (especially on high-traffic routes,
-                #  we probably will have a lot of duplicates from our parallel requests)
-                dfroutings2 = dfroutings.groupby(["u", "v"]).agg(
-                    lambda x: pd.Series.mode(x)[0]
-                )
+    return Ge
 
-                # Now, get rid of any (u,v) pairs that aren't in the edges array Ge.
-                common_index = dfroutings2.index.intersection(Ge.index)
-                missing_index = dfroutings2.index.difference(Ge.index)
-                # for (u, v) in missing_index:
-                #
-                #     uu, vv = u, v
-                #
-                #     for i in range(500):
-                #         ww = dfroutings2.loc[(uu, vv)].item()
-                #
-                #         if (vv, ww) in Ge.index:
-                #             Ge.loc[(u, v), "v2"] = int(vv)
-                #             Ge.loc[(u, v), "w"] = int(ww)
-                #             print(f"!{i}")
-                #             break
-                #         else:
-                #             uu, vv = vv, ww
-                #     else:
-                #         # raise Exception()
-                #         print(f'Oh crap! {i}')
-                n_new_solved = len(common_index.intersection(df_unsolved.index))
-                print(f"Solved {n_new_solved} new edges.")
-                Ge.loc[common_index, "w"] = dfroutings2.loc[common_index, "w"]
-
-                # If we've solved them all, and have done our min_iter iterations,then break.
-                if (len(df_unsolved) == 0) and (i >= min_iter):
-                    break
+
+def followup_local_routing(G, Ge, Gn, center_node, towards_origin=True, tree=None):
+    """Use the local routing engine to set the exact next step 'w' of every edge
+    from a single shortest-path tree, with no OSRM calls at all. This can be used
+    in place of `followup_osrm_routing_parallel` (and makes
+    `followup_heuristic_routing` unnecessary). Edges that can't reach the center
+    node are left with w==0.
+    `tree` is the (node_ids, transit_time, next_node) from
+    `local_routing.shortest_path_tree`, if it's already known (e.g., from the whole
+    map, when Ge is just one tile of it; see `tiling`)."""
+
+    with Timer(prefix="Fix missing bits with local routing engine"):
+        if tree is None:
+            tree = local_routing.shortest_path_tree(
+                G, center_node, towards_origin=towards_origin
+            )
+        node_ids, transit_time, next_node = tree
+
+        # The next step after (u,v) is the next step on the route from v.
+        graph = compact.graph_of(Ge)
+        node_i = graph.node_index(node_ids)
+        next_node_of = np.zeros(graph.n_nodes, dtype=np.int64)
+        next_node_of[node_i[node_i >= 0]] = next_node[node_i >= 0]
+        compact.set_successors(Ge, graph, graph.successors(next_node_of[graph.vi]))
+
+        print(
+            "Routed %d edges; %d can't reach the center node."
+            % ((Ge.w != 0).sum(), (Ge.w == 0).sum())
+        )
 
     return Ge
 
 
 def propagate_edges(Ge):
     """Propagate traffic from each edge towards the center node, using the routings that we just
-     figured out. """
+     figured out.
+
+    Every edge passes its traffic on to its successor (the edge (v2, w) that
+    follows it), so the routings form a forest of edges. We accumulate the traffic
+    in topological order (upstream edges first), a whole 'generation' of edges at
+    a time. Routing loops (which shouldn't happen, but can with bogus routings) are
+    reported, stored in Gge.attrs["cycles"] as lists of (u, v) edges, and broken at
+    the edge that is closest to the center node, so that their traffic still gets
+    counted once."""
 
     # Reset index to a dummy integer index for faster/easier access
     Gge = Ge.copy().reset_index()
 
-    # Make a mapping from ('u','v') to this new dummy index to speed up some stuff below.
-    edge_mapping = Gge[["u", "v"]].copy()
-    edge_mapping["edge_idx"] = edge_mapping.index
-    edge_mapping = edge_mapping.set_index(["u", "v"])
-
-    Gge["through_traffic"] = 0  # how much traffic has gone through each edge.
-    Gge["current_traffic"] = 0  # Amount of traffic on that edge
-    valid_edges = Gge.query("w != 0")
+    # How much traffic starts out on each edge.
+    graph = compact.graph_of(Gge)
+    successor = compact.successors_of(Gge, graph)
+    spawn = spawn_traffic(Gge, successor)
 
-    # Each non-ignored edge gets 1 car, plus another 1 car per every 50 m of length.
-    Gge.loc[valid_edges.index, "current_traffic"] = valid_edges.length / 50  # +1
-
-    # No traffic originates on freeways
-    Gge.loc[Gge.highway.str.startswith("motorway") == True, "current_traffic"] = 0
-
-    # Residential streets spawn more traffic
-    Gge.loc[
-        Gge.highway.isin(["residential", "tertiary", "secondary"]) == True,
-        "current_traffic",
-    ] *= 5
-
-    old_status = ""
     with Timer(prefix="Propagate Edges"):
-        while True:
-            edges_to_propagate = (
-                Gge.query("(current_traffic > 0)")  # .reset_index()  # & (w != 0)")
-                .loc[:, ["u", "v", "v2", "w", "current_traffic"]]
-                .copy()
-            )
-
-            if not len(edges_to_propagate):
-                break
+        end_time = Gge["end_time"].to_numpy(float) if "end_time" in Gge else None
+        through_traffic, cycles = _accumulate_traffic(successor, spawn, end_time)
 
-            try:
-                # Print status, and check to make sur eit changed, otherwise
-                # we are in a loop
-                assert (edges_to_propagate.w != 0).all()
-                status = "Edges to propagate: %d. Traffic: %d. Cars on road: %d." % (
-                    len(edges_to_propagate),
-                    edges_to_propagate.current_traffic.mean(),
-                    edges_to_propagate.current_traffic.sum(),
+        print(
+            "Propagated %d cars over %d edges."
+            % (spawn.sum(), (through_traffic > 0).sum())
+        )
+        if cycles:
+            print(
+                RuntimeWarning(
+                    "Found %d routing loop(s), over %d edges, e.g.: %s"
+                    % (
+                        len(cycles),
+                        sum(len(c) for c in cycles),
+                        " -> ".join(str(n) for n in Gge.u.values[cycles[0]]),
+                    )
                 )
-                print(status)
-                if status == old_status:
-                    print("Looping without traffic updates. STOP!")
-                    # raise Exception()
-                    break
-                old_status = status
-            except Exception as e:
-                raise
-                pass
-
-            # Tally up current traffic as through traffic
-            Gge.loc[
-                edges_to_propagate.index, "through_traffic"
-            ] += edges_to_propagate.current_traffic
-
-            # Zero current traffic on main copy
-            Gge.current_traffic = 0
-
-            # Propagate current traffic to next step using the routing we figured out earlier.
-            traffic = (
-                edges_to_propagate.query("w>0")
-                .groupby(["v2", "w"])
-                .current_traffic.sum()
             )
 
-            # Drop any edges that don't exist
-            common_index = traffic.index.intersection(edge_mapping.index)
-            traffic = traffic.loc[common_index]
-            dummyindexed_traffic = pd.Series(
-                traffic.values,
-                index=edge_mapping.loc[traffic.index, "edge_idx"].values.astype(int),
-            )
+    Gge["through_traffic"] = through_traffic
+    Gge["current_traffic"] = 0.0  # Everything has reached its destination.
+    Gge.attrs["cycles"] = [
+        list(zip(Gge.u.values[c].tolist(), Gge.v.values[c].tolist())) for c in cycles
+    ]
+    return Gge
 
-            # Now propagate into the main copy to be ready for the next iteration.
-            Gge.loc[
-                dummyindexed_traffic.index, "current_traffic"
-            ] = dummyindexed_traffic
 
-    return Gge
+def spawn_traffic(Ge, successor):
+    """How much traffic starts out on each edge of Ge (by position), given its
+    `successor`s (see `compact.successors_of`): only routed edges get any."""
+
+    # How much traffic starts out on each edge:
+    #  each routed edge gets 1 car per every 50 m of length...
+    spawn = np.where(
+        successor != compact.UNROUTED, Ge["length"].to_numpy(float) / 50, 0.0
+    )
+    road_class = (
+        Ge["road_class"].to_numpy()
+        if "road_class" in Ge.columns
+        else road_classes(Ge.highway)
+    )
+    # ... but no traffic originates on freeways...
+    spawn[
+        np.isin(road_class, [ROAD_CLASS["motorway"], ROAD_CLASS["motorway_link"]])
+    ] = 0
+    # ... and residential streets spawn more traffic
+    spawn[
+        np.isin(
+            road_class,
+            [
+                ROAD_CLASS["residential"],
+                ROAD_CLASS["tertiary"],
+                ROAD_CLASS["secondary"],
+            ],
+        )
+    ] *= 5
+    return spawn
+
+
+def _accumulate_traffic(successor, traffic, end_time=None):
+    """Total traffic through every edge, given the traffic that starts out on each
+    edge and the edge that each edge passes its traffic on to (`successor`, -1 if
+    none). Uses Kahn's algorithm: the edges that nothing flows into go first, then
+    the edges that only they flow into, etc.
+
+    Any edges left over at the end are on routing loops. Each loop is broken at its
+    edge with the lowest `end_time` (or its first edge), and then we carry on.
+    Returns (through_traffic, cycles), where cycles is a list of arrays of edge
+    numbers, in the order that traffic goes around each loop."""
+
+    successor = np.array(successor, dtype=np.int64)
+    through_traffic = np.array(traffic, dtype=float)
+    n_in = np.bincount(successor[successor >= 0], minlength=len(successor))
+    done = np.zeros(len(successor), dtype=bool)
+    cycles = []
+
+    frontier = np.flatnonzero(n_in == 0)
+    while True:
+        while len(frontier):
+            done[frontier] = True
+            frontier = frontier[successor[frontier] >= 0]
+            np.add.at(through_traffic, successor[frontier], through_traffic[frontier])
+            targets, counts = np.unique(successor[frontier], return_counts=True)
+            n_in[targets] -= counts
+            frontier = targets[n_in[targets] == 0]
+
+        # Anything that isn't done yet is on a loop (every edge has only one
+        #  successor, so nothing can be 'downstream' of a loop).
+        left = np.flatnonzero(~done)
+        if not len(left):
+            break
+        cycle = [left[0]]
+        while successor[cycle[-1]] != cycle[0]:
+            cycle.append(successor[cycle[-1]])
+        cycle = np.array(cycle)
+        # Break it after the edge that's closest to the center node.
+        last = len(cycle) - 1 if end_time is None else np.argmin(end_time[cycle])
+        cycle = np.roll(cycle, -(last + 1))
+        successor[cycle[-1]] = -1
+        n_in[cycle[0]] -= 1
+        cycles.append(cycle)
+        frontier = cycle[:1]
+
+    return through_traffic, cycles
@@ -0,0 +1,142 @@
+"""Animate a motorshed: a video (or GIF) of it filling in, out from the center node
+by transit time (an 'isochrone sweep', see `fill_in_frames`), or of its traffic
+building up, hop by hop, as it's propagated towards the center node (like
+`gen2.propagate_edges` does, see `build_up_frames`).
+
+Calling `render_layer` for every frame would build a whole matplotlib figure each
+time. Instead, each frame is just the through traffic of every edge so far (a numpy
+array, worked out for all of the edges at once), and the edges are only projected
+once, in a `render_np.RenderSession`, which restyles them for each frame (edges
+without any traffic yet aren't drawn; the rest are scaled to the busiest edge of
+the finished motorshed, so they brighten as the traffic builds up).
+
+The frames are rendered on a pool of processes and handed to imageio's writer in
+order, as they're done, with only a few of them in flight at once, so the whole
+animation is never in memory."""
+
+import collections
+import concurrent.futures
+import os
+
+import imageio.v2 as imageio
+import numpy as np
+from contexttimer import Timer
+
+from motorshed.algos import compact, gen2
+
+
+def fill_in_frames(Gn, Gge, n_frames=100):
+    """The through traffic (for each row of Gge) of `n_frames` frames, as the
+    motorshed fills in: at each time (evenly spaced, from 0 to the longest transit
+    time to the center node), the edges that can get there (from both of their
+    nodes; see Gn's 'transit_time') by then have all of their traffic, and the
+    rest have none. (Edges with no transit time never show up.)"""
+    transit_time = Gn.transit_time.to_numpy(float)
+    node_i = Gn.index.get_indexer
+    edge_time = np.maximum(transit_time[node_i(Gge.u)], transit_time[node_i(Gge.v)])
+    traffic = Gge.through_traffic.to_numpy(float)
+
+    for t in np.linspace(0, np.nanmax(edge_time), n_frames):
+        yield np.where(edge_time <= t, traffic, 0.0)
+
+
+def build_up_frames(Gge, n_frames=None):
+    """The through traffic (for each row of Gge, e.g., from `gen2.propagate_edges`)
+    as the traffic that starts out on each edge (see `gen2.spawn_traffic`) moves on
+    towards the center node, an edge per hop. The first frame is before it's moved
+    at all, and the last one is when it's all arrived (the same as Gge's
+    'through_traffic'). There's a frame per hop, or (up to) `n_frames` (evenly spaced,
+    including the first and last ones)."""
+    successor = compact.successors_of(Gge)
+    spawn = gen2.spawn_traffic(Gge, successor)
+    # (Break routing loops where `propagate_edges` does.)
+    end_time = Gge["end_time"].to_numpy(float) if "end_time" in Gge else None
+    _, cycles = gen2._accumulate_traffic(successor, spawn, end_time)
+    successor = successor.astype(np.int64)
+    for cycle in cycles:
+        successor[cycle[-1]] = -1
+
+    def hops():
+        # The through traffic after each hop, while any of it is still moving
+        #  (only the edges it's on are worked on).
+        through = spawn.copy()
+        yield through
+        moving = np.flatnonzero(spawn)
+        amount = spawn[moving]
+        while True:
+            keep = successor[moving] >= 0
+            if not keep.any():
+                break
+            edges, where = np.unique(successor[moving[keep]], return_inverse=True)
+            amount = np.bincount(where, weights=amount[keep], minlength=len(edges))
+            moving = edges
+            through[moving] += amount
+            yield through
+
+    if n_frames is None:
+        for through in hops():
+            yield through.copy()
+        return
+
+    # (How many hops there are, to know which ones to show.)
+    n_hops = sum(1 for _ in hops())
+    show = set(np.linspace(0, n_hops - 1, n_frames).round().astype(int).tolist())
+    for hop, through in enumerate(hops()):
+        if hop in show:
+            yield through.copy()
+
+
+def save_animation(fn, session, frames, fps=10, n_workers=None, **style):
+    """Render the `frames` (each the through traffic of every row of the session's
+    Ge; see above) with a `render_np.RenderSession` (with a style, see its
+    `render`), and write them to `fn` (a video, or a GIF, by its extension), on a
+    pool of `n_workers` processes (default: one per CPU; 1 means don't use a pool).
+    Returns how many frames were written."""
+    n_workers = n_workers or os.cpu_count()
+    # (GIFs are written by Pillow, which wants how long each frame is, in ms.)
+    if fn.lower().endswith(".gif"):
+        timing = dict(duration=1000 / fps, loop=0)
+    else:
+        timing = dict(fps=fps)
+
+    n_frames = 0
+    with Timer(prefix="Animate"), imageio.get_writer(fn, **timing) as writer:
+        if n_workers <= 1:
+            _frame_worker_init(session, style)
+            for through_traffic in frames:
+                writer.append_data(_frame_worker(through_traffic))
+                n_frames += 1
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_frame_worker_init,
+                initargs=(session, style),
+            ) as executor:
+                # Keep the workers busy, but with only a few frames waiting to be
+                #  written (in order) at a time.
+                pending = collections.deque()
+                for through_traffic in frames:
+                    if len(pending) >= 2 * n_workers:
+                        writer.append_data(pending.popleft().result())
+                        n_frames += 1
+                    pending.append(executor.submit(_frame_worker, through_traffic))
+                while pending:
+                    writer.append_data(pending.popleft().result())
+                    n_frames += 1
+
+    print("Wrote %d frames to %s." % (n_frames, fn))
+    return n_frames
+
+
+_frame_state = None
+
+
+def _frame_worker_init(session, style):
+    global _frame_state
+    _frame_state = (session, style)
+
+
+def _frame_worker(through_traffic):
+    session, style = _frame_state
+    # (Videos don't have an alpha channel.)
+    return session.render(through_traffic=through_traffic, **style)[..., :3]
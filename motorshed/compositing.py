@@ -0,0 +1,116 @@
+"""Composite layers (RGBA uint8 images, e.g., from `render_mpl.render_layer`, or
+`render_np.Layer`s to draw) into one output image, in place.
+
+`render_mpl.combine_layers_max` and `concat_layers_horiz` make a new full-size
+image each, so a bidirectional tri-pane map (the two directions, and both of them
+combined, side by side) holds several canvases at once. A `Canvas` is allocated
+once, with its panes (side by side, or stacked); layers are then drawn straight
+into their pane (the first one in each), or drawn into one pane-sized scratch
+image and blended in (the others), and images are blended in a band of rows at a
+time, so nothing else the size of the canvas is ever made.
+
+Blend modes (see `blend`):
+
+    max     the brighter of the two, channel by channel (like combine_layers_max)
+    add     the sum, saturating at 255 (e.g., for overlaying many origins)
+    over    the new layer over what's there, by its alpha. Layers are
+            premultiplied (as `render_np.draw_segments` draws on a transparent
+            background, e.g., bgcolor="none"); opaque ones just replace it."""
+
+import matplotlib.colors
+import numpy as np
+
+BLEND_MODES = ("max", "add", "over")
+# How many pixels to blend at once (for the temporary arrays that some modes need).
+BLEND_PIXELS = 1 << 20
+
+
+def background(bgcolor):
+    """The RGBA (uint8) of a matplotlib color."""
+    return np.round(np.array(matplotlib.colors.to_rgba(bgcolor)) * 255).astype(np.uint8)
+
+
+def blend(dst, src, mode="max"):
+    """Blend the RGBA (uint8) image `src` into `dst` (the same shape), in place (see
+    BLEND_MODES, above). Either one can be a view, e.g., of a `Canvas`'s pane."""
+    if mode not in BLEND_MODES:
+        raise ValueError("Unknown blend mode %r (not one of %s)." % (mode, BLEND_MODES))
+    if dst.shape != src.shape:
+        raise ValueError(
+            "Can't blend a %s image into a %s one." % (src.shape, dst.shape)
+        )
+
+    rows = max(BLEND_PIXELS // max(dst.shape[1], 1), 1)
+    for top in range(0, len(dst), rows):
+        d, s = dst[top : top + rows], src[top : top + rows]
+        if mode == "max":
+            np.maximum(d, s, out=d)
+        elif mode == "add":
+            # (Wrapped around where it went over 255, which is where it's now less
+            #  than what was added.)
+            np.add(d, s, out=d)
+            np.copyto(d, 255, where=d < s)
+        else:
+            # Premultiplied: src + dst * (1 - src alpha).
+            keep = 255 - s[..., 3:].astype(np.uint16)
+            d[:] = s + (d * keep + 127) // 255
+
+
+class Canvas:
+    """An RGBA image of `n_panes` square panes of `size` pixels (side by side, or
+    stacked if not `horizontal`), filled with `bgcolor`, that layers are added to
+    in place (see above).
+
+        canvas = Canvas(size, n_panes=3)
+        canvas.add(to_layer, pane=0)
+        canvas.add(from_layer, pane=2)
+        canvas.add(canvas.pane(0), pane=1)
+        canvas.add(canvas.pane(2), pane=1, mode="max")
+        save_layer(fn, canvas.image)
+    """
+
+    def __init__(self, size, n_panes=1, horizontal=True, bgcolor="black"):
+        self.size, self.n_panes, self.horizontal = size, n_panes, horizontal
+        self.bg = background(bgcolor)
+        shape = (size, size * n_panes) if horizontal else (size * n_panes, size)
+        self.image = np.empty(shape + (4,), dtype=np.uint8)
+        self.image[:] = self.bg
+        self._blank = [True] * n_panes
+        self._scratch = None
+
+    def pane(self, n=0):
+        """Pane `n`, as a view of the image."""
+        rows = cols = slice(None)
+        if self.horizontal:
+            cols = slice(n * self.size, (n + 1) * self.size)
+        else:
+            rows = slice(n * self.size, (n + 1) * self.size)
+        return self.image[rows, cols]
+
+    def add(self, layer, pane=0, mode="max"):
+        """Add `layer` (an RGBA image, or anything with a `draw(out)`, like a
+        `render_np.Layer`) to a pane, blended with what's there (see `blend`). The
+        first layer in a pane is just put there. Layers to draw are drawn straight
+        into the pane when they can be (as the first one, or 'over' the others),
+        and into a scratch pane (which is re-used) to blend them in, otherwise.
+        Returns the pane."""
+        if mode not in BLEND_MODES:
+            raise ValueError(
+                "Unknown blend mode %r (not one of %s)." % (mode, BLEND_MODES)
+            )
+        dst = self.pane(pane)
+        if isinstance(layer, np.ndarray):
+            if self._blank[pane]:
+                np.copyto(dst, layer)
+            else:
+                blend(dst, layer, mode)
+        elif self._blank[pane] or mode == "over":
+            layer.draw(dst)
+        else:
+            if self._scratch is None:
+                self._scratch = np.empty((self.size, self.size, 4), dtype=np.uint8)
+            self._scratch[:] = self.bg
+            layer.draw(self._scratch)
+            blend(dst, self._scratch, mode)
+        self._blank[pane] = False
+        return dst
@@ -1,2 +1,43 @@
-""" Runtime settings for Motorshed. """
+"""Runtime settings for Motorshed."""
 
+import os
+
+# Which routing backend to use to calculate transit times and routes:
+#   "osrm":  the OSRM Table and Route APIs (see `motorshed.osrm`)
+#   "local": the built-in routing engine (see `motorshed.local_routing`), which
+#            works offline on the graph itself and is much faster.
+ROUTING_BACKEND = "osrm"
+
+# The OSRM server to use. The public server is free but slow and rate-limited; for
+#  anything more than a few maps, run your own osrm-routed (see notes/OSRM.sh) and
+#  point this at it, e.g. MOTORSHED_OSRM_HOST=http://localhost:5000
+OSRM_PUBLIC_HOST = "http://router.project-osrm.org"
+OSRM_HOST = os.environ.get("MOTORSHED_OSRM_HOST", OSRM_PUBLIC_HOST)
+
+# Max number of simultaneous requests to the OSRM server. Please be gentle with
+#  the public server; a local one can take a lot more.
+OSRM_MAX_IN_FLIGHT = int(os.environ.get("MOTORSHED_OSRM_MAX_IN_FLIGHT", 8))
+
+# Limits for Table API requests. The table size is osrm-routed's --max-table-size
+#  (100 by default), which limits sources x destinations to its square (see
+#  `osrm.max_table_points`); URLs much longer than ~8k characters get rejected by
+#  many servers and proxies.
+OSRM_MAX_TABLE_SIZE = int(os.environ.get("MOTORSHED_OSRM_MAX_TABLE_SIZE", 100))
+OSRM_MAX_URL_LENGTH = 8000
+
+# Whether to keep only the columns that the motorshed calculation needs, in the
+#  smallest types that will do, in the node and edge dataframes (see
+#  `gen2.create_initial_dataframes`). Saves memory on big maps.
+LEAN_DATAFRAMES = os.environ.get("MOTORSHED_LEAN_DATAFRAMES", "") not in ("", "0")
+
+# Where to keep what we know about the routes to/from each origin (see
+#  `motorshed.routing_store`).
+ROUTING_STORE = os.environ.get(
+    "MOTORSHED_ROUTING_STORE",
+    os.path.join(os.path.dirname(__file__), "cache", "routing_store.sqlite"),
+)
+
+# A local OSM extract (.osm.pbf, or .osm XML) to make maps from, instead of
+#  downloading them from Overpass (see `motorshed.osm_extract`), e.g., the one
+#  that your local OSRM server uses.
+OSM_EXTRACT = os.environ.get("MOTORSHED_OSM_EXTRACT")
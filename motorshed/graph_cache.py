@@ -0,0 +1,498 @@
+"""A columnar, memory-mappable cache for the graphs from `overpass.get_map`.
+
+A pickled networkx graph has to be decompressed and unpickled into millions of
+little Python dicts before anything can use it. Here, every node and edge attribute
+is a typed column instead, saved as its own .npy file, so loading is just mapping
+the files into memory: nothing is read until it's used, and gen2 and the renderer
+can get the coordinates and topology (via `ColumnarGraph.to_gdfs`) without ever
+building the networkx graph. (`to_networkx` builds it, for the code that needs it.)
+
+A cached graph is a directory, `<name>.graph`, in the cache directory:
+
+    meta.json                  graph attributes, what's in each column, extras
+    nodes.node.npy             node IDs
+    nodes.<attribute>.npy      node attributes, in the same order
+    edges.u.npy, edges.v.npy, edges.key.npy
+    edges.<attribute>.npy      edge attributes, in the same order
+
+Columns are stored as:
+    int, float, bool   as is (with a '.missing.npy' mask, for ints and bools that
+                       some of the nodes/edges don't have; missing floats are NaN)
+    str                category codes (int32, -1 where missing), with the
+                       categories in meta.json
+    geometry           LineStrings, as all of their coordinates ('.coords.npy')
+                       and where each one starts ('.offsets.npy')
+    anything else      a pickled list (e.g., the lists of OSM IDs of simplified
+                       edges); these can't be memory-mapped
+"""
+
+import copy
+import json
+import os
+import pickle
+import shutil
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from motorshed import util
+
+FORMAT_VERSION = 1
+
+# Stand-in for the attributes that a node or edge doesn't have.
+_MISSING = object()
+
+
+def graph_path(name, cache_dir=None):
+    return os.path.join(cache_dir or util.cache_dir, f"{name}.graph")
+
+
+def save_graph(name, G, cache_dir=None, **extra):
+    """Save the networkx graph G to the cache, as `name`. Anything in `extra` that
+    JSON can handle (e.g., center_node, origin_point) is saved with it."""
+    nodes, node_data = zip(*G.nodes(data=True)) if len(G) else ((), ())
+    edges = list(G.edges(keys=True, data=True))
+    u, v, key = (np.array([e[n] for e in edges], dtype=np.int64) for n in range(3))
+    return save_columns(
+        name,
+        nodes,
+        _columns_of(node_data, reserved=("node",)),
+        u,
+        v,
+        key,
+        _columns_of([e[3] for e in edges], reserved=("u", "v", "key")),
+        graph=G.graph,
+        cache_dir=cache_dir,
+        **extra,
+    )
+
+
+def save_columns(
+    name,
+    node_ids,
+    node_columns,
+    u,
+    v,
+    key,
+    edge_columns,
+    graph=None,
+    cache_dir=None,
+    **extra,
+):
+    """Save a graph that's already in columns (e.g., from `osm_extract`) to the
+    cache, as `name`, without networkx. The columns are dicts of name -> values:
+    numpy arrays (saved as they are), pandas Categoricals, or lists (with None
+    where a node or edge doesn't have the attribute). `graph` is the graph
+    attributes (e.g., its 'crs'), and `extra` is as in `save_graph`."""
+    meta = dict(
+        version=FORMAT_VERSION,
+        graph=graph or {},
+        extra=extra,
+        n_nodes=len(node_ids),
+        n_edges=len(u),
+        nodes={},
+        edges={},
+    )
+    files = {
+        "nodes.node": np.asarray(node_ids, dtype=np.int64),
+        "edges.u": np.asarray(u, dtype=np.int64),
+        "edges.v": np.asarray(v, dtype=np.int64),
+        "edges.key": np.asarray(key, dtype=np.int64),
+    }
+    for table, columns in (("nodes", node_columns), ("edges", edge_columns)):
+        for column, values in columns.items():
+            kind, arrays, column_meta = _encode_column(values)
+            for suffix, arr in arrays.items():
+                files[f"{table}.{column}{suffix}"] = arr
+            if kind == "object":
+                files[f"{table}.{column}"] = [
+                    None if _is_missing(x) else x for x in values
+                ]
+            meta[table][column] = dict(kind=kind, **column_meta)
+
+    return _write_graph(graph_path(name, cache_dir), meta, files)
+
+
+def load_graph(name, cache_dir=None, mmap=True):
+    """The cached graph `name`, as a ColumnarGraph (its columns are memory-mapped
+    unless `mmap` is False). Raises FileNotFoundError if it isn't cached."""
+    return ColumnarGraph(graph_path(name, cache_dir), mmap=mmap)
+
+
+def cached_regions(cache_dir=None):
+    """The (name, bbox) of every cached graph that was saved with the bounding box
+    that it covers (as its 'bbox' extra: (west, south, east, north), in degrees)."""
+    cache_dir = cache_dir or util.cache_dir
+    regions = []
+    for fn in sorted(os.listdir(cache_dir)):
+        meta_fn = os.path.join(cache_dir, fn, "meta.json")
+        if fn.endswith(".graph") and os.path.exists(meta_fn):
+            with open(meta_fn) as f:
+                bbox = json.load(f)["extra"].get("bbox")
+            if bbox is not None:
+                regions.append((fn[: -len(".graph")], tuple(bbox)))
+    return regions
+
+
+def largest_component(node_ids, u, v, keep):
+    """Of the nodes `keep` (a mask of node_ids), the ones in the largest weakly
+    connected component of the edges (u, v) between them. (That's all that osmnx
+    keeps, too.)"""
+    order = np.argsort(node_ids)
+    ui = order[np.searchsorted(node_ids, u, sorter=order)]
+    vi = order[np.searchsorted(node_ids, v, sorter=order)]
+    inside = keep[ui] & keep[vi]
+    n = len(node_ids)
+    adjacency = coo_matrix((np.ones(inside.sum()), (ui[inside], vi[inside])), (n, n))
+    n_components, labels = connected_components(adjacency, connection="weak")
+    largest = np.bincount(labels[keep], minlength=n_components).argmax()
+    return keep & (labels == largest)
+
+
+def _write_graph(path, meta, files):
+    """Write a cached graph: meta.json, and `files` (arrays are saved as .npy,
+    lists are pickled)."""
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    for name, data in files.items():
+        if isinstance(data, list):
+            with open(os.path.join(tmp_path, name + ".pkl"), "wb") as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        else:
+            np.save(os.path.join(tmp_path, name + ".npy"), data)
+
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        # (e.g., a pyproj CRS is saved as its string.)
+        json.dump(meta, f, default=str)
+
+    # Swap in the new directory all at once, so that a half-written graph is never
+    #  mistaken for a cached one.
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _columns_of(data, reserved=()):
+    """The attributes in `data` (a dict for each node or edge), as lists, with
+    _MISSING where a node or edge doesn't have one."""
+    names = {}  # (a dict keeps them in order of first appearance)
+    for d in data:
+        names.update(dict.fromkeys(d))
+    return {
+        name: [d.get(name, _MISSING) for d in data]
+        for name in names
+        if name not in reserved
+    }
+
+
+def _is_missing(value):
+    return (
+        value is _MISSING
+        or value is None
+        or (isinstance(value, float) and np.isnan(value))
+    )
+
+
+def _encode_column(values):
+    """Pick how to store a column. Returns (kind, arrays, meta): the arrays to save,
+    by file name suffix, and what else needs to go in meta.json."""
+    if isinstance(values, pd.Categorical):
+        codes = values.codes.astype(np.int32)
+        return "category", {"": codes}, dict(categories=values.categories.tolist())
+    if isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+        kind = {"b": "bool", "i": "int", "u": "int", "f": "float"}[values.dtype.kind]
+        return kind, {"": values}, {}
+
+    missing = np.array([_is_missing(v) for v in values], dtype=bool)
+    present = [v for v, m in zip(values, missing) if not m]
+
+    def with_mask(data):
+        return {"": data, ".missing": missing} if missing.any() else {"": data}
+
+    if all(isinstance(v, (bool, np.bool_)) for v in present):
+        data = np.array([bool(v) if not m else False for v, m in zip(values, missing)])
+        return "bool", with_mask(data), {}
+
+    if all(
+        isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_))
+        for v in present
+    ):
+        data = np.array([0 if m else v for v, m in zip(values, missing)], np.int64)
+        return "int", with_mask(data), {}
+
+    if all(isinstance(v, (int, float, np.integer, np.floating)) for v in present):
+        data = np.array([np.nan if m else v for v, m in zip(values, missing)], float)
+        return "float", {"": data}, {}
+
+    if all(isinstance(v, str) for v in present):
+        categories, codes = np.unique(
+            np.array(present, dtype=object), return_inverse=True
+        )
+        data = np.full(len(values), -1, dtype=np.int32)
+        data[~missing] = codes
+        return "category", {"": data}, dict(categories=categories.tolist())
+
+    if all(getattr(v, "geom_type", None) == "LineString" for v in present):
+        coords = [
+            np.empty((0, 2)) if m else np.asarray(v.coords)[:, :2]
+            for v, m in zip(values, missing)
+        ]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in coords], out=offsets[1:])
+        arrays = {".coords": np.concatenate(coords or [np.empty((0, 2))])}
+        arrays[".offsets"] = offsets
+        return "geometry", arrays, {}
+
+    return "object", {}, {}
+
+
+class ColumnarGraph:
+    """A graph from the cache (see `load_graph`). The node IDs and edges (u, v, key)
+    are arrays, as are the columns of attributes (`node_column`, `edge_column`);
+    they're only read from disk as they're used."""
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap_mode = "r" if mmap else None
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(
+                "%s is cache format %s, not %s"
+                % (path, self.meta["version"], FORMAT_VERSION)
+            )
+        self.graph = self.meta["graph"]
+        self.extra = self.meta["extra"]
+        # The rows of the saved columns that this graph is, if it's a `subgraph`.
+        self._rows = None
+        self._edge_nodes = None
+
+        self.node_ids = self._load("nodes.node")
+        self.u = self._load("edges.u")
+        self.v = self._load("edges.v")
+        self.key = self._load("edges.key")
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        return len(self.u)
+
+    @property
+    def node_columns(self):
+        return list(self.meta["nodes"])
+
+    @property
+    def edge_columns(self):
+        return list(self.meta["edges"])
+
+    def _load(self, name):
+        arr = np.load(os.path.join(self.path, name + ".npy"), mmap_mode=self.mmap_mode)
+        # (A plain, read-only view of the mapping: a np.memmap would stay one
+        #  through everything that's done with it, e.g., in pandas.)
+        return np.asarray(arr)
+
+    def _load_pkl(self, name):
+        with open(os.path.join(self.path, name + ".pkl"), "rb") as f:
+            return pickle.load(f)
+
+    def node_index(self, node_ids):
+        """Positions of the (OSM) `node_ids` in self.node_ids."""
+        order = np.argsort(self.node_ids)
+        return order[np.searchsorted(self.node_ids, node_ids, sorter=order)]
+
+    def edge_node_index(self):
+        """Positions of the edges' u and v in self.node_ids (worked out once)."""
+        if self._edge_nodes is None:
+            self._edge_nodes = self.node_index(self.u), self.node_index(self.v)
+        return self._edge_nodes
+
+    def _edges_between(self, nodes):
+        ui, vi = self.edge_node_index()
+        return nodes[ui] & nodes[vi]
+
+    def subgraph(self, nodes):
+        """The subgraph of `nodes` (a boolean mask, in the order of self.node_ids),
+        with the edges between them, as a ColumnarGraph that reads just its own
+        rows of the columns (e.g., one tile of a big map), without saving it."""
+        nodes = np.asarray(nodes, dtype=bool)
+        edges = self._edges_between(nodes)
+        sub = copy.copy(self)
+        sub._rows = dict(nodes=np.flatnonzero(nodes), edges=np.flatnonzero(edges))
+        if self._rows is not None:
+            sub._rows = {t: self._rows[t][rows] for t, rows in sub._rows.items()}
+        sub.node_ids = self.node_ids[nodes]
+        sub.u, sub.v, sub.key = self.u[edges], self.v[edges], self.key[edges]
+        sub._edge_nodes = None
+        return sub
+
+    def save_subgraph(self, name, nodes, cache_dir=None, **extra):
+        """Cut the subgraph of `nodes` (a boolean mask, in the order of
+        self.node_ids), with the edges between them, out of this graph, column by
+        column, and save it to the cache as `name` (with `extra`, as in
+        `save_graph`). Returns it, loaded."""
+        if self._rows is not None:
+            raise ValueError("Only whole cached graphs can be cut up and saved.")
+        nodes = np.asarray(nodes, dtype=bool)
+        edges = self._edges_between(nodes)
+        meta = dict(
+            self.meta, extra=extra, n_nodes=int(nodes.sum()), n_edges=int(edges.sum())
+        )
+
+        files = {"nodes.node": self.node_ids[nodes]}
+        for field in ("u", "v", "key"):
+            files[f"edges.{field}"] = getattr(self, field)[edges]
+        for table, keep in (("nodes", nodes), ("edges", edges)):
+            for column, column_meta in self.meta[table].items():
+                base = f"{table}.{column}"
+                if column_meta["kind"] == "object":
+                    values = self._load_pkl(base)
+                    files[base] = [x for x, k in zip(values, keep.tolist()) if k]
+                elif column_meta["kind"] == "geometry":
+                    lengths = np.diff(self._load(base + ".offsets"))
+                    coords = self._load(base + ".coords")
+                    files[base + ".coords"] = coords[np.repeat(keep, lengths)]
+                    offsets = np.zeros(keep.sum() + 1, dtype=np.int64)
+                    np.cumsum(lengths[keep], out=offsets[1:])
+                    files[base + ".offsets"] = offsets
+                else:
+                    files[base] = self._load(base)[keep]
+                    if os.path.exists(os.path.join(self.path, base + ".missing.npy")):
+                        files[base + ".missing"] = self._load(base + ".missing")[keep]
+
+        path = _write_graph(graph_path(name, cache_dir), meta, files)
+        return ColumnarGraph(path, mmap=self.mmap_mode is not None)
+
+    def node_column(self, name):
+        return self._column("nodes", name)
+
+    def edge_column(self, name):
+        return self._column("edges", name)
+
+    def _column(self, table, name):
+        """The column as an array (or pandas Categorical, for strings), for a
+        dataframe: missing ints become NaN (so floats), missing bools NaN (so
+        objects), like `ox.graph_to_gdfs` would do."""
+        column_meta = self.meta[table][name]
+        kind = column_meta["kind"]
+        base = f"{table}.{name}"
+        rows = slice(None) if self._rows is None else self._rows[table]
+
+        if kind == "category":
+            return pd.Categorical.from_codes(
+                self._load(base)[rows], categories=column_meta["categories"]
+            )
+        if kind == "geometry":
+            return self._geometry(base)[rows]
+        if kind == "object":
+            # (The extra None keeps numpy from making lists of lists 2-D.)
+            return np.array(self._load_pkl(base) + [None], dtype=object)[:-1][rows]
+
+        data = self._load(base)[rows]
+        if os.path.exists(os.path.join(self.path, base + ".missing.npy")):
+            missing = self._load(base + ".missing")[rows]
+            data = data.astype(float if kind == "int" else object)
+            data[missing] = np.nan
+        return data
+
+    def _geometry(self, base):
+        import shapely
+
+        coords = self._load(base + ".coords")
+        offsets = self._load(base + ".offsets")
+        lengths = np.diff(offsets)
+        geometry = np.full(len(lengths), None, dtype=object)
+        ok = lengths >= 2
+        if ok.any():
+            keep = np.repeat(ok, lengths)
+            indices = np.repeat(np.arange(ok.sum()), lengths[ok])
+            geometry[ok] = shapely.linestrings(coords[keep], indices=indices)
+        return geometry
+
+    def _python_values(self, table, name):
+        """The column as a list of Python values, with _MISSING where the node or
+        edge doesn't have the attribute."""
+        column = self._column(table, name)
+        if isinstance(column, pd.Categorical):
+            values = np.asarray(column, dtype=object)
+        else:
+            values = column
+        return [_MISSING if _is_missing(v) else v for v in values.tolist()]
+
+    def to_gdfs(self, node_columns=None, edge_columns=None):
+        """Node and edge dataframes (Gn, Ge), like `ox.graph_to_gdfs(G,
+        node_geometry=False, ...)` gives, but straight from the columns (so without
+        copying them, as far as pandas allows). Gn is indexed by node ID; Ge has u,
+        v and key as columns. Ge is a GeoDataFrame if the edges have geometry.
+        `node_columns` and `edge_columns` are the attributes to include (default:
+        all of them); the others are never even read."""
+        node_columns = [
+            name
+            for name in self.node_columns
+            if node_columns is None or name in node_columns
+        ]
+        Gn = pd.DataFrame(
+            {name: self.node_column(name) for name in node_columns},
+            index=pd.Index(self.node_ids, name="osmid"),
+            copy=False,
+        )
+
+        columns = dict(u=self.u, v=self.v, key=self.key)
+        for name in self.edge_columns:
+            if edge_columns is None or name in edge_columns:
+                columns[name] = self.edge_column(name)
+        Ge = pd.DataFrame(columns, copy=False)
+
+        if "geometry" in Ge.columns:
+            import geopandas as gpd
+
+            Ge = gpd.GeoDataFrame(Ge, geometry="geometry", crs=self.graph.get("crs"))
+        return Gn, Ge
+
+    def to_networkx(self):
+        """The networkx MultiDiGraph, as it was saved (apart from details like
+        ints vs. floats in columns that are a mix of them)."""
+        G = nx.MultiDiGraph(**self.graph)
+
+        columns = {
+            name: self._python_values("nodes", name) for name in self.node_columns
+        }
+        G.add_nodes_from(
+            (
+                node,
+                {
+                    name: vals[i]
+                    for name, vals in columns.items()
+                    if vals[i] is not _MISSING
+                },
+            )
+            for i, node in enumerate(self.node_ids.tolist())
+        )
+
+        columns = {
+            name: self._python_values("edges", name) for name in self.edge_columns
+        }
+        G.add_edges_from(
+            (
+                u,
+                v,
+                key,
+                {
+                    name: vals[i]
+                    for name, vals in columns.items()
+                    if vals[i] is not _MISSING
+                },
+            )
+            for i, (u, v, key) in enumerate(
+                zip(self.u.tolist(), self.v.tolist(), self.key.tolist())
+            )
+        )
+        return G
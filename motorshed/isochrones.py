@@ -0,0 +1,204 @@
+"""Isochrones: the areas that can get to the center node (or be got to from it) within
+a given transit time, from the transit times of the nodes (Gn's 'transit_time', from
+the table API or the local engine; see `pipeline.get_transit_times`).
+
+The transit times are interpolated onto a raster grid over the map (an
+`IsochroneGrid`), and the isochrones are contoured from that (with contourpy, which
+is what matplotlib's `contour` uses). Finding which nodes each cell of the grid is
+interpolated from (with a KD-tree, or a Delaunay triangulation) is the slow part, so
+it's done once:
+
+- the contours at other intervals are just re-contoured from the same grid, and
+- other transit times for the same nodes (e.g., the other direction) are just a
+  weighted sum of them (see `IsochroneGrid.set_times`).
+
+Cells that are farther than max_distance_m from any node (e.g., in a lake, or out
+past the edge of the map) don't have a transit time, so isochrones don't spill over
+into them. The isochrones come out as polygons (see `IsochroneGrid.isochrones`), or
+as a layer of their outlines, to draw over a motorshed (see `IsochroneLayer`)."""
+
+import contourpy
+import matplotlib.cm
+import numpy as np
+import pandas as pd
+import scipy.spatial
+import shapely
+from contexttimer import Timer
+
+from motorshed import render_np
+
+METHODS = ("nearest", "linear")
+# How many cells the grid has across (along the longer side of the map).
+GRID_CELLS = 512
+# How far (in meters) from the nearest node a cell can be, to have a transit time.
+MAX_DISTANCE_M = 250.0
+
+
+class IsochroneGrid:
+    """Gn's transit times (in seconds), interpolated (by `method`: "nearest", or
+    "linear", over a Delaunay triangulation of the nodes) onto a grid `cells` wide
+    (along the longer side of the map), in map coordinates (see above).
+
+        grid = IsochroneGrid(Gn)
+        polygons = grid.isochrones([300, 600, 900])
+        canvas.add(grid.layer(Gn, [300, 600, 900]), mode="over")
+    """
+
+    def __init__(self, Gn, cells=GRID_CELLS, method="nearest", max_distance_m=None):
+        if method not in METHODS:
+            raise ValueError(
+                "Unknown interpolation method %r (not one of %s)." % (method, METHODS)
+            )
+        if max_distance_m is None:
+            max_distance_m = MAX_DISTANCE_M
+
+        with Timer(prefix="Isochrone grid (%s, %d cells)" % (method, cells)):
+            xy = Gn[["x", "y"]].to_numpy(float)
+            x_min, y_min = xy.min(axis=0)
+            x_max, y_max = xy.max(axis=0)
+            self.cell_m = max(x_max - x_min, y_max - y_min) / cells
+            # (The centers of the cells.)
+            n_x = int((x_max - x_min) / self.cell_m) + 1
+            n_y = int((y_max - y_min) / self.cell_m) + 1
+            self.x = x_min + np.arange(n_x) * self.cell_m
+            self.y = y_min + np.arange(n_y) * self.cell_m
+            cell_xy = np.stack(
+                [np.tile(self.x, len(self.y)), np.repeat(self.y, len(self.x))], axis=1
+            )
+
+            # Each cell's transit time is a weighted sum of its nodes' (see
+            #  `set_times`): its nearest node's...
+            distance, nearest = scipy.spatial.cKDTree(xy).query(cell_xy, workers=-1)
+            self.nodes, self.weights = nearest[:, None], np.ones((len(nearest), 1))
+            if method == "linear":
+                # ... or the corners' of the triangle of nodes that it's in (and
+                #  still the nearest node's, if it isn't in any).
+                triangulation = scipy.spatial.Delaunay(xy)
+                simplex = triangulation.find_simplex(cell_xy)
+                inside = simplex >= 0
+                transform = triangulation.transform[simplex[inside]]
+                barycentric = np.einsum(
+                    "nij,nj->ni", transform[:, :2], cell_xy[inside] - transform[:, 2]
+                )
+                self.nodes = np.repeat(self.nodes, 3, axis=1)
+                self.weights = np.zeros((len(nearest), 3))
+                self.weights[:, 0] = 1
+                self.nodes[inside] = triangulation.simplices[simplex[inside]]
+                self.weights[inside] = np.column_stack(
+                    [barycentric, 1 - barycentric.sum(axis=1)]
+                )
+            self.far = distance > max_distance_m
+
+        self.set_times(Gn.transit_time)
+
+    def set_times(self, transit_time):
+        """Re-interpolate the grid from other transit times (one for each node of
+        the Gn that it was made with, in the same order; NaN if there isn't one)."""
+        transit_time = np.asarray(transit_time, dtype=float)
+        times = (transit_time[self.nodes] * self.weights).sum(axis=1)
+        times[self.far] = np.nan
+        self.times = times.reshape(len(self.y), len(self.x))
+        self._contours = None
+
+    def contours(self):
+        """The contour generator of the grid (made once, for any levels)."""
+        if self._contours is None:
+            self._contours = contourpy.contour_generator(
+                self.x,
+                self.y,
+                self.times,
+                line_type="Separate",
+                fill_type="OuterOffset",
+            )
+        return self._contours
+
+    def lines(self, level):
+        """The outline of the isochrone for `level` (seconds), as a list of
+        polylines ((n, 2) arrays, in map coordinates)."""
+        return self.contours().lines(level)
+
+    def isochrones(self, levels):
+        """The isochrones for `levels` (seconds), as a dataframe with their
+        'transit_time' and 'geometry' (a shapely MultiPolygon, in map coordinates:
+        everywhere that's within that transit time)."""
+        lowest = np.nanmin(self.times) - 1
+        geometry = []
+        for level in levels:
+            polygons = []
+            if level > lowest:
+                points, offsets = self.contours().filled(lowest, level)
+                for ring_points, ring_offsets in zip(points, offsets):
+                    rings = np.split(ring_points, ring_offsets[1:-1])
+                    polygons.append(shapely.Polygon(rings[0], rings[1:]))
+            geometry.append(shapely.MultiPolygon(polygons))
+        return pd.DataFrame(dict(transit_time=list(levels), geometry=geometry))
+
+    def layer(
+        self,
+        Gn,
+        levels,
+        canvas_inches=8,
+        dpi=150,
+        cmap=matplotlib.cm.viridis,
+        line_width=1.0,
+    ):
+        """The isochrones' outlines at `levels`, as an `IsochroneLayer`."""
+        return IsochroneLayer(self, Gn, levels, canvas_inches, dpi, cmap, line_width)
+
+
+class IsochroneLayer:
+    """The outlines of the isochrones at `levels` (seconds), `line_width` points
+    wide, colored by the `cmap` (from the shortest transit time to the longest), on
+    a canvas laid out like `render_np.render_layer`'s (for the same Gn, size and
+    dpi), ready to be drawn over a motorshed, into all of the canvas or just a band
+    of rows of it (like a `render_np.Layer`: e.g., with `compositing.Canvas.add`,
+    or `render_np.render_poster`, with mode="over")."""
+
+    def __init__(
+        self,
+        grid,
+        Gn,
+        levels,
+        canvas_inches=8,
+        dpi=150,
+        cmap=matplotlib.cm.viridis,
+        line_width=1.0,
+    ):
+        self.size = int(round(canvas_inches * dpi))
+        to_pixels = render_np.canvas_transform(Gn, self.size, dpi)
+        self.box = to_pixels.box
+
+        # All of the outlines' points, and which line (and level) each one is on.
+        levels = np.asarray(levels, dtype=float)
+        lines = [grid.lines(level) for level in levels]
+        line_level = np.repeat(np.arange(len(levels)), [len(ls) for ls in lines])
+        lines = [line for ls in lines for line in ls]
+        points = np.concatenate(lines) if lines else np.empty((0, 2))
+        line = np.repeat(np.arange(len(lines)), [len(line) for line in lines])
+
+        # Segments between each point and the next, along the same line.
+        column, row = to_pixels(points[:, 0], points[:, 1])
+        points = np.stack([column, row], axis=1)
+        along = np.flatnonzero(line[1:] == line[:-1])
+        self.segments = np.hstack([points[along], points[along + 1]])
+        values = levels / levels.max() if len(levels) else levels
+        self.colors = cmap(values[line_level[line[along]]])[:, :3] * 255
+        self.radius = np.full(len(self.segments), line_width * dpi / 72 / 2)
+        y_min = np.minimum(self.segments[:, 1], self.segments[:, 3])
+        y_max = np.maximum(self.segments[:, 1], self.segments[:, 3])
+        self.rows = y_min - self.radius - 1, y_max + self.radius + 1
+
+    def draw(self, out, top=0):
+        """Draw the layer over `out` (in place), which is the rows of the canvas
+        from `top` on (all of it, by default)."""
+        left, box_top, right, box_bottom = self.box
+        in_band = np.flatnonzero(
+            (self.rows[1] >= top) & (self.rows[0] < top + len(out))
+        )
+        render_np.draw_segments(
+            out,
+            self.segments[in_band] - np.array([0, top, 0, top]),
+            self.radius[in_band],
+            self.colors[in_band],
+            clip=(left, box_top - top, right, box_bottom - top),
+        )
@@ -0,0 +1,245 @@
+"""A local routing engine that works directly on the (projected) osmnx graph from
+`overpass.get_map`, so we don't need to make any OSRM calls at all.
+
+The graph is converted to a compact sparse adjacency matrix (CSR) with an estimated
+travel time on each edge, and then a single Dijkstra run from the center node gives us
+both the transit time of every node and the exact next step of every route. This is a
+drop-in alternative to `osrm.get_transit_times` (for the transit times) and to the
+gen2 follow-up routing steps (for the 'w' of every edge, see
+`gen2.followup_local_routing`)."""
+
+import weakref
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from contexttimer import Timer
+from scipy.sparse.csgraph import dijkstra
+
+from motorshed import graph_cache
+
+# Speeds to assume when an edge has no (parseable) 'maxspeed' tag, by highway type.
+DEFAULT_SPEEDS_KPH = {
+    "motorway": 105,
+    "motorway_link": 60,
+    "trunk": 90,
+    "trunk_link": 50,
+    "primary": 65,
+    "primary_link": 45,
+    "secondary": 55,
+    "secondary_link": 40,
+    "tertiary": 45,
+    "tertiary_link": 35,
+    "unclassified": 40,
+    "residential": 40,  # ~25 mph, which is what gen2 has always assumed.
+    "living_street": 15,
+    "service": 20,
+}
+FALLBACK_SPEED_KPH = 40
+
+KPH_TO_MPS = 1000 / 3600
+MPH_TO_MPS = 1609 / 3600
+
+# Building the CSR matrix is most of the work (the search itself is fast), and it's
+#  the same for every center node, so we keep it for as long as the graph is around.
+_csr_cache = weakref.WeakKeyDictionary()
+# The transit times and the next steps come from the same search, so we keep the
+#  last search of each graph (per direction), for `gen2.followup_local_routing`
+#  to re-use after `get_transit_times`.
+_tree_cache = weakref.WeakKeyDictionary()
+
+
+def _first(value):
+    """osmnx sometimes gives a list of values for a tag (e.g., when ways were merged).
+    Just use the first one."""
+    if isinstance(value, (list, tuple)):
+        return value[0] if len(value) else np.nan
+    return value
+
+
+def estimate_speeds_mps(highway, maxspeed):
+    """Vectorized estimate of the speed (in meters/second) on each edge, from its
+    'highway' and 'maxspeed' tags. Handles "35 mph", "50" (OSM default is km/h),
+    "50 km/h", lists of tags, and missing values (which fall back to a default speed
+    by highway type). Each distinct (highway, maxspeed) pair is only worked out
+    once, so it's fast for categorical columns, too."""
+    highway = pd.Series(highway).map(_first).astype(str)
+    maxspeed = pd.Series(maxspeed, index=highway.index).map(_first).astype(str)
+    codes, pairs = pd.MultiIndex.from_arrays([highway, maxspeed]).factorize()
+    highway = pairs.get_level_values(0).to_series()
+    maxspeed = pairs.get_level_values(1).to_series()
+
+    # Pull out the number and the units (if any) in one go.
+    parsed = maxspeed.str.extract(
+        r"^\s*(?P<value>\d+(?:\.\d+)?)\s*(?P<units>mph|km/h|kmh|kph)?", expand=True
+    )
+    value = parsed["value"].astype(float)
+    is_mph = (parsed["units"] == "mph").to_numpy()
+    speeds = np.where(is_mph, value * MPH_TO_MPS, value * KPH_TO_MPS)
+
+    # Fill in anything we couldn't parse from the highway type.
+    defaults = (
+        highway.map(DEFAULT_SPEEDS_KPH).fillna(FALLBACK_SPEED_KPH).to_numpy()
+        * KPH_TO_MPS
+    )
+    speeds = np.where(np.isfinite(speeds) & (speeds > 0), speeds, defaults)
+    return speeds.astype(float)[codes]
+
+
+def graph_to_csr(G, towards_origin=True):
+    """Convert G (a networkx graph, or a `graph_cache.ColumnarGraph`) into a compact
+    sparse adjacency matrix (CSR) whose values are the estimated travel time (s) of
+    each edge. Parallel edges keep the fastest one.
+    If `towards_origin`, the matrix is transposed, so that a search *from* the
+    center node follows the edges backwards (i.e., it finds routes *to* the center).
+    Returns (node_ids, csr_matrix), where row/column i is node node_ids[i].
+    The result is cached (see above), so don't modify it."""
+
+    key = (towards_origin, G.number_of_nodes(), G.number_of_edges())
+    cached = _csr_cache.setdefault(G, {})
+    if key not in cached:
+        cached[key] = _graph_to_csr(G, towards_origin)
+    return cached[key]
+
+
+def _graph_to_csr(G, towards_origin):
+    if isinstance(G, graph_cache.ColumnarGraph):
+        # Straight from the columns (e.g., for a map too big for networkx).
+        node_ids, u, v = G.node_ids, G.u, G.v
+        length, highway, maxspeed = (
+            G.edge_column(name) if name in G.edge_columns else [default] * len(u)
+            for name, default in (
+                ("length", 0.0),
+                ("highway", None),
+                ("maxspeed", None),
+            )
+        )
+    else:
+        node_ids = np.fromiter(G.nodes, dtype=np.int64, count=len(G))
+        u, v, length, highway, maxspeed = zip(
+            *(
+                (
+                    u,
+                    v,
+                    data.get("length", 0.0),
+                    data.get("highway"),
+                    data.get("maxspeed"),
+                )
+                for u, v, data in G.edges(data=True)
+            )
+        )
+    node_index = pd.Index(node_ids)
+
+    iu = node_index.get_indexer(np.array(u, dtype=np.int64))
+    iv = node_index.get_indexer(np.array(v, dtype=np.int64))
+    travel_time = np.asarray(length, dtype=float) / estimate_speeds_mps(
+        highway, maxspeed
+    )
+    # Zero-weight edges would look like missing edges in the sparse matrix.
+    travel_time = np.maximum(travel_time, 1e-3)
+
+    if towards_origin:
+        iu, iv = iv, iu
+
+    # Keep only the fastest of any parallel edges (the sparse matrix constructor
+    #  would otherwise add them up).
+    order = np.lexsort((travel_time, iv, iu))
+    iu, iv, travel_time = iu[order], iv[order], travel_time[order]
+    first = np.ones(len(iu), dtype=bool)
+    first[1:] = (iu[1:] != iu[:-1]) | (iv[1:] != iv[:-1])
+
+    adjacency = scipy.sparse.csr_matrix(
+        (travel_time[first], (iu[first], iv[first])),
+        shape=(len(node_ids), len(node_ids)),
+    )
+    return node_ids, adjacency
+
+
+def shortest_path_tree(G, center_node, towards_origin=True):
+    """Run a single Dijkstra search from the center node.
+    Returns three arrays, aligned with each other:
+       node_ids:      the node IDs of G
+       transit_time:  travel time (s) to (or from) the center node; NaN if unreachable
+       next_node:     the next node on the route from each node towards the center node.
+                      -1 for the center node itself and 0 if unreachable (same
+                      conventions as the 'w' column in gen2.)
+    If not `towards_origin`, times are *from* the center node, and 'next_node' is
+    the previous node on the route from the center (which is the next step if the edges
+    are reversed, as in `gen2.create_initial_dataframes(..., towards_origin=False)`).
+    The last result for each graph and direction is cached, so don't modify it."""
+
+    key = (center_node, G.number_of_nodes(), G.number_of_edges())
+    cached = _tree_cache.setdefault(G, {})
+    if towards_origin in cached and cached[towards_origin][0] == key:
+        return cached[towards_origin][1]
+
+    with Timer(prefix="Local routing engine (dijkstra)"):
+        node_ids, adjacency = graph_to_csr(G, towards_origin=towards_origin)
+        i_center = int(np.flatnonzero(node_ids == center_node)[0])
+
+        transit_time, predecessors = dijkstra(
+            adjacency, directed=True, indices=i_center, return_predecessors=True
+        )
+
+        reachable = predecessors >= 0
+        next_node = np.zeros(len(node_ids), dtype=np.int64)
+        next_node[reachable] = node_ids[predecessors[reachable]]
+        next_node[i_center] = -1
+        transit_time[~np.isfinite(transit_time)] = np.nan
+
+    cached[towards_origin] = (key, (node_ids, transit_time, next_node))
+    return node_ids, transit_time, next_node
+
+
+def get_transit_times(G, origin_point, towards_origin=True, profile="driving"):
+    """Drop-in replacement for `osrm.get_transit_times` that uses the local routing
+    engine. Adds 'transit_time' to every node of G (in-place). `origin_point` can be a
+    node ID or a (lat, lon) pair, in which case the nearest node is used. Only the
+    'driving' profile is supported."""
+
+    if profile != "driving":
+        raise ValueError("The local routing engine only supports 'driving'.")
+
+    if type(origin_point) not in (int, np.int64):
+        origin_point = nearest_node(G, origin_point)
+
+    node_ids, transit_time, next_node = shortest_path_tree(
+        G, origin_point, towards_origin=towards_origin
+    )
+
+    for node, t in zip(node_ids, transit_time):
+        G.nodes[node]["transit_time"] = t
+
+
+def get_transit_times_bidirectional(G, origin_point, profile="driving"):
+    """Drop-in replacement for `osrm.get_transit_times_bidirectional`: sets
+    'transit_time' (to the origin) on every node of G, and returns the arrays of
+    transit times to and from the origin, in the same order as G.nodes."""
+
+    if profile != "driving":
+        raise ValueError("The local routing engine only supports 'driving'.")
+
+    if type(origin_point) not in (int, np.int64):
+        origin_point = nearest_node(G, origin_point)
+
+    node_ids, times_to, next_node = shortest_path_tree(G, origin_point, True)
+    node_ids, times_from, next_node = shortest_path_tree(G, origin_point, False)
+
+    for node, t in zip(node_ids, times_to):
+        G.nodes[node]["transit_time"] = t
+
+    return times_to, times_from
+
+
+def nearest_node(G, lat_lon):
+    """Node of G that is nearest to a (lat, lon) point."""
+    node_ids, lat, lon = zip(*((n, d["lat"], d["lon"]) for n, d in G.nodes(data=True)))
+    return nearest_of(node_ids, lat, lon, lat_lon)
+
+
+def nearest_of(node_ids, lat, lon, lat_lon):
+    """Of the nodes `node_ids` at (`lat`, `lon`), the nearest to a (lat, lon) point."""
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    dy = lat - lat_lon[0]
+    dx = (lon - lat_lon[1]) * np.cos(np.radians(lat_lon[0]))
+    return node_ids[int(np.argmin(dx**2 + dy**2))]
@@ -0,0 +1,212 @@
+"""Level of detail, for rendering: turn the (styled) edges of a motorshed into as
+few line segments as will look the same at the resolution they're drawn at.
+
+- Chains of edges through nodes that only have two neighbors (e.g., the nodes
+  along a curve, with `simplify=False` in `get_map`), with the same traffic (so
+  drawn the same way), are merged into one polyline.
+- Each polyline follows the real curve of its edges (their 'geometry', where they
+  have one, rather than just u -> v), simplified to within a fraction of a pixel
+  (TOLERANCE_PX, with shapely's Douglas-Peucker).
+- Polylines that are too faint to see (their color is within MIN_CONTRAST of the
+  background's) or too small (shorter and narrower than MIN_SIZE_PX, altogether)
+  are dropped. (That's the only part that depends on how they're styled, so it's
+  done last; see `polylines` and `visible`.)
+
+What's left is a list of line segments, each with the edge that it's styled like,
+for `render_np` (or a matplotlib LineCollection, in `render_mpl`)."""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+# How far (in pixels) simplified lines can stray from the real ones.
+TOLERANCE_PX = 0.5
+# How different (0-255, in any of R, G or B) from the background an edge's color
+#  has to be, to be drawn.
+MIN_CONTRAST = 2
+# How big (length + width, in pixels) a polyline has to be, to be drawn.
+MIN_SIZE_PX = 1.0
+
+
+def pixel_size_m(Gn, canvas_inches=8, dpi=150):
+    """About how big a pixel is (in map units, i.e., meters), when the map is drawn
+    on a square canvas (like `render_mpl.render_layer` does). (A bit smaller than
+    it really is, as the map doesn't go all the way to the sides.)"""
+    extent = max(Gn.x.max() - Gn.x.min(), Gn.y.max() - Gn.y.min())
+    return extent / (canvas_inches * dpi)
+
+
+def level_of_detail(
+    Gn,
+    gdf,
+    radius,
+    colors,
+    bg,
+    pixel_m,
+    tolerance_px=TOLERANCE_PX,
+    min_contrast=MIN_CONTRAST,
+    min_size_px=MIN_SIZE_PX,
+):
+    """The segments to draw the edges in `gdf` (from `render_mpl.style_edges`, in the
+    order they're drawn in; with geometry, if they have it) with, at `pixel_m` (the
+    size of a pixel, in map units). `radius` (half of the width, in pixels) and
+    `colors` (RGB, 0-255) are each edge's style, and `bg` the background's color.
+    Returns (segments, edge): (x1, y1, x2, y2) in map coordinates, and which row of
+    gdf (by position) each one is styled like, in the order to draw them in."""
+    segments, edge, length = polylines(Gn, gdf, pixel_m, tolerance_px)
+    keep = visible(
+        np.asarray(radius, dtype=float)[edge],
+        np.asarray(colors, dtype=float)[edge],
+        bg,
+        length / pixel_m,
+        min_contrast,
+        min_size_px,
+    )
+    return segments[keep], edge[keep]
+
+
+def polylines(Gn, gdf, pixel_m, tolerance_px=TOLERANCE_PX):
+    """The merged and simplified polylines of `level_of_detail` (see above), before
+    anything is culled (which is the only part that depends on how they're styled).
+    Returns (segments, edge, length): like `level_of_detail`'s, and the length of
+    the whole polyline that each segment is part of (in map units)."""
+    coords, offsets = edge_coords(Gn, gdf)
+    node_i = Gn.index.get_indexer
+    order, starts = edge_chains(
+        node_i(gdf.u), node_i(gdf.v), gdf.through_traffic.to_numpy(), len(Gn)
+    )
+    if not len(order):
+        return np.empty((0, 4)), np.empty(0, dtype=np.int64), np.empty(0)
+
+    # The points along each chain, in order, without the repeated ones where one
+    #  edge meets the next.
+    n_points = np.diff(offsets)[order]
+    joined = np.ones(len(order), dtype=bool)
+    joined[starts] = False
+    take = n_points - joined
+    first = offsets[order] + joined
+    total = np.cumsum(take)
+    points = coords[np.repeat(first - (total - take), take) + np.arange(total[-1])]
+    chain = np.repeat(np.cumsum(~joined) - 1, take)
+    lines = shapely.linestrings(points, indices=chain)
+
+    lines = shapely.simplify(lines, tolerance_px * pixel_m, preserve_topology=False)
+    points, chain = shapely.get_coordinates(lines, return_index=True)
+
+    # Segments between each point and the next, along the same chain. (Each chain
+    #  is styled like its first edge; they all have the same traffic.)
+    along = np.flatnonzero(chain[1:] == chain[:-1])
+    chain = chain[along]
+    segments = np.hstack([points[along], points[along + 1]])
+    return segments, order[starts][chain], shapely.length(lines)[chain]
+
+
+def visible(
+    radius, colors, bg, length_px, min_contrast=MIN_CONTRAST, min_size_px=MIN_SIZE_PX
+):
+    """Which segments (a boolean mask) can be seen: the ones with `colors` (RGB,
+    0-255) at least `min_contrast` from `bg`'s, on polylines that are at least
+    `min_size_px` long, counting their width (`radius`, in pixels, on each end)."""
+    contrast = np.abs(colors - np.asarray(bg, dtype=float)[:3]).max(axis=1)
+    return (contrast >= min_contrast) & (length_px + 2 * radius >= min_size_px)
+
+
+def edge_coords(Gn, gdf):
+    """All of the points along each edge in `gdf`, from u to v: its geometry's, if
+    it has one, or else just u's and v's. Returns (coords, offsets): edge n's points
+    are coords[offsets[n]:offsets[n + 1]]."""
+    node_i = Gn.index.get_indexer
+    xy = Gn[["x", "y"]].to_numpy(float)
+    xy_u, xy_v = xy[node_i(gdf.u)], xy[node_i(gdf.v)]
+
+    curved = np.zeros(len(gdf), dtype=bool)
+    n_points = np.full(len(gdf), 2)
+    if "geometry" in gdf.columns:
+        geometry = gdf["geometry"].to_numpy(object)
+        curved = pd.notna(geometry)
+        curve_coords, curve = shapely.get_coordinates(
+            geometry[curved], return_index=True
+        )
+        n_points[curved] = np.bincount(curve, minlength=curved.sum())
+    offsets = np.zeros(len(gdf) + 1, dtype=np.int64)
+    np.cumsum(n_points, out=offsets[1:])
+
+    coords = np.empty((offsets[-1], 2))
+    straight = offsets[:-1][~curved]
+    coords[straight] = xy_u[~curved]
+    coords[straight + 1] = xy_v[~curved]
+    if curved.any():
+        # (The geometry of a reversed edge (see `gen2.reverse_edges`) still goes
+        #  from v to u, so it's flipped around.)
+        start, count = offsets[:-1][curved], n_points[curved]
+        first = curve_coords[np.cumsum(count) - count]
+        flip = np.hypot(*(first - xy_v[curved]).T) < np.hypot(*(first - xy_u[curved]).T)
+        i = np.arange(len(curve)) - np.repeat(np.cumsum(count) - count, count)
+        i = np.where(flip[curve], count[curve] - 1 - i, i)
+        coords[start[curve] + i] = curve_coords
+    return coords, offsets
+
+
+def edge_chains(ui, vi, traffic, n_nodes):
+    """Chains of edges (ui -> vi, as node numbers, below `n_nodes`) that can be
+    drawn as one polyline: each edge is followed by the one that goes on from its
+    vi, if vi only has two neighbors, and the next one has the same `traffic` (and
+    doesn't go straight back to ui). Returns (order, starts): the edges
+    (positions), chain by chain, and where each chain starts in `order`. Chains are
+    in the order of their first edges."""
+    ui, vi = np.asarray(ui, dtype=np.int64), np.asarray(vi, dtype=np.int64)
+    n_edges = len(ui)
+
+    # Nodes with two neighbors (whichever way the edges go), and at most one edge
+    #  each way to each of them.
+    pairs = np.sort(np.minimum(ui, vi) * n_nodes + np.maximum(ui, vi))
+    pairs = pairs[np.append(True, pairs[1:] != pairs[:-1])]
+    n_neighbors = np.bincount(
+        np.concatenate(np.divmod(pairs, n_nodes)), minlength=n_nodes
+    )
+    n_out = np.bincount(ui, minlength=n_nodes)
+    n_in = np.bincount(vi, minlength=n_nodes)
+    through = (n_neighbors == 2) & (n_out <= 2) & (n_in <= 2)
+
+    # The (up to) two edges out of each node.
+    by_u = np.argsort(ui, kind="stable")
+    start = np.searchsorted(ui[by_u], np.arange(n_nodes))
+    out = np.full((n_nodes, 2), -1)
+    for k in range(2):
+        has = n_out > k
+        out[np.flatnonzero(has), k] = by_u[start[has] + k]
+
+    # Each edge's next edge, if any: the one out of its v that isn't back to u.
+    first_out, second_out = out[vi, 0], out[vi, 1]
+    nxt = np.where((first_out >= 0) & (vi[first_out] != ui), first_out, second_out)
+    ok = through[vi] & (nxt >= 0)
+    ok[ok] &= (vi[nxt[ok]] != ui[ok]) & (traffic[nxt[ok]] == traffic[ok])
+    nxt[~ok] = -1
+    # (At most one edge can lead into each one.)
+    n_prev = np.bincount(nxt[nxt >= 0], minlength=n_edges)
+    nxt[(nxt >= 0) & (n_prev[np.maximum(nxt, 0)] > 1)] = -1
+    has_prev = np.zeros(n_edges, dtype=bool)
+    has_prev[nxt[nxt >= 0]] = True
+
+    # Follow them from the ones that don't have a previous edge; whatever's left
+    #  over is in loops, which start anywhere.
+    nxt = nxt.tolist()
+    seen = bytearray(n_edges)
+    chains = []
+    for heads in (np.flatnonzero(~has_prev), range(n_edges)):
+        for e in heads:
+            if seen[e]:
+                continue
+            chain = []
+            while e >= 0 and not seen[e]:
+                seen[e] = 1
+                chain.append(e)
+                e = nxt[e]
+            chains.append(chain)
+    chains.sort(key=lambda chain: chain[0])
+
+    order = np.fromiter(
+        (e for chain in chains for e in chain), dtype=np.int64, count=n_edges
+    )
+    starts = np.cumsum([0] + [len(chain) for chain in chains[:-1]])
+    return order, starts
@@ -0,0 +1,318 @@
+"""Make maps from a local OSM extract (.osm.pbf, or .osm XML, optionally .bz2 or .gz
+compressed), e.g. the one that a local OSRM server uses (see notes/OSRM.sh),
+instead of downloading them from Overpass.
+
+The extract is streamed, once: only the nodes inside the map's bounding box, and
+the drivable ways, are kept (so memory depends on the size of the map, not of the
+extract), and they go straight into arrays, and from there into the graph cache
+(see `graph_cache.save_columns`), without building a networkx graph. Like osmnx's
+maps (with simplify=False): every node of a way is a node of the graph, every
+segment of a way is an edge (both ways, unless it's one-way), and only the largest
+connected part of the map is kept.
+
+Reading .pbf files needs pyosmium (`pip install osmium`); XML doesn't need anything.
+Nodes must come before ways in the file, as they do in extracts (otherwise, sort it
+with `osmium sort`)."""
+
+import bz2
+import gzip
+import xml.etree.ElementTree as ET
+from array import array
+
+import numpy as np
+import pandas as pd
+import pyproj
+
+from motorshed import graph_cache, local_routing, overpass
+
+# Like osmnx's "drive" network type: ways with these highway tags aren't drivable...
+EXCLUDED_HIGHWAYS = {
+    "abandoned",
+    "bridleway",
+    "bus_guideway",
+    "construction",
+    "corridor",
+    "cycleway",
+    "elevator",
+    "escalator",
+    "footway",
+    "no",
+    "path",
+    "pedestrian",
+    "planned",
+    "platform",
+    "proposed",
+    "raceway",
+    "razed",
+    "service",
+    "steps",
+    "track",
+}
+# ... and nor are these services, or ways that cars aren't allowed on.
+EXCLUDED_SERVICES = {
+    "alley",
+    "driveway",
+    "emergency_access",
+    "parking",
+    "parking_aisle",
+    "private",
+}
+
+# The way tags that become edge attributes (as strings), as in osmnx.
+EDGE_TAGS = ("highway", "name", "maxspeed", "lanes", "ref", "bridge")
+
+
+def is_drivable(tags):
+    """Whether a way with `tags` (a dict) is part of the drivable road network."""
+    highway = tags.get("highway")
+    return (
+        highway is not None
+        and highway not in EXCLUDED_HIGHWAYS
+        and tags.get("area") != "yes"
+        and tags.get("access") != "private"
+        and tags.get("motor_vehicle") != "no"
+        and tags.get("motorcar") != "no"
+        and tags.get("service") not in EXCLUDED_SERVICES
+    )
+
+
+def oneway_direction(tags):
+    """1 if traffic on a way with `tags` only goes in the direction of its nodes, -1
+    if it only goes the other way, and 0 if it goes both ways."""
+    oneway = tags.get("oneway")
+    if oneway in ("-1", "reverse"):
+        return -1
+    if oneway in ("yes", "true", "1") or tags.get("junction") == "roundabout":
+        return 1
+    return 0
+
+
+def utm_crs(lat, lon):
+    """The UTM zone's CRS at (lat, lon), like osmnx projects to."""
+    zone = int((lon + 180) // 6) + 1
+    return "epsg:%d" % ((32600 if lat >= 0 else 32700) + zone)
+
+
+class _Collector:
+    """Keeps what's needed of the nodes and ways as they stream by."""
+
+    def __init__(self, bbox):
+        self.bbox = bbox
+        self.node_ids = array("q")
+        self.lat = array("d")
+        self.lon = array("d")
+        self.node_highway = {}  # (Few nodes have one, e.g., traffic signals.)
+        self.sorted_ids = None
+
+        # Edges (u, v), each with the number of its way, and which way it goes.
+        self.u = array("q")
+        self.v = array("q")
+        self.way_n = array("q")
+        self.reversed = array("b")
+        self.ways = []  # (OSM ID, tags) of each way that has edges
+
+    def node(self, node_id, lat, lon, highway=None):
+        west, south, east, north = self.bbox
+        if south <= lat <= north and west <= lon <= east:
+            self.node_ids.append(node_id)
+            self.lat.append(lat)
+            self.lon.append(lon)
+            if highway is not None:
+                self.node_highway[node_id] = highway
+
+    def way(self, way_id, refs, tags):
+        if not is_drivable(tags):
+            return
+        if self.sorted_ids is None:
+            # The nodes are done; get ready to look them up.
+            self.sorted_ids = np.sort(np.frombuffer(self.node_ids, dtype=np.int64))
+
+        refs = np.asarray(refs, dtype=np.int64)
+        if not len(self.sorted_ids) or len(refs) < 2:
+            return
+        pos = np.minimum(
+            np.searchsorted(self.sorted_ids, refs), len(self.sorted_ids) - 1
+        )
+        inside = self.sorted_ids[pos] == refs
+        # The segments of the way with both nodes inside the box.
+        segments = np.flatnonzero(inside[:-1] & inside[1:])
+        if not len(segments):
+            return
+
+        u, v = refs[segments], refs[segments + 1]
+        direction = oneway_direction(tags)
+        way_n = len(self.ways)
+        self.ways.append((way_id, tags))
+        if direction >= 0:
+            self._add_edges(u, v, way_n, False)
+        if direction <= 0:
+            self._add_edges(v[::-1], u[::-1], way_n, True)
+
+    def _add_edges(self, u, v, way_n, is_reversed):
+        self.u.extend(u.tolist())
+        self.v.extend(v.tolist())
+        self.way_n.extend([way_n] * len(u))
+        self.reversed.extend([is_reversed] * len(u))
+
+
+def _read_xml(fn, collector):
+    opener = (
+        bz2.open if fn.endswith(".bz2") else gzip.open if fn.endswith(".gz") else open
+    )
+    with opener(fn, "rb") as f:
+        context = ET.iterparse(f, events=("start", "end"))
+        event, root = next(context)
+        for event, elem in context:
+            if event != "end":
+                continue
+            if elem.tag == "node":
+                highway = None
+                for tag in elem.iter("tag"):
+                    if tag.get("k") == "highway":
+                        highway = tag.get("v")
+                collector.node(
+                    int(elem.get("id")),
+                    float(elem.get("lat")),
+                    float(elem.get("lon")),
+                    highway,
+                )
+            elif elem.tag == "way":
+                tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+                refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                collector.way(int(elem.get("id")), refs, tags)
+            elif elem.tag == "relation":
+                # (There's nothing for us after the ways.)
+                break
+            else:
+                continue
+            # Forget what's been read, so that memory doesn't grow with the file.
+            root.clear()
+
+
+def _read_pbf(fn, collector):
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError("Reading .pbf files needs pyosmium (pip install osmium)")
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, n):
+            collector.node(n.id, n.location.lat, n.location.lon, n.tags.get("highway"))
+
+        def way(self, w):
+            if "highway" in w.tags:
+                tags = {tag.k: tag.v for tag in w.tags}
+                collector.way(w.id, [nd.ref for nd in w.nodes], tags)
+
+    Handler().apply_file(fn)
+
+
+def load_extract(fn, bbox=None, center=None, distance=1000, name=None, cache_dir=None):
+    """Make the map of the roads in a bounding box from the OSM extract `fn`: either
+    `bbox` (west, south, east, north), or the box that reaches `distance` meters
+    around `center` (lat, lon), like `overpass.get_map`. It's saved to the graph
+    cache as `name` (by default, named after the file and box), and returned as a
+    ColumnarGraph; with a `center`, its nearest node is the 'center_node' extra."""
+    if bbox is None:
+        bbox = overpass.bbox_around(center, distance)
+    bbox = tuple(float(b) for b in bbox)
+    name = name or "%s.%.5f,%.5f,%.5f,%.5f" % ((fn.split("/")[-1],) + bbox)
+
+    collector = _Collector(bbox)
+    if fn.endswith(".pbf"):
+        _read_pbf(fn, collector)
+    else:
+        _read_xml(fn, collector)
+
+    node_ids = np.frombuffer(collector.node_ids, dtype=np.int64)
+    lat = np.frombuffer(collector.lat, dtype=float)
+    lon = np.frombuffer(collector.lon, dtype=float)
+    u = np.frombuffer(collector.u, dtype=np.int64)
+    v = np.frombuffer(collector.v, dtype=np.int64)
+    way_n = np.frombuffer(collector.way_n, dtype=np.int64)
+    if not len(u):
+        raise ValueError("There are no drivable roads in %s in %s" % (bbox, fn))
+
+    # Only the largest connected part of the roads (which leaves out the nodes that
+    #  aren't on any of them, too).
+    keep = graph_cache.largest_component(
+        node_ids, u, v, np.isin(node_ids, np.concatenate([u, v]))
+    )
+    kept_ids = node_ids[keep]
+    edges = np.isin(u, kept_ids) & np.isin(v, kept_ids)
+    node_ids, lat, lon = kept_ids, lat[keep], lon[keep]
+    u, v, way_n = u[edges], v[edges], way_n[edges]
+
+    # Project all of the nodes at once.
+    crs = utm_crs(np.mean(lat), np.mean(lon))
+    transformer = pyproj.Transformer.from_crs("epsg:4326", crs, always_xy=True)
+    x, y = transformer.transform(lon, lat)
+
+    # Parallel edges (the same (u, v), from different ways) get keys 0, 1, ...
+    order = np.lexsort((v, u))
+    new_pair = np.r_[
+        True, (u[order][1:] != u[order][:-1]) | (v[order][1:] != v[order][:-1])
+    ]
+    group_start = np.maximum.accumulate(np.where(new_pair, np.arange(len(u)), 0))
+    key = np.empty(len(u), dtype=np.int64)
+    key[order] = np.arange(len(u)) - group_start
+
+    node_index = pd.Index(node_ids)
+    ui, vi = node_index.get_indexer(u), node_index.get_indexer(v)
+    length = _haversine_m(lat[ui], lon[ui], lat[vi], lon[vi])
+
+    ways_id = np.array([way_id for way_id, tags in collector.ways], dtype=np.int64)
+    edge_columns = dict(osmid=ways_id[way_n])
+    for tag in EDGE_TAGS:
+        values = pd.Categorical([tags.get(tag) for way_id, tags in collector.ways])
+        edge_columns[tag] = pd.Categorical.from_codes(
+            values.codes[way_n], categories=values.categories
+        )
+    oneway = np.array([oneway_direction(tags) != 0 for _, tags in collector.ways])
+    edge_columns["oneway"] = oneway[way_n]
+    edge_columns["reversed"] = np.frombuffer(collector.reversed, dtype=np.int8)[
+        edges
+    ].astype(bool)
+    edge_columns["length"] = length
+    edge_columns["through_traffic"] = np.ones(len(u), dtype=np.int64)
+
+    node_columns = dict(
+        osmid=node_ids,
+        x=x,
+        y=y,
+        lon=lon,
+        lat=lat,
+        highway=pd.Categorical(
+            [collector.node_highway.get(n) for n in node_ids.tolist()]
+        ),
+        calculated=np.zeros(len(node_ids), dtype=bool),
+    )
+
+    extra = dict(bbox=bbox, source=fn)
+    if center is not None:
+        center_node = local_routing.nearest_of(node_ids, lat, lon, center)
+        extra.update(center_node=int(center_node), origin_point=tuple(center))
+
+    graph_cache.save_columns(
+        name,
+        node_ids,
+        node_columns,
+        u,
+        v,
+        key,
+        edge_columns,
+        graph=dict(crs=crs),
+        cache_dir=cache_dir,
+        **extra,
+    )
+    print("Read %d nodes and %d edges from %s." % (len(node_ids), len(u), fn))
+    return graph_cache.load_graph(name, cache_dir)
+
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * overpass.EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
@@ -1,10 +1,17 @@
+import concurrent.futures
 import os
+import random
+import threading
+import time
+import urllib.parse
 
 import numpy as np
 import requests
+import requests.adapters
 import requests_cache
 from contexttimer import Timer
 
+from motorshed import config
 from motorshed.util import cache_dir
 
 # Cache HTTP requests (other than map requests, which I think are too complicated
@@ -16,6 +23,338 @@ requests_cache.install_cache(
 )
 
 
+class OSRMError(Exception):
+    """An OSRM request that failed for good (i.e., even after retrying). `code` is
+    OSRM's error code (e.g. "TooBig"), if it gave us one."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class OSRMStats:
+    """Counters for one client (or one run, see `reset`), to help tune OSRM servers.
+    Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0  # HTTP requests sent (including retries)
+            self.cache_hits = 0  # ... that were answered from the local cache
+            self.retries = 0  # requests that were repeated after a failure
+            self.throttles = 0  # 429 (Too Many Requests) / 503 responses
+            self.errors = 0  # other failures: 5xx, bad bodies, connection errors
+            self.failures = 0  # requests that we gave up on (OSRMError)
+            self.total_latency = 0.0  # s, for requests that reached the server
+            self.n_latencies = 0  # ... and how many of those there were
+
+    def record(self, latency=None, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+            if latency is not None:
+                self.total_latency += latency
+                self.n_latencies += 1
+
+    @property
+    def mean_latency(self):
+        # (Only the requests that got an answer from the server: connection errors
+        #  and timeouts have no latency, and cache hits don't count.)
+        n = self.n_latencies
+        return self.total_latency / n if n else np.nan
+
+    def as_dict(self):
+        return dict(
+            requests=self.requests,
+            cache_hits=self.cache_hits,
+            retries=self.retries,
+            throttles=self.throttles,
+            errors=self.errors,
+            failures=self.failures,
+            mean_latency=self.mean_latency,
+        )
+
+    def __repr__(self):
+        return (
+            "OSRM: %(requests)d requests (%(cache_hits)d cached), %(retries)d retries, "
+            "%(throttles)d throttled, %(errors)d errors, %(failures)d failures, "
+            "mean latency %(mean_latency).3fs" % self.as_dict()
+        )
+
+
+class RateController:
+    """Adaptive limit on the number of requests in flight (AIMD, as in TCP).
+
+    Every success raises the limit a little (by about 1 per 'round' of requests), up
+    to `max_in_flight`, as long as latency stays close to the best we've seen; every
+    throttle/error (or latency that has blown up) halves it, at most once per round,
+    down to `min_in_flight`. That way we settle near the largest concurrency that the
+    server can sustain.
+    """
+
+    # Back off if latency gets this many times worse than the best we've seen.
+    LATENCY_TOLERANCE = 4.0
+
+    def __init__(self, max_in_flight, min_in_flight=1, initial=None):
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min(min_in_flight, max_in_flight)
+        self.limit = float(initial or max_in_flight)
+        self.in_flight = 0
+        self.best_latency = np.inf
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency):
+        with self._condition:
+            self.best_latency = min(self.best_latency, latency)
+            if latency > self.LATENCY_TOLERANCE * self.best_latency + 0.05:
+                self._decrease()
+            else:
+                self.limit = min(self.max_in_flight, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_failure(self):
+        with self._condition:
+            self._decrease()
+
+    def _decrease(self):
+        # Only once per 'round' (about one latency), so that a burst of failures
+        #  from the same round of requests doesn't collapse the limit.
+        now = time.monotonic()
+        if now - self._last_decrease > min(self.best_latency, 1.0):
+            self.limit = max(self.min_in_flight, self.limit / 2)
+            self._last_decrease = now
+
+
+class OSRMClient:
+    """A thread-safe client for the OSRM HTTP API (Table and Route services).
+
+    All requests go through one `requests.Session`, so connections are kept alive and
+    re-used instead of opening a new one per request. At most `max_in_flight` requests
+    are sent at the same time (which is also the size of the connection pool and of the
+    client's thread pool, see `map`). Within that, a `RateController` adapts the
+    concurrency to what the server can sustain.
+
+    Failed requests (429/5xx responses, connection errors, or bodies that aren't
+    JSON) are retried up to `max_retries` times, with exponential backoff and
+    jitter (or as told by a Retry-After header). All the calls we make are
+    idempotent GETs, so that's safe. The counters in `stats` (an OSRMStats)
+    show how it's going.
+
+    `host` defaults to `config.OSRM_HOST`; point it at your own osrm-routed instance
+    (see notes/OSRM.sh) to go much faster than the public server allows. Responses are
+    cached on disk (see above) only for the public server, unless `use_cache` says
+    otherwise.
+    """
+
+    # Response codes that are worth retrying.
+    THROTTLE_CODES = (429, 503)
+    RETRY_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        host=None,
+        max_in_flight=None,
+        timeout=30,
+        use_cache=None,
+        max_retries=5,
+        backoff_s=0.5,
+        max_backoff_s=30.0,
+    ):
+        self.host = (host or config.OSRM_HOST).rstrip("/")
+        self.max_in_flight = max_in_flight or config.OSRM_MAX_IN_FLIGHT
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+
+        self.session = requests.Session()
+        if use_cache is None:
+            use_cache = self.host == config.OSRM_PUBLIC_HOST
+        if not use_cache and hasattr(self.session, "settings"):
+            # requests_cache has patched requests.Session; turn the cache off.
+            self.session.settings.disabled = True
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.max_in_flight, pool_block=True
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.rate = RateController(self.max_in_flight)
+        self.stats = OSRMStats()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def __repr__(self):
+        return "OSRMClient(%r, max_in_flight=%d)" % (self.host, self.max_in_flight)
+
+    def get(self, service, coordinates, profile="driving", **params):
+        """Send a GET request to `/{service}/v1/{profile}/{coordinates}?{params}`,
+        retrying if needed. Blocks while the rate controller says there are enough
+        requests in flight. Returns (parsed JSON body, response); raises OSRMError if
+        all attempts failed."""
+
+        url = "%s/%s/v1/%s/%s" % (self.host, service, profile, coordinates)
+        if params:
+            # Built by hand, because OSRM wants literal ';' separators.
+            url += "?" + "&".join("%s=%s" % (k, v) for k, v in params.items())
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats.record(retries=1)
+
+            retry_after = None
+            self.rate.acquire()
+            try:
+                t0 = time.monotonic()
+                r = self.session.get(url, timeout=self.timeout)
+                latency = time.monotonic() - t0
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.stats.record(requests=1, errors=1)
+                self.rate.on_failure()
+                error = e
+            else:
+                from_cache = getattr(r, "from_cache", False)
+                self.stats.record(
+                    requests=1,
+                    cache_hits=int(from_cache),
+                    latency=None if from_cache else latency,
+                )
+                try:
+                    body = r.json()
+                except ValueError as e:
+                    body, error = None, e
+
+                if r.status_code in self.RETRY_CODES:
+                    throttled = r.status_code in self.THROTTLE_CODES
+                    self.stats.record(
+                        throttles=int(throttled), errors=int(not throttled)
+                    )
+                    self.rate.on_failure()
+                    retry_after = r.headers.get("Retry-After")
+                    error = OSRMError("HTTP %d from %s" % (r.status_code, url))
+                elif body is None:
+                    # e.g., a truncated body, or an HTML error page from a proxy.
+                    self.stats.record(errors=1)
+                    self.rate.on_failure()
+                else:
+                    if not from_cache:
+                        self.rate.on_success(latency)
+                    return body, r
+            finally:
+                self.rate.release()
+
+            if attempt < self.max_retries:
+                time.sleep(self._backoff(attempt, retry_after))
+
+        self.stats.record(failures=1)
+        raise OSRMError(
+            "Giving up after %d attempts: %s (%s)" % (attempt + 1, url, error)
+        )
+
+    def _backoff(self, attempt, retry_after=None):
+        """How long to wait before the next attempt: exponential, with full
+        jitter, unless the server told us."""
+        try:
+            return min(float(retry_after), self.max_backoff_s)
+        except (TypeError, ValueError):
+            backoff = min(self.max_backoff_s, self.backoff_s * 2**attempt)
+            return random.uniform(0, backoff)
+
+    def route(self, start, end, profile="driving"):
+        """Route FROM `start` TO `end` (each a (lon, lat) pair). Only asks for what we
+        actually use: the OSM node IDs along the route and the total duration.
+        Returns the route (list of node IDs), transit time and response."""
+
+        coordinates = "%f,%f;%f,%f" % (start[0], start[1], end[0], end[1])
+        body, r = self.get(
+            "route",
+            coordinates,
+            profile,
+            annotations="nodes",
+            overview="false",
+            steps="false",
+        )
+        route = body["routes"][0]
+        return route["legs"][0]["annotation"]["nodes"], route["duration"], r
+
+    def table(self, coordinates, sources=None, destinations=None, profile="driving"):
+        """Table API: the matrix of durations between `coordinates` (a list of
+        "lon,lat" strings, or an already-formatted string, see `format_coordinates`).
+        `sources` and `destinations` are lists of indices into `coordinates` (default:
+        all). Returns the durations (np.ndarray of shape (n_sources, n_destinations),
+        NaN where there is no route), and the response."""
+
+        if not isinstance(coordinates, str):
+            coordinates = ";".join(coordinates)
+
+        params = {}
+        if sources is not None:
+            params["sources"] = ";".join(str(i) for i in sources)
+        if destinations is not None:
+            params["destinations"] = ";".join(str(i) for i in destinations)
+
+        body, r = self.get("table", coordinates, profile, **params)
+        if "durations" not in body:
+            raise OSRMError(body.get("message"), code=body.get("code"))
+        durations = np.array(body["durations"], dtype=float)
+        return durations, r
+
+    @property
+    def executor(self):
+        """A thread pool with one worker per in-flight request, shared by everything
+        that uses this client."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_in_flight
+                )
+            return self._executor
+
+    def map(self, fn, *iterables):
+        """Like `executor.map`: call fn on every item, in parallel, and yield the
+        results in order."""
+        return self.executor.map(fn, *iterables)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.session.close()
+
+
+_default_client = None
+
+
+def get_client():
+    """The shared OSRMClient, created (from `config`) the first time it's needed."""
+    global _default_client
+    if _default_client is None:
+        _default_client = OSRMClient()
+    return _default_client
+
+
+def set_client(client):
+    """Use `client` (an OSRMClient) for all the module-level functions below."""
+    global _default_client
+    _default_client = client
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
 
@@ -23,64 +362,250 @@ def chunks(l, n):
         yield l[i : i + n]
 
 
-def get_transit_times(G, origin_point, towards_origin=True, profile='driving'):
+def encode_polyline(lat_lon, precision=5):
+    """Encode an array of (lat, lon) points with Google's polyline algorithm, which
+    OSRM accepts as `polyline(...)` in place of a list of coordinates, and which is
+    about 3x shorter."""
+    values = np.round(np.asarray(lat_lon, dtype=float) * 10**precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=0).ravel()
+    return "".join(_encode_value(int(v)) for v in deltas)
+
+
+def decode_polyline(encoded, precision=5):
+    """Inverse of `encode_polyline`. Returns an (N, 2) array of (lat, lon)."""
+    values, shift, result = [], 0, 0
+    for c in encoded:
+        b = ord(c) - 63
+        result |= (b & 0x1F) << shift
+        shift += 5
+        if b < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            shift, result = 0, 0
+    return np.cumsum(np.reshape(values, (-1, 2)), axis=0) / 10**precision
+
+
+def _encode_value(v):
+    v = ~(v << 1) if v < 0 else v << 1
+    chars = []
+    while v >= 0x20:
+        chars.append(chr((0x20 | (v & 0x1F)) + 63))
+        v >>= 5
+    chars.append(chr(v + 63))
+    return "".join(chars)
+
+
+def format_coordinates(lat_lon):
+    """Format (lat, lon) points for an OSRM request URL (as an encoded polyline)."""
+    return "polyline(%s)" % urllib.parse.quote(encode_polyline(lat_lon), safe="")
+
+
+def table_chunks(lat_lon, origin, max_points, max_url_length):
+    """Split the points `lat_lon` into chunks for Table API requests about `origin`:
+    each chunk is as big as possible while still having at most `max_points` points
+    (not counting the origin; see `max_table_points`) and fitting (with the origin)
+    within our URL length limit. Points are visited in a
+    roughly spatial order, which keeps the polyline deltas (and so the URLs) short.
+    Returns a list of arrays of indices into `lat_lon`."""
+
+    lat_lon = np.asarray(lat_lon, dtype=float)
+    order = np.lexsort((lat_lon[:, 1], np.round(lat_lon[:, 0], 3)))
+
+    # Length of each point in the URL (quoted polyline), relative to the point
+    #  before it. The first point of a chunk is relative to the origin instead.
+    points = np.round(lat_lon[order] * 1e5).astype(np.int64)
+    origin = np.round(np.asarray(origin, dtype=float) * 1e5).astype(np.int64)
+    previous = np.vstack([origin, points[:-1]])
+
+    def url_length(delta):
+        encoded = _encode_value(int(delta[0])) + _encode_value(int(delta[1]))
+        return len(urllib.parse.quote(encoded, safe=""))
+
+    lengths = [url_length(d) for d in points - previous]
+
+    # Leave room for the host, service, and sources/destinations (about 200 chars),
+    #  and for the origin, which goes first.
+    budget = max_url_length - 200 - len("polyline()") - url_length(origin)
+
+    result, start, used = [], 0, 0
+    for i, length in enumerate(lengths):
+        if i > start:
+            full = (i - start) >= max_points or used + length > budget
+            if full:
+                result.append(order[start:i])
+                start, used = i, 0
+        if i == start:
+            length = url_length(points[i] - origin)
+        used += length
+    if start < len(order):
+        result.append(order[start:])
+    return result
+
+
+def max_table_points(max_table_size, both_directions=False):
+    """The most points (besides the origin) that a Table API request can have.
+    osrm-routed limits the number of sources x destinations to max_table_size**2,
+    so a one-to-many (or many-to-one) request can have up to max_table_size**2
+    points, but a many-to-many request (`both_directions`) only max_table_size."""
+    if both_directions:
+        return max_table_size - 1
+    return max_table_size**2 - 1
+
+
+def get_transit_times(
+    G,
+    origin_point,
+    towards_origin=True,
+    profile="driving",
+    client=None,
+    max_table_size=None,
+    max_url_length=None,
+):
     """Calculate transit_time for every node in the graph, and add to
     G (in-place) as a 'transit_time' property on each node.
     :type towards_origin: bool
         If True, traffic is calculated from each node *to* the `origin_point`. If False,
         then traffic is `origin_point` *to* each node. This is not symmetric b/c of one-way streets,
         left turns, etc.
+
+    The nodes are sent in chunks that are as big as the server and URL length allow
+    (see `table_chunks`; defaults from `config`), and the chunks are requested
+    concurrently. If the server says a chunk is too big anyway, it's split in two.
     """
+    times = table_transit_times(
+        _node_lat_lon(G),
+        _origin_lat_lon(G, origin_point),
+        towards_origin=towards_origin,
+        profile=profile,
+        client=client,
+        max_table_size=max_table_size,
+        max_url_length=max_url_length,
+    )
+
+    for n, node in enumerate(G.nodes):
+        G.nodes[node]["transit_time"] = times[n]
+
+
+def get_transit_times_bidirectional(
+    G,
+    origin_point,
+    profile="driving",
+    client=None,
+    max_table_size=None,
+    max_url_length=None,
+):
+    """Like `get_transit_times`, but gets the transit times both *to* and *from*
+    `origin_point` at once: each chunk is a single many-to-many table query.
+    That's one round trip per chunk instead of two, but the server computes (and
+    sends back) the full (N+1) x (N+1) matrix of each chunk, of which we only use
+    2N values, and many-to-many chunks are limited to max_table_size points (see
+    `max_table_points`) instead of max_table_size**2. So it's only worth it when
+    round trips are what's expensive (e.g., a remote server, with small chunks);
+    for big maps on a local server, calling `get_transit_times` twice is less work.
+    Sets 'transit_time' (to the origin) on every node of G, and returns the two
+    arrays of transit times (to, from), in the same order as G.nodes."""
+    times = table_transit_times(
+        _node_lat_lon(G),
+        _origin_lat_lon(G, origin_point),
+        towards_origin=None,
+        profile=profile,
+        client=client,
+        max_table_size=max_table_size,
+        max_url_length=max_url_length,
+    )
+
+    for n, node in enumerate(G.nodes):
+        G.nodes[node]["transit_time"] = times[n, 0]
+
+    return times[:, 0], times[:, 1]
 
+
+def _node_lat_lon(G):
+    return np.array([(data["lat"], data["lon"]) for n, data in G.nodes(data=True)])
+
+
+def _origin_lat_lon(G, origin_point):
     # Node ID -> actual node.
     if type(origin_point) in (int, np.int64):
         origin_point = G.nodes[origin_point]
         origin_point = [origin_point["lat"], origin_point["lon"]]
+    return np.asarray(origin_point, dtype=float)[:2]
 
-    end = "%s,%s" % (origin_point[1], origin_point[0])
-    starts = ["%s,%s" % (data["lon"], data["lat"]) for n, data in G.nodes(data=True)]
-    times = []
-
-    MAX_N_TABLE_SERVICE = 100
-    origin_is = "destination" if towards_origin else "source"
-    # the table service seems limited in number
-    for chunk in chunks(starts, MAX_N_TABLE_SERVICE):
-        chunk = ";".join(chunk)
 
-        query = (
-            "http://router.project-osrm.org/table/v1/%s/%s;%s?%ss=0"
-            % (profile, end, chunk, origin_is)
-        )
-        # query = (
-        #     "http://maps.motorshed.io/osrm/table/v1/driving/%s;%s?destinations=0"
-        #     % (end, chunk)
-        # )
-
-        # print(query)
+def table_transit_times(
+    lat_lon,
+    origin_point,
+    towards_origin=True,
+    profile="driving",
+    client=None,
+    max_table_size=None,
+    max_url_length=None,
+):
+    """Transit times between `origin_point` and each of the (lat, lon) points in
+    `lat_lon`, from the Table API (see `get_transit_times`). Returns an array, in the
+    same order as `lat_lon`. If `towards_origin` is None, both directions come back
+    from the same requests, as an (N, 2) array of (to, from) transit times."""
+    client = client or get_client()
+    max_table_size = max_table_size or config.OSRM_MAX_TABLE_SIZE
+    max_url_length = max_url_length or config.OSRM_MAX_URL_LENGTH
+    both_directions = towards_origin is None
 
-        with Timer(prefix="osrm table api"):
-            r = requests.get(query)
+    # Results go straight into here, in node order.
+    times = np.full((len(lat_lon), 2) if both_directions else len(lat_lon), np.nan)
 
-        if towards_origin:
-            times.append(np.array(r.json()["durations"])[1:, 0])
-        else:
-            # durations are nested differently when origin is src
-            times.append(np.array(r.json()["durations"][0])[1:])
+    def fetch(index):
+        coordinates = format_coordinates(np.vstack([origin_point, lat_lon[index]]))
+        try:
+            if both_directions:
+                # The origin is both a source and a destination: the first column
+                #  is 'to' the origin, and the first row is 'from' it.
+                durations, r = client.table(coordinates, profile=profile)
+                times[index, 0] = durations[1:, 0]
+                times[index, 1] = durations[0, 1:]
+            elif towards_origin:
+                durations, r = client.table(
+                    coordinates, destinations=[0], profile=profile
+                )
+                times[index] = durations[1:, 0]
+            else:
+                durations, r = client.table(coordinates, sources=[0], profile=profile)
+                times[index] = durations[0, 1:]
+        except OSRMError as e:
+            if e.code != "TooBig" or len(index) < 2:
+                raise
+            # The server's limit is smaller than we thought.
+            fetch(index[: len(index) // 2])
+            fetch(index[len(index) // 2 :])
 
-    times = np.concatenate(times)
+    chunks = table_chunks(
+        lat_lon,
+        origin_point,
+        max_table_points(max_table_size, both_directions),
+        max_url_length,
+    )
+    with Timer(prefix="osrm table api (%d chunks)" % len(chunks)):
+        for _ in client.map(fetch, chunks):
+            pass
+    print(client.stats)
 
-    for n, node in enumerate(G.nodes):
-        G.nodes[node]["transit_time"] = times[n]
+    return times
 
 
 def osrm(
-    G, start_node, end_node, missing_nodes=None, mode="driving", private_host=True
+    G,
+    start_node,
+    end_node,
+    missing_nodes=None,
+    mode="driving",
+    private_host=True,
+    client=None,
 ):
     """Query the local or remote OSRM for route and transit time.
      FROM start_node TO end_node
     If any nodes are not
     found, it updates `missing_nodes` with those nodes.
-    Returns the route, transit time, and request response."""
+    Returns the route, transit time, and request response.
+    Which OSRM server is used depends on `client` (default: `get_client()`)."""
+    client = client or get_client()
 
     if missing_nodes is None:
         missing_nodes = set([])
@@ -90,49 +615,38 @@ def osrm(
     if not hasattr(start_node, "keys"):
         start_node = G.nodes[start_node]
 
-    start = "%f,%f" % (start_node["lon"], start_node["lat"])
-    end = "%f,%f" % (end_node["lon"], end_node["lat"])
-
-    # if private_host:
-    # query = (
-    #     "http://maps.motorshed.io/osrm/route/v1/%s/%s;%s?steps=true&annotations=true"
-    #     % (mode, start, end)
-    # )
-    # else:
-    query = (
-        "http://router.project-osrm.org/route/v1/%s/%s;%s?steps=true&annotations=true"
-        % (mode, start, end)
-    )
-    r = requests.get(query)
+    start = (start_node["lon"], start_node["lat"])
+    end = (end_node["lon"], end_node["lat"])
 
     try:
-        route = r.json()["routes"][0]["legs"][0]["annotation"]["nodes"]
-        transit_time = r.json()["routes"][0]["duration"]
+        route, transit_time, r = client.route(start, end, profile=mode)
 
-    except KeyError:
-        print("No route found for %i" % start_node)
-        missing_nodes.update(start_node)
-        route, transit_time = [], np.NaN
+    except (KeyError, IndexError):
+        print("No route found for %s" % start_node.get("osmid", start_node))
+        missing_nodes.update([start_node.get("osmid")])
+        route, transit_time, r = [], np.nan, None
 
     return route, transit_time, r
 
-def osrm_parallel(G2, node_pairs):
-    N_WORKERS = 4
 
-    import concurrent.futures
-    with concurrent.futures.ThreadPoolExecutor(max_workers=N_WORKERS) as executor:
-        future_to_node = {
-            executor.submit(osrm, G2, n1, n2): (n1, n2)
-            for (n1, n2) in node_pairs}
+def osrm_parallel(G2, node_pairs, client=None):
+    """Route between many (start, end) node pairs at once, using the client's
+    thread pool. Returns a list of (route, transit_time)."""
+    client = client or get_client()
+
+    future_to_node = {
+        client.executor.submit(osrm, G2, n1, n2, client=client): (n1, n2)
+        for (n1, n2) in node_pairs
+    }
 
     results = []
     for future in concurrent.futures.as_completed(future_to_node):
         nnode = future_to_node[future]
         try:
-            route, transit_time, r  = future.result()
+            route, transit_time, r = future.result()
         except Exception as exc:
             print(exc)
             continue
         results.append((route, transit_time))
 
-    return results
\ No newline at end of file
+    return results
@@ -0,0 +1,148 @@
+"""Write rendered images (RGBA arrays, e.g., from `render_mpl.render_layer`) out as
+PNG, WebP, JPEG or raw numpy (.npy) files, with a speed/size profile, and in the
+background, so that the next map can be rendered while the last one is written.
+
+For a big map, `save_layer`'s PNG (compression 9, optimized) can take longer than
+rendering it. The profiles trade how long encoding takes for how big the file is:
+
+    fast        PNG with zlib level 1 (see `png_stream`), lossless WebP at its
+                fastest, baseline JPEG
+    balanced    PNG with zlib level 6, lossless WebP at medium effort, optimized
+                JPEG (the default)
+    small       PNG with zlib level 9, optimized (like `save_layer` always did),
+                lossless WebP at high effort, optimized progressive JPEG
+
+(.npy is the same for all of them: just the array, as fast as the disk can take it.
+JPEGs drop the alpha channel.) E.g., for a 2400 x 2400 map, a PNG takes 0.2 s
+(2.3 MB), 0.4 s (2.1 MB) or 4.2 s (1.9 MB), and a WebP 0.3 s (2.4 MB), 0.8 s
+(1.2 MB) or 2.4 s (1.2 MB).
+
+An `ImageWriter` encodes images on a pool of threads (zlib, and Pillow's encoders,
+let go of the GIL while they work), or of processes. Every image written reports
+how long it took to encode, and how big it is."""
+
+import concurrent.futures
+import os
+import time
+
+import imageio.v2 as imageio
+import numpy as np
+
+from motorshed import png_stream
+
+FORMATS = ("png", "webp", "jpeg", "npy")
+EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg", "npy": ".npy"}
+# The encoder options for each format, by profile (see above). (PNGs are written by
+#  `png_stream`, unless they're optimized, which only Pillow does.)
+PROFILES = {
+    "fast": dict(
+        png=dict(compression=1),
+        webp=dict(lossless=True, quality=0, method=0),
+        jpeg=dict(quality=90),
+    ),
+    "balanced": dict(
+        png=dict(compression=6),
+        webp=dict(lossless=True, quality=50, method=4),
+        jpeg=dict(quality=90, optimize=True),
+    ),
+    "small": dict(
+        png=dict(compress_level=9, optimize=True),
+        webp=dict(lossless=True, quality=90, method=6),
+        jpeg=dict(quality=90, optimize=True, progressive=True),
+    ),
+}
+
+
+def save_image(fn, rgba_arr, format="png", profile="balanced"):
+    """Save the RGBA (or RGB) array as `fn` plus the format's extension (see
+    FORMATS and PROFILES, above). Returns (filename, bytes, seconds it took)."""
+    if format not in FORMATS:
+        raise ValueError("Unknown image format %r (not one of %s)." % (format, FORMATS))
+    if profile not in PROFILES:
+        raise ValueError(
+            "Unknown profile %r (not one of %s)." % (profile, tuple(PROFILES))
+        )
+    fn_out = fn + EXTENSIONS[format]
+    rgba_arr = np.asarray(rgba_arr)
+
+    start = time.perf_counter()
+    if format == "npy":
+        np.save(fn_out, rgba_arr)
+    elif format == "png" and "compression" in PROFILES[profile]["png"]:
+        height, width, channels = rgba_arr.shape
+        with png_stream.PNGWriter(
+            fn_out, width, height, channels, **PROFILES[profile]["png"]
+        ) as png:
+            png.write_rows(rgba_arr)
+    else:
+        if format == "jpeg":
+            rgba_arr = rgba_arr[..., :3]
+        imageio.imwrite(fn_out, rgba_arr, format=format, **PROFILES[profile][format])
+    seconds = time.perf_counter() - start
+
+    n_bytes = os.path.getsize(fn_out)
+    print("%s: %.2f MB, encoded in %.3f seconds" % (fn_out, n_bytes / 1e6, seconds))
+    return fn_out, n_bytes, seconds
+
+
+class ImageWriter:
+    """Save images (see `save_image`) in the background, on a pool of `n_workers`
+    threads (or processes, with `processes`; the images are then copied to them).
+    Images mustn't be changed until they've been written (see `wait`).
+
+        with ImageWriter(profile="fast") as writer:
+            for address in addresses:
+                writer.save(address, render_layer(...), format="webp")
+    """
+
+    def __init__(self, profile="balanced", n_workers=1, processes=False):
+        if profile not in PROFILES:
+            raise ValueError(
+                "Unknown profile %r (not one of %s)." % (profile, tuple(PROFILES))
+            )
+        self.profile = profile
+        if processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(n_workers)
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(n_workers)
+        self._pending = []
+
+    def save(self, fn, rgba_arr, format="png"):
+        """Start saving an image (see `save_image`). Returns its future (of
+        (filename, bytes, seconds))."""
+        future = self._executor.submit(save_image, fn, rgba_arr, format, self.profile)
+        self._pending.append(future)
+        return future
+
+    def wait(self):
+        """Wait for the images that are still being written, and return their
+        (filename, bytes, seconds), in the order they were saved."""
+        pending, self._pending = self._pending, []
+        written = [future.result() for future in pending]
+        if written:
+            print(
+                "Wrote %d image(s): %.2f MB, encoded in %.3f seconds"
+                % (
+                    len(written),
+                    sum(n_bytes for _, n_bytes, _ in written) / 1e6,
+                    sum(seconds for _, _, seconds in written),
+                )
+            )
+        return written
+
+    def close(self):
+        """Wait for everything to be written (see `wait`), and stop the pool."""
+        try:
+            return self.wait()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # (Don't hide the error with another one from writing.)
+            self._executor.shutdown(cancel_futures=True)
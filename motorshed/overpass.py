@@ -1,11 +1,28 @@
+import os.path
+
+import networkx as nx
+import numpy as np
 import osmnx as ox
 
-from motorshed import util
+from motorshed import config, graph_cache, local_routing, osm_extract, util
+
+# (The same as osmnx uses for its bounding boxes.)
+EARTH_RADIUS_M = 6_371_009
 
+# What osmnx raises when there aren't any roads in a box (in different versions).
+_NO_ROADS = ("InsufficientResponseError", "EmptyOverpassResponse")
 
-def get_map(address, place=None, distance=1000):
+
+def get_map(address, place=None, distance=1000, columnar=False):
     """Get the graph (G) and end_node from OSMNX, initializes through_traffic, transit_time, and calculated.
-    Uses local cache (via Pickle) when possible."""
+    Uses local cache (see `graph_cache`) when possible. With `columnar`, G is the
+    cached `graph_cache.ColumnarGraph`, which gen2 can use without ever building the
+    networkx graph.
+    A map around an address that isn't cached under its own name is cut out of a
+    cached map that covers it, if there is one, and if cached maps only cover part
+    of it, only the rest is downloaded (see `map_from_cached_regions`). If there's
+    a local OSM extract (`config.OSM_EXTRACT`), maps around an address are read from
+    it, instead of downloaded (see `osm_extract`)."""
 
     if place is not None:
         distance = 100
@@ -14,37 +31,215 @@ def get_map(address, place=None, distance=1000):
     cache_name = "%s.%s%s" % (address, place or "", distance)
     try:
         # Try to load cache
-        (G, center_node, origin_point) = util.from_cache_pkl(cache_name)
+        if not os.path.exists(graph_cache.graph_path(cache_name)):
+            _convert_pkl_cache(cache_name)
+        G = graph_cache.load_graph(cache_name)
+        center_node = G.extra["center_node"]
+        origin_point = tuple(G.extra["origin_point"])
         # center_node = ox.get_nearest_node(G, origin_point)
-        return (G, center_node, origin_point)
+        return (G if columnar else G.to_networkx(), center_node, origin_point)
     except:
         # If cache miss, then load from netowrk.
         print("Cache miss. Loading.")
 
-        G, origin_point = ox.graph_from_address(
-            address,
-            distance=distance,
-            network_type="drive",
-            return_coords=True,
-            simplify=False,
+    bbox = None
+    if place is None:
+        origin_point = tuple(ox.geocode(address))
+        bbox = bbox_around(origin_point, distance)
+        G = map_from_cached_regions(cache_name, bbox, origin_point)
+        if G is None and config.OSM_EXTRACT:
+            G = osm_extract.load_extract(
+                config.OSM_EXTRACT,
+                center=origin_point,
+                distance=distance,
+                name=cache_name,
+            )
+        if G is not None:
+            center_node = G.extra["center_node"]
+            return (G if columnar else G.to_networkx(), center_node, origin_point)
+
+    G, origin_point = ox.graph_from_address(
+        address,
+        distance=distance,
+        network_type="drive",
+        return_coords=True,
+        simplify=False,
+    )
+
+    if place is not None:
+        G = ox.graph_from_place(place, network_type="drive", simplify=False)
+
+    # get center node:
+    center_node = ox.get_nearest_node(G, origin_point)
+
+    G = ox.project_graph(G)
+    _init_traffic(G)
+
+    # Save to cache for next time. (Only maps of a bounding box can be cut up for
+    #  other maps; places aren't boxes.)
+    graph_cache.save_graph(
+        cache_name, G, center_node=center_node, origin_point=origin_point, bbox=bbox
+    )
+    if columnar:
+        G = graph_cache.load_graph(cache_name)
+
+    return (G, center_node, origin_point)
+
+
+def _init_traffic(G):
+    # initialize edge traffic to 1, source node traffic to 1:
+    for u, v, k, data in G.edges(data=True, keys=True):
+        data["through_traffic"] = 1  # BASELINE
+
+    for node, data in G.nodes(data=True):
+        data["calculated"] = False
+
+
+def _convert_pkl_cache(cache_name):
+    """Move a map from the old (pickle) cache into the graph cache, if it's there."""
+    if os.path.exists(os.path.join(util.cache_dir, f"{cache_name}.cache.pkl.bz2")):
+        G, center_node, origin_point = util.from_cache_pkl(cache_name)
+        graph_cache.save_graph(
+            cache_name, G, center_node=center_node, origin_point=origin_point
         )
 
-        if place is not None:
-            G = ox.graph_from_place(place, network_type="drive", simplify=False)
 
-        # get center node:
-        center_node = ox.get_nearest_node(G, origin_point)
+def bbox_around(lat_lon, distance):
+    """The bounding box (west, south, east, north), in degrees, that reaches
+    `distance` meters from a (lat, lon) point in each direction (like osmnx's)."""
+    lat, lon = lat_lon
+    d_lat = np.rad2deg(distance / EARTH_RADIUS_M)
+    d_lon = d_lat / np.cos(np.deg2rad(lat))
+    return (lon - d_lon, lat - d_lat, lon + d_lon, lat + d_lat)
+
+
+def _area(bbox):
+    west, south, east, north = bbox
+    return max(east - west, 0) * max(north - south, 0)
+
+
+def _intersection(bbox, other):
+    return (
+        max(bbox[0], other[0]),
+        max(bbox[1], other[1]),
+        min(bbox[2], other[2]),
+        min(bbox[3], other[3]),
+    )
+
+
+def _contains(bbox, other):
+    return _intersection(bbox, other) == tuple(other)
+
+
+def _bbox_minus(bbox, other):
+    """Up to 4 boxes that, together, cover the part of bbox that `other` doesn't:
+    full-width strips to the north and south, and the rest to the west and east."""
+    west, south, east, north = bbox
+    o_west, o_south, o_east, o_north = _intersection(bbox, other)
+    boxes = [
+        (west, o_north, east, north),
+        (west, south, east, o_south),
+        (west, o_south, o_west, o_north),
+        (o_east, o_south, east, o_north),
+    ]
+    return [box for box in boxes if _area(box) > 0]
+
+
+def _in_bbox(lat, lon, bbox):
+    west, south, east, north = bbox
+    return (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+
+
+def map_from_cached_regions(cache_name, bbox, origin_point, cache_dir=None):
+    """Make the map of `bbox` (west, south, east, north) from the cached maps, and
+    cache it as `cache_name`:
+      - if a cached map covers all of it, it's cut out of (the smallest) one;
+      - if cached maps cover part of it, it's the part of the one that covers the
+        most, plus the rest, downloaded (as up to 4 boxes);
+      - if none of it is cached, returns None.
+    Returns the new map, as a ColumnarGraph."""
+    regions = [
+        (name, region)
+        for name, region in graph_cache.cached_regions(cache_dir)
+        if _area(_intersection(region, bbox)) > 0
+    ]
+    if not regions:
+        return None
+
+    covering = [(name, region) for name, region in regions if _contains(region, bbox)]
+    if covering:
+        name, region = min(covering, key=lambda r: _area(r[1]))
+        print("Cutting the map out of the cached map %r." % name)
+    else:
+        name, region = max(regions, key=lambda r: _area(_intersection(r[1], bbox)))
+        print("Part of the map is in the cached map %r; downloading the rest." % name)
+
+    # The cached part.
+    CG = graph_cache.load_graph(name, cache_dir)
+    lat, lon = CG.node_column("lat"), CG.node_column("lon")
+    keep = _in_bbox(lat, lon, bbox)
+    if covering:
+        keep = graph_cache.largest_component(CG.node_ids, CG.u, CG.v, keep)
+        center_node = local_routing.nearest_of(
+            CG.node_ids[keep], lat[keep], lon[keep], origin_point
+        )
+        return CG.save_subgraph(
+            cache_name,
+            keep,
+            cache_dir,
+            center_node=int(center_node),
+            origin_point=origin_point,
+            bbox=bbox,
+        )
+
+    # (It's saved for now just to get it as a networkx graph; it's replaced below.)
+    G = CG.save_subgraph(cache_name, keep, cache_dir).to_networkx()
 
-        G = ox.project_graph(G)
+    # The rest. Edges that cross from the cached part come along, too.
+    complete = True
+    for box in _bbox_minus(bbox, region):
+        try:
+            G_box = _graph_from_bbox(box)
+        except Exception as e:
+            print("Nothing downloaded for %s: %r" % (box, e))
+            # (It's complete if there just aren't any roads there.)
+            complete = complete and type(e).__name__ in _NO_ROADS
+            continue
+        for node, data in G_box.nodes(data=True):
+            data["lat"], data["lon"] = data["y"], data["x"]
+        G = nx.compose(G, ox.project_graph(G_box, to_crs=CG.graph["crs"]))
+    _init_traffic(G)
 
-        # initialize edge traffic to 1, source node traffic to 1:
-        for u, v, k, data in G.edges(data=True, keys=True):
-            data["through_traffic"] = 1  # BASELINE
+    node_ids = np.fromiter(G.nodes, dtype=np.int64, count=len(G))
+    lat, lon = np.array([(d["lat"], d["lon"]) for n, d in G.nodes(data=True)]).T
+    u, v = np.array([(u, v) for u, v, k in G.edges(keys=True)], dtype=np.int64).T
+    keep = graph_cache.largest_component(node_ids, u, v, _in_bbox(lat, lon, bbox))
+    G = G.subgraph(node_ids[keep].tolist()).copy()
+    G.graph["crs"] = CG.graph["crs"]
+    center_node = local_routing.nearest_of(
+        node_ids[keep], lat[keep], lon[keep], origin_point
+    )
 
-        for node, data in G.nodes(data=True):
-            data["calculated"] = False
+    # (If a download failed, the map might have holes, so don't cut it up for
+    #  others.)
+    graph_cache.save_graph(
+        cache_name,
+        G,
+        cache_dir,
+        center_node=int(center_node),
+        origin_point=origin_point,
+        bbox=bbox if complete else None,
+    )
+    return graph_cache.load_graph(cache_name, cache_dir)
 
-        # Save to cache for next time.
-        util.cache_to_pkl(cache_name, (G, center_node, origin_point))
 
-        return (G, center_node, origin_point)
+def _graph_from_bbox(bbox):
+    """Download the drivable roads of `bbox` (west, south, east, north), with the
+    edges that cross its edges (and the nodes on the other end)."""
+    kwargs = dict(
+        network_type="drive", simplify=False, retain_all=True, truncate_by_edge=True
+    )
+    if int(ox.__version__.split(".")[0]) >= 2:
+        return ox.graph_from_bbox(bbox, **kwargs)
+    west, south, east, north = bbox
+    return ox.graph_from_bbox(north, south, east, west, **kwargs)
@@ -0,0 +1,254 @@
+"""The whole motorshed calculation, from a graph to edges with through_traffic,
+for one or both directions, using whichever routing backend is configured
+(see `config.ROUTING_BACKEND`)."""
+
+import concurrent.futures
+import os
+
+import numpy as np
+import osmnx as ox
+import pandas as pd
+from contexttimer import Timer
+
+from motorshed import config, local_routing, osrm
+from motorshed.algos import gen2
+
+
+def get_router(backend=None):
+    """The module that provides transit times for `backend` ("osrm" or "local";
+    default: `config.ROUTING_BACKEND`)."""
+    backend = backend or config.ROUTING_BACKEND
+    if backend == "local":
+        return local_routing
+    elif backend == "osrm":
+        return osrm
+    raise ValueError("Unknown routing backend: %r" % backend)
+
+
+def store_profile(backend=None, profile="driving"):
+    """What the results of `backend` are filed under in a RoutingStore."""
+    return "%s/%s" % (backend or config.ROUTING_BACKEND, profile)
+
+
+def get_transit_times(G, center_node, towards_origin=True, backend=None, store=None):
+    """Set 'transit_time' on every node of G (in place), with the `backend`'s
+    get_transit_times. With a RoutingStore (`store`), the ones that it knows are
+    loaded from it, only the others are calculated (with OSRM, only they are sent
+    to the Table API), and then they're saved for next time."""
+    router = get_router(backend)
+    if store is None:
+        return router.get_transit_times(G, center_node, towards_origin=towards_origin)
+
+    profile = store_profile(backend)
+    nodes = np.fromiter(G.nodes, dtype=np.int64, count=len(G))
+    times, known = store.load_transit_times(center_node, nodes, towards_origin, profile)
+    missing = np.flatnonzero(~known)
+    print("Routing store: %d of %d transit times known." % (known.sum(), len(nodes)))
+
+    if len(missing):
+        if router is osrm:
+            times[missing] = osrm.table_transit_times(
+                osrm._node_lat_lon(G)[missing],
+                osrm._origin_lat_lon(G, center_node),
+                towards_origin=towards_origin,
+            )
+        else:
+            # (No queries to save here; it's just as fast to do them all.)
+            router.get_transit_times(G, center_node, towards_origin=towards_origin)
+            times = np.array([d["transit_time"] for n, d in G.nodes(data=True)])
+        store.save_transit_times(
+            center_node, nodes[missing], times[missing], towards_origin, profile
+        )
+
+    for node, t in zip(nodes.tolist(), times):
+        G.nodes[node]["transit_time"] = t
+
+
+def route_edges(G, Gn, Ge, center_node, towards_origin=True, backend=None, store=None):
+    """Run the gen2 routing steps and propagate the traffic, starting from the
+    dataframes from `gen2.create_initial_dataframes` (with the 'transit_time' for
+    this direction already in Gn). Returns Gge, the edges with through_traffic.
+    With a RoutingStore (`store`), the routings that it knows are used (so only
+    the rest need to be worked out), and the new ones are saved."""
+    Ge = find_successors(G, Gn, Ge, center_node, towards_origin, backend, store)
+    return gen2.propagate_edges(Ge)
+
+
+def find_successors(
+    G, Gn, Ge, center_node, towards_origin=True, backend=None, store=None, tree=None
+):
+    """The gen2 routing steps of `route_edges`, without propagating the traffic.
+    Returns Ge, routed. `tree` is passed on to `gen2.followup_local_routing`."""
+    Ge, Gn = gen2.initial_routing(Ge, Gn)
+
+    if store is not None:
+        profile = store_profile(backend)
+        n_known = store.apply_successors(center_node, Ge, towards_origin, profile)
+        print("Routing store: %d of %d edges routed." % (n_known, len(Ge)))
+
+    if get_router(backend) is local_routing:
+        Ge = gen2.followup_local_routing(
+            G, Ge, Gn, center_node, towards_origin=towards_origin, tree=tree
+        )
+    else:
+        Ge, Gn = gen2.followup_heuristic_routing(Ge, Gn)
+        Ge = gen2.followup_osrm_routing_parallel(
+            G, Ge, Gn, center_node, towards_origin=towards_origin
+        )
+
+    if store is not None:
+        store.save_successors(center_node, Ge, towards_origin, profile)
+
+    return Ge
+
+
+def motorshed(G, center_node, towards_origin=True, backend=None, store=None):
+    """Calculate a one-way motorshed. Returns (Gn, Gge). With a RoutingStore
+    (`store`), whatever is known about this center is re-used (see
+    `get_transit_times` and `route_edges`)."""
+    with Timer(prefix="Get transit times"):
+        get_transit_times(G, center_node, towards_origin, backend, store)
+
+    Gn, Ge = gen2.create_initial_dataframes(G, towards_origin=towards_origin)
+    Gge = route_edges(G, Gn, Ge, center_node, towards_origin, backend, store)
+
+    return Gn, Gge
+
+
+def bidirectional_motorshed(G, center_node, backend=None, store=None):
+    """Calculate the motorsheds *to* and *from* center_node in one go: the transit
+    times for both directions come from the same table queries, and the node and edge
+    dataframes are only created once (the 'from' edges are just the 'to' edges,
+    reversed).
+    Returns (Gn, Gge_to, Gge_from). Gn has the transit times in both directions, as
+    'transit_time_to' and 'transit_time_from'. With a RoutingStore (`store`), the
+    directions are loaded from it (and only what's missing is queried) separately.
+    """
+    router = get_router(backend)
+
+    with Timer(prefix="Get transit times (both directions)"):
+        if store is None:
+            times_to, times_from = router.get_transit_times_bidirectional(
+                G, center_node
+            )
+        else:
+            times = []
+            for towards_origin in (False, True):
+                get_transit_times(G, center_node, towards_origin, backend, store)
+                times.append([d["transit_time"] for n, d in G.nodes(data=True)])
+            times_from, times_to = times
+
+    Gn, Ge = gen2.create_initial_dataframes(G, towards_origin=True)
+    node_ids = list(G.nodes)
+    Gn["transit_time_to"] = pd.Series(times_to, index=node_ids).reindex(Gn.index)
+    Gn["transit_time_from"] = pd.Series(times_from, index=node_ids).reindex(Gn.index)
+
+    with Timer(prefix="TOWARDS origin"):
+        Gge_to = route_edges(
+            G,
+            Gn.assign(transit_time=Gn.transit_time_to),
+            Ge.copy(),
+            center_node,
+            towards_origin=True,
+            backend=backend,
+            store=store,
+        )
+
+    with Timer(prefix="AWAY from origin"):
+        Gge_from = route_edges(
+            G,
+            Gn.assign(transit_time=Gn.transit_time_from),
+            gen2.reverse_edges(Ge),
+            center_node,
+            towards_origin=False,
+            backend=backend,
+            store=store,
+        )
+
+    return Gn, Gge_to, Gge_from
+
+
+def batch_motorsheds(
+    G, center_nodes, towards_origin=True, backend=None, n_workers=None
+):
+    """Calculate the motorsheds of many centers (e.g., a set of stores) on the
+    same graph. Each center can be a node ID, a (lat, lon) point, or an address;
+    points and addresses are snapped to the nearest node of G. The dataframes are created once and shared; each center node is then
+    routed and propagated in its own process, on a pool of `n_workers` processes
+    (default: one per CPU; 1 means don't use a pool).
+    Returns one dataframe of edges, indexed by (u, v) in the direction of the graph,
+    with the through_traffic for each center in a column named after it (after
+    its node ID, for (lat, lon) points)."""
+    centers = list(center_nodes)
+    center_nodes = [center_node_of(G, c) for c in centers]
+    names = [c if isinstance(c, str) else n for c, n in zip(centers, center_nodes)]
+    n_workers = min(n_workers or os.cpu_count(), len(center_nodes))
+
+    # Nodes get their transit times in the workers; we just need the columns.
+    Gn, Ge = gen2.create_initial_dataframes(G, towards_origin=towards_origin)
+
+    if not center_nodes:
+        u, v = ("u", "v") if towards_origin else ("v", "u")
+        return pd.DataFrame(index=Ge.set_index([u, v]).index.rename(["u", "v"]))
+    shared = (G, Gn, Ge, towards_origin, backend)
+
+    with Timer(prefix="Batch of %d motorsheds" % len(center_nodes)):
+        if n_workers <= 1:
+            _batch_worker_init(*shared)
+            results = map(_batch_worker, center_nodes)
+            traffic = dict(results)
+        else:
+            # Everything shared is sent once per worker, not once per center node.
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_batch_worker_init,
+                initargs=shared,
+            ) as executor:
+                traffic = dict(executor.map(_batch_worker, center_nodes))
+
+    edges = pd.concat([traffic[c] for c in center_nodes], axis=1, keys=names)
+    return edges.fillna(0).sort_index()
+
+
+def center_node_of(G, center):
+    """The node of G for `center`: a node ID, a (lat, lon) point, or an address
+    (which is geocoded with osmnx)."""
+    if isinstance(center, str):
+        center = ox.geocode(center)
+    if isinstance(center, (tuple, list, np.ndarray)):
+        return local_routing.nearest_node(G, center)
+    return center
+
+
+_batch_state = None
+
+
+def _batch_worker_init(G, Gn, Ge, towards_origin, backend):
+    global _batch_state
+    _batch_state = (G, Gn, Ge, towards_origin, backend)
+
+
+def _batch_worker(center_node):
+    G, Gn, Ge, towards_origin, backend = _batch_state
+
+    # (This only changes this process's copy of G, unless we're not using a pool,
+    #  in which case it's what would have happened anyway.)
+    get_router(backend).get_transit_times(G, center_node, towards_origin)
+    transit_time = pd.Series(
+        [data["transit_time"] for node, data in G.nodes(data=True)], index=list(G.nodes)
+    )
+
+    Gge = route_edges(
+        G,
+        Gn.assign(transit_time=transit_time.reindex(Gn.index).values),
+        Ge.copy(),
+        center_node,
+        towards_origin=towards_origin,
+        backend=backend,
+    )
+
+    # Back to the direction of the graph, so that all of the columns line up.
+    u, v = ("u", "v") if towards_origin else ("v", "u")
+    through_traffic = Gge.set_index([u, v]).through_traffic.astype(float)
+    through_traffic.index.names = ["u", "v"]
+    return center_node, through_traffic
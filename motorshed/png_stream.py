@@ -0,0 +1,96 @@
+"""Write PNGs a band of rows at a time, so that the whole image never has to be in
+memory (e.g., for posters; see `render_np.render_poster`).
+
+A PNG is just a header, and then the rows of the image (each with a filter byte in
+front of it), deflated into one zlib stream, in as many IDAT chunks as we like. So
+the rows can be compressed and written out as they're rendered."""
+
+import struct
+import zlib
+
+import numpy as np
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG color types, by the number of channels.
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+# The 'Up' filter: each row is stored as its difference from the row above it,
+#  which compresses well for maps (mostly background, and long lines).
+FILTER_UP = 2
+
+
+class PNGWriter:
+    """Write a `width` x `height` 8-bit PNG to `fn`, with `channels` channels
+    (4 is RGBA), as it's handed bands of rows (`write_rows`), from the top down.
+
+        with PNGWriter("poster.png", width, height) as png:
+            for band in bands:
+                png.write_rows(band)
+    """
+
+    def __init__(self, fn, width, height, channels=4, compression=6):
+        self.fn = fn
+        self.width, self.height, self.channels = width, height, channels
+        self.rows_written = 0
+        self._previous = np.zeros((1, width * channels), dtype=np.uint8)
+        self._compressor = zlib.compressobj(compression)
+
+        self._file = open(fn, "wb")
+        self._file.write(SIGNATURE)
+        self._chunk(
+            b"IHDR",
+            struct.pack(">IIBBBBB", width, height, 8, COLOR_TYPES[channels], 0, 0, 0),
+        )
+
+    def write_rows(self, rows):
+        """Compress and write the next rows of the image (a uint8 array, (rows,
+        width, channels), or (rows, width) with one channel)."""
+        rows = np.asarray(rows, dtype=np.uint8).reshape(len(rows), -1)
+        if rows.shape[1] != self.width * self.channels:
+            raise ValueError(
+                "Rows should be %d pixels (of %d channels) wide."
+                % (self.width, self.channels)
+            )
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError("More rows than the image's %d." % self.height)
+
+        # (uint8 differences wrap around, just like the filter does.)
+        filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = FILTER_UP
+        np.subtract(rows, np.vstack([self._previous, rows[:-1]]), out=filtered[:, 1:])
+        self._previous = rows[-1:].copy()
+        self.rows_written += len(rows)
+
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        """Finish the PNG (it has to have all of its rows by now)."""
+        if self._file.closed:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(
+                    "Only %d of the image's %d rows were written."
+                    % (self.rows_written, self.height)
+                )
+            self._chunk(b"IDAT", self._compressor.flush())
+            self._chunk(b"IEND", b"")
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # (Don't hide the error with another one about the missing rows.)
+            self._file.close()
+
+    def _chunk(self, chunk_type, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
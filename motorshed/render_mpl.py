@@ -1,49 +1,68 @@
-import imageio
 import matplotlib.cm
 import numpy as np
-from contexttimer import Timer
 from matplotlib import pyplot as plt
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.collections import LineCollection
 
-from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.colors import LinearSegmentedColormap, to_rgba
 
+from motorshed import output
+# (Not `from motorshed import lod`: render_layer's `lod` argument would hide it.)
+from motorshed.lod import level_of_detail, pixel_size_m
 
-def render_layer(
-    Gn,
-    Ge,
-    center_node,
-    bgcolor="black",
-    canvas_inches=8,
-    dpi=150,
-    max_edge_width=None,
-    cmap=matplotlib.cm.magma,
-):
-    """ Fast matplotlib-based function to render the graph defined by Gn and Ge,
-      with concentric circles at the center_node. Return
-      as an image: np.ndarray `rgb_arr`.
-    """
 
+# The rings of the 'center node' marker: (radius in meters, cmap value, alpha),
+#  drawn in this order.
+CENTER_RINGS = (
+    (100, 150, 0.1),  # 100 meters approx
+    (75, 190, 0.2),
+    (65, 210, 0.3),
+    (55, 220, 0.4),
+    (45, 235, 0.55),
+    (35, 255, 1.0),
+)
+
+
+def guess_max_edge_width(Gn, Ge, canvas_inches=8):
+    """Take into account graph size and complexity, and figure size, to guess
+    a good max edge width (in points). This is based on past "good" value, and seems
+    to work pretty well."""
     # guess approximate geographic size to help w/ guessing a good line width.
     approx_width_m = (Gn.x.max() - Gn.x.min() + Gn.y.max() - Gn.y.min()) / 2
 
-    # If needed, take into account graph size and complexity, and figure size, to guess
-    #  a good edge width. This is based on past "good" value, and seems to work pretty
-    #  well.
-    if max_edge_width is None:
-        max_edge_width = (
-            2.5
-            * (10000 / approx_width_m) ** 0.25
-            * (50000 / len(Ge)) ** 0.15
-            * (30000 / len(Gn)) ** 0.1
-            * (canvas_inches / 8) ** 0.33
-        )
+    max_edge_width = (
+        2.5
+        * (10000 / approx_width_m) ** 0.25
+        * (50000 / len(Ge)) ** 0.15
+        * (30000 / len(Gn)) ** 0.1
+        * (canvas_inches / 8) ** 0.33
+    )
+    print(f"Guessing a good max width: {max_edge_width} pixels")
+    return max_edge_width
 
-        print(f"Guessing a good max width: {max_edge_width} pixels")
+
+def style_edges(Ge, max_edge_width):
+    """The edges with traffic, with their 'edge_widths' (in points) and
+    'edge_intensity' (0-255, for the cmap), sorted so that when plotted, the
+    brightest/thickest ones are on top."""
 
     # Temporary dataframe for prepping graph.
     gdf = Ge.query("through_traffic!=0").reset_index().copy()
 
+    gdf["edge_widths"], gdf["edge_intensity"] = edge_style(
+        gdf.through_traffic.values, gdf.through_traffic.max(), max_edge_width
+    )
+
+    # Sort edges so that when plotted, the brightest/thickest ones are on top.
+    gdf.sort_values("edge_widths", ascending=True, inplace=True)
+    return gdf
+
+
+def edge_style(through_traffic, max_traffic, max_edge_width):
+    """The widths (in points) and intensities (0-255, uint8, for the cmap) of edges
+    with `through_traffic`, when the busiest one (with `max_traffic`) gets
+    max_edge_width. (E.g., for frames of an animation, with the traffic so far.)"""
+
     # Limit how small edges can get.
     min_intensity_ratio = 1.1 / 255
     min_edge_width = max_edge_width * 0.05
@@ -51,31 +70,64 @@ def render_layer(
     # we make 'edge intensity' a logarithmic fxn of the through
     #  traffic, with a '+2' that prevents verrry small through
     #  traffics from re-scaling the graph.
-    gdf["edge_intensity"] = np.log2(gdf.through_traffic + 2.0)
+    edge_intensity = np.log2(np.asarray(through_traffic, dtype=float) + 2.0)
+    edge_intensity = edge_intensity / np.log2(max_traffic + 2.0)
     # Edge widths scale as edge intensity, between our min and max
     #  allowable edge widthsl.
-    gdf["edge_widths"] = (gdf.edge_intensity / gdf.edge_intensity.max()) * (
-        max_edge_width - min_edge_width
-    ) + min_edge_width
+    edge_widths = edge_intensity * (max_edge_width - min_edge_width) + min_edge_width
 
     # Make edge intensity between 0->255 (uint8) for easier plotting.
-    gdf.edge_intensity = (gdf.edge_intensity / gdf.edge_intensity.max()) * (
-        1 - min_intensity_ratio
-    ) + min_intensity_ratio
-    gdf.edge_intensity = (gdf.edge_intensity * 255).astype(np.uint8)
+    edge_intensity = edge_intensity * (1 - min_intensity_ratio) + min_intensity_ratio
+    edge_intensity = (edge_intensity * 255).astype(np.uint8)
+    return edge_widths, edge_intensity
 
-    # Sort edges so that when plotted, the brightest/thickest ones are on top.
-    gdf.sort_values("edge_widths", ascending=True, inplace=True)
+
+def render_layer(
+    Gn,
+    Ge,
+    center_node,
+    bgcolor="black",
+    canvas_inches=8,
+    dpi=150,
+    max_edge_width=None,
+    cmap=matplotlib.cm.magma,
+    lod=False,
+):
+    """ Fast matplotlib-based function to render the graph defined by Gn and Ge,
+      with concentric circles at the center_node. Return
+      as an image: np.ndarray `rgb_arr`.
+      With `lod`, edges are drawn with their real curves, merged and simplified
+      to the pixel size (see `lod`).
+      (`render_np.render_layer` does the same without matplotlib, faster.)
+    """
+
+    # If needed, guess a good edge width.
+    if max_edge_width is None:
+        max_edge_width = guess_max_edge_width(Gn, Ge, canvas_inches)
+
+    gdf = style_edges(Ge, max_edge_width)
 
     # Vectorized operations to calculate inputs to the plotting function
-    xy1 = Gn.loc[gdf.u, ["x", "y"]].values
-    xy2 = Gn.loc[gdf.v, ["x", "y"]].values
-    line_coords = list(
-        zip(xy1, xy2)
-    )  # wish this was a numpy op; that might be possible
     line_colors = cmap(
         gdf.edge_intensity
     )  # map edge intensities using chosen color map
+    line_widths = gdf.edge_widths.values
+    if lod:
+        # Fewer, but curvier, lines (styled like the edges they came from).
+        segments, edge = level_of_detail(
+            Gn,
+            gdf,
+            line_widths * dpi / 72 / 2,
+            line_colors[:, :3] * 255,
+            np.array(to_rgba(bgcolor)) * 255,
+            pixel_size_m(Gn, canvas_inches, dpi),
+        )
+        line_coords = segments.reshape(-1, 2, 2)
+        line_colors, line_widths = line_colors[edge], line_widths[edge]
+    else:
+        xy1 = Gn.loc[gdf.u, ["x", "y"]].values
+        xy2 = Gn.loc[gdf.v, ["x", "y"]].values
+        line_coords = np.stack([xy1, xy2], axis=1)
 
     # Create a matplotlib canvas
     fig, ax = plt.subplots(
@@ -85,7 +137,7 @@ def render_layer(
 
     # add the lines to the axis as a linecollection (a pretty fast MPL actor)
     lc = LineCollection(
-        line_coords, colors=line_colors, linewidths=gdf.edge_widths, capstyle="round"
+        line_coords, colors=line_colors, linewidths=line_widths, capstyle="round"
     )
     ax.add_collection(lc)
 
@@ -106,64 +158,18 @@ def render_layer(
     yaxis.set_visible(False)
 
     #####
-    # Draw the 'center node'. This is ugly and could be refactored/shortened. Or,
-    #  it would be nice to have other options, e.g., a graphic icon
-    R = 100  # 100 meters approx
-
-    ax.add_artist(
-        plt.Circle(
-            (Gn.loc[center_node].x, Gn.loc[center_node].y),
-            zorder=2,
-            radius=R,
-            color=cmap(150),
-            alpha=0.1,
-        )
-    )
-    ax.add_artist(
-        plt.Circle(
-            (Gn.loc[center_node].x, Gn.loc[center_node].y),
-            zorder=2,
-            radius=R * 0.75,
-            color=cmap(190),
-            alpha=0.2,
-        )
-    )
-    ax.add_artist(
-        plt.Circle(
-            (Gn.loc[center_node].x, Gn.loc[center_node].y),
-            zorder=2,
-            radius=R * 0.65,
-            color=cmap(210),
-            alpha=0.3,
+    # Draw the 'center node'. It would be nice to have other options, e.g., a
+    #  graphic icon
+    for radius, value, alpha in CENTER_RINGS:
+        ax.add_artist(
+            plt.Circle(
+                (Gn.loc[center_node].x, Gn.loc[center_node].y),
+                zorder=2,
+                radius=radius,
+                color=cmap(value),
+                alpha=alpha,
+            )
         )
-    )
-    ax.add_artist(
-        plt.Circle(
-            (Gn.loc[center_node].x, Gn.loc[center_node].y),
-            zorder=2,
-            radius=R * 0.55,
-            color=cmap(220),
-            alpha=0.4,
-        )
-    )
-    ax.add_artist(
-        plt.Circle(
-            (Gn.loc[center_node].x, Gn.loc[center_node].y),
-            zorder=2,
-            radius=R * 0.45,
-            color=cmap(235),
-            alpha=0.55,
-        )
-    )
-    ax.add_artist(
-        plt.Circle(
-            (Gn.loc[center_node].x, Gn.loc[center_node].y),
-            zorder=2,
-            radius=R * 0.35,
-            color=cmap(255),
-            alpha=1.0,
-        )
-    )
 
     # Tight layout to use more of the Field of View
     fig.tight_layout()
@@ -182,19 +188,20 @@ def render_layer(
     return rgba_arr
 
 
-def save_layer(fn, rgba_arr):
-    """ Save the RGBA array as a PNG. Return the filename."""
-    with Timer(prefix="PNG"):
-        fn_png = fn + ".png"
-        print(fn_png)
-        imageio.imwrite(fn_png, rgba_arr, format='png', optimize=True, bits=8, prefer_uint8=True, compression=9)
-
-    return fn_png
+def save_layer(fn, rgba_arr, format="png", profile="small"):
+    """ Save the RGBA array as a PNG (or another format, with a faster profile; see
+    `output.save_image`). Return the filename."""
+    fn_out, n_bytes, seconds = output.save_image(fn, rgba_arr, format, profile)
+    return fn_out
 
 
 def combine_layers_max(list_of_layers):
     """ Combine several layers using a 'max' function. Useful for, e.g., bidirectional displays """
-    return np.max(list_of_layers, axis=0)
+    # (One layer at a time, into a copy of the first, rather than stacking them all.)
+    combined = np.array(list_of_layers[0])
+    for layer in list_of_layers[1:]:
+        np.maximum(combined, layer, out=combined)
+    return combined
 
 
 def concat_layers_horiz(list_of_layers):
@@ -0,0 +1,440 @@
+"""Render motorshed layers straight into a numpy RGBA array, without matplotlib.
+
+`render_mpl.render_layer` builds a whole matplotlib figure to draw the edges as a
+LineCollection through Agg, and then copies the canvas out of it. Here, the same
+edges (styled the same way, see `render_mpl.style_edges`) are rasterized directly:
+every edge is a line segment with round caps (a 'capsule'), and every pixel near
+it is covered by how far its center is from the segment (which antialiases it).
+The segments are drawn in batches, and within a batch, the pixels that several
+segments cover are drawn over in rounds, so that they're still painted in order
+(thin/faint ones first), like Agg does.
+
+The image is laid out like matplotlib would (the same size, and the map in the
+same place), so layers from either one can be combined.
+
+Posters (e.g., 20k pixels on a side) are rendered with `render_poster`, a band of
+rows at a time: every layer is drawn into the band, they're combined, and the band
+is written out to the PNG, so only a band (not the poster) is ever in memory."""
+
+import concurrent.futures
+import os
+
+import matplotlib.cm
+import matplotlib.colors
+import numpy as np
+from contexttimer import Timer
+
+from motorshed import compositing, png_stream, render_mpl
+from motorshed.compositing import background
+
+# (Not `from motorshed import lod`: the `lod` arguments below would hide it.)
+from motorshed.lod import polylines, visible
+
+# The margin that matplotlib's tight_layout leaves around the map: 1.08 times the
+#  (default, 10 pt) font size.
+PAD_POINTS = 1.08 * 10
+# How many (segment, pixel) pairs to work out at once. (Each one takes a few dozen
+#  bytes while it's being drawn.)
+BATCH_PIXELS = 1_000_000
+
+
+def render_layer(
+    Gn,
+    Ge,
+    center_node,
+    bgcolor="black",
+    canvas_inches=8,
+    dpi=150,
+    max_edge_width=None,
+    cmap=matplotlib.cm.magma,
+    out=None,
+    lod=False,
+):
+    """Render the graph defined by Gn and Ge, with concentric circles at the
+    center_node, like `render_mpl.render_layer` (with the same parameters), and
+    return it as an RGBA image (np.ndarray, uint8). It's drawn into `out`, if
+    given (an RGBA array of the right size, e.g., to re-use it). With `lod`, the
+    edges are drawn with their real curves, simplified to the pixel size (see
+    `lod`). (To render the same motorshed several ways, use a `RenderSession`.)"""
+    session = RenderSession(Gn, Ge, center_node, canvas_inches, dpi, lod)
+    return session.render(bgcolor, max_edge_width, cmap, out)
+
+
+def render_poster(
+    fn, layers, bgcolor="black", band_height=512, mode="max", compression=6
+):
+    """Render a poster into the PNG `fn`, a band of `band_height` rows at a time
+    (see above), and return `fn`. `layers` are `Layer`s (all of the same size; see
+    `RenderSession.layer`), and are blended together with `mode` (see
+    `compositing.blend`; by default, their max, like
+    `render_mpl.combine_layers_max`)."""
+    size = layers[0].size
+    if any(layer.size != size for layer in layers):
+        raise ValueError("The layers of a poster have to be the same size.")
+    bg = background(bgcolor)
+
+    with Timer(prefix="Render poster (%d x %d pixels)" % (size, size)):
+        # (Re-used from band to band.)
+        combined = np.empty((min(band_height, size), size, 4), dtype=np.uint8)
+        band = np.empty_like(combined) if len(layers) > 1 else None
+        with png_stream.PNGWriter(fn, size, size, compression=compression) as png:
+            for top in range(0, size, band_height):
+                rows = min(band_height, size - top)
+                for n, layer in enumerate(layers):
+                    if not n or mode == "over":
+                        # (Drawn straight into the combined band: the first layer,
+                        #  and the others, when they're just drawn over it.)
+                        if not n:
+                            combined[:rows] = bg
+                        layer.draw(combined[:rows], top)
+                    else:
+                        band[:rows] = bg
+                        layer.draw(band[:rows], top)
+                        compositing.blend(combined[:rows], band[:rows], mode)
+                png.write_rows(combined[:rows])
+
+    print(fn)
+    return fn
+
+
+class RenderSession:
+    """Everything about rendering a motorshed (at a size and resolution) that
+    doesn't depend on how it's styled, worked out once: which edges are drawn, in
+    what order, how busy each one is, and their segments in pixels (with `lod`,
+    merged and simplified; see `lod.polylines`). Rendering it with a style (a
+    cmap, max edge width and background color, see `render_layer`) then just maps
+    those to colors and widths, so trying out styles (see `render_batch`) is fast.
+
+        session = RenderSession(Gn, Gge, center_node, dpi=300)
+        red, blue = session.render_batch([dict(cmap=cm_red), dict(cmap=cm_blue)])
+    """
+
+    def __init__(self, Gn, Ge, center_node, canvas_inches=8, dpi=150, lod=False):
+        with Timer(prefix="Prepare render session"):
+            self.size = int(round(canvas_inches * dpi))
+            self.lod = lod
+            self.max_edge_width = render_mpl.guess_max_edge_width(Gn, Ge, canvas_inches)
+            # The edges to draw, in order (with where they are in Ge, for restyling
+            #  them with other traffic; see `Layer`).
+            gdf = render_mpl.style_edges(Ge.assign(ge_row=np.arange(len(Ge))), 1.0)
+            self.ge_row = gdf.ge_row.to_numpy()
+            self.traffic = gdf.through_traffic.to_numpy(float)
+            self.max_traffic = gdf.through_traffic.max()
+            # (Widths are in points, like matplotlib's.)
+            self.pixels_per_point = dpi / 72
+            to_pixels = canvas_transform(Gn, self.size, dpi)
+            self.box = to_pixels.box
+
+            # Segment ends, in pixels, and the edge that each one is styled like.
+            if lod:
+                segments, self.edge, length = polylines(Gn, gdf, 1 / to_pixels.scale)
+                self.length_px = length * to_pixels.scale
+                x1, y1 = to_pixels(segments[:, 0], segments[:, 1])
+                x2, y2 = to_pixels(segments[:, 2], segments[:, 3])
+            else:
+                self.edge = np.arange(len(gdf))
+                node_i = Gn.index.get_indexer
+                x, y = to_pixels(Gn.x.to_numpy(float), Gn.y.to_numpy(float))
+                ui, vi = node_i(gdf.u), node_i(gdf.v)
+                x1, y1, x2, y2 = x[ui], y[ui], x[vi], y[vi]
+            self.segments = np.stack([x1, y1, x2, y2], axis=1)
+            self.y_range = np.minimum(y1, y2), np.maximum(y1, y2)
+
+            # Where the 'center node' is, and how big its rings are, in pixels.
+            self.center = np.array(
+                to_pixels(Gn.x.loc[center_node], Gn.y.loc[center_node])
+            )
+            self.ring_scale = to_pixels.scale
+
+    def layer(
+        self,
+        max_edge_width=None,
+        cmap=matplotlib.cm.magma,
+        bgcolor="black",
+        through_traffic=None,
+    ):
+        """The motorshed, styled (see `render_layer`), as a `Layer`. (`bgcolor` is
+        only used to leave out edges that can't be seen against it, with `lod`.)
+        With `through_traffic` (for each row of Ge), the edges are drawn with that
+        instead of their own, still scaled to the busiest edge of the motorshed,
+        and the ones without any are left out (e.g., for the frames of an
+        animation; see `animation`)."""
+        return Layer(self, max_edge_width, cmap, bgcolor, through_traffic)
+
+    def render(
+        self,
+        bgcolor="black",
+        max_edge_width=None,
+        cmap=matplotlib.cm.magma,
+        out=None,
+        through_traffic=None,
+    ):
+        """Render the motorshed with a style (see `render_layer` and `layer`), into
+        `out`, if given, and return it (an RGBA image)."""
+        layer = self.layer(max_edge_width, cmap, bgcolor, through_traffic)
+        with Timer(prefix="Render layer (numpy)"):
+            if out is None:
+                out = np.empty((self.size, self.size, 4), dtype=np.uint8)
+            out[:] = background(bgcolor)
+            layer.draw(out)
+        return out
+
+    def render_batch(self, styles, n_workers=None):
+        """Render the motorshed in each of the `styles` (dicts of `render`'s
+        arguments, e.g., dict(cmap=render_mpl.cm_red)), on a pool of `n_workers`
+        processes (default: one per CPU; 1 means don't use a pool), and return the
+        images, in the same order."""
+        n_workers = min(n_workers or os.cpu_count(), len(styles))
+        if n_workers <= 1:
+            return [self.render(**style) for style in styles]
+
+        # (The session is sent to each worker once, not once per style.)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_session_worker_init,
+            initargs=(self,),
+        ) as executor:
+            return list(executor.map(_session_worker, styles))
+
+
+class Layer:
+    """A `RenderSession`'s edges, styled (see `render_mpl.style_edges`) and in
+    pixels, and the rings around its center node, ready to be drawn into all of the
+    canvas, or just a band of rows of it (see `render_poster`)."""
+
+    def __init__(
+        self,
+        session,
+        max_edge_width=None,
+        cmap=matplotlib.cm.magma,
+        bgcolor="black",
+        through_traffic=None,
+    ):
+        # If needed, use the guess of a good edge width.
+        if max_edge_width is None:
+            max_edge_width = session.max_edge_width
+        self.size, self.box = session.size, session.box
+
+        traffic = session.traffic
+        if through_traffic is not None:
+            traffic = np.asarray(through_traffic, dtype=float)[session.ge_row]
+        traffic = traffic[session.edge]
+        widths, intensity = render_mpl.edge_style(
+            traffic, session.max_traffic, max_edge_width
+        )
+        # (Looked up in the cmap's table once, not once per edge.)
+        colors = cmap(np.arange(256))[:, :3] * 255
+        self.radius = widths * session.pixels_per_point / 2
+        self.colors = colors[intensity]
+        self.segments = session.segments
+        y_min, y_max = session.y_range
+
+        # Without the ones that aren't there (yet), or (with lod) that can't be
+        #  seen, in this style.
+        keep = traffic != 0
+        if session.lod:
+            keep &= visible(
+                self.radius, self.colors, background(bgcolor), session.length_px
+            )
+        if not keep.all():
+            self.radius, self.colors = self.radius[keep], self.colors[keep]
+            self.segments, y_min, y_max = self.segments[keep], y_min[keep], y_max[keep]
+        # (The rows that each one reaches, to find the ones in a band.)
+        self.rows = y_min - self.radius - 1, y_max + self.radius + 1
+
+        # The 'center node', drawn over the edges.
+        cx, cy = session.center
+        self.rings = [
+            (
+                np.array([[cx, cy, cx, cy]]),
+                np.array([ring_radius * session.ring_scale]),
+                np.array([colors[value]]),
+                alpha,
+            )
+            for ring_radius, value, alpha in render_mpl.CENTER_RINGS
+        ]
+
+    def draw(self, out, top=0):
+        """Draw the layer over `out` (in place), which is the rows of the canvas
+        from `top` on (all of it, by default)."""
+        shift = np.array([0, top, 0, top])
+        left, box_top, right, box_bottom = self.box
+        clip = (left, box_top - top, right, box_bottom - top)
+
+        in_band = np.flatnonzero(
+            (self.rows[1] >= top) & (self.rows[0] < top + len(out))
+        )
+        draw_segments(
+            out,
+            self.segments[in_band] - shift,
+            self.radius[in_band],
+            self.colors[in_band],
+            clip=clip,
+        )
+        for segments, radius, colors, alpha in self.rings:
+            draw_segments(out, segments - shift, radius, colors, alpha, clip=clip)
+
+
+def canvas_transform(Gn, size, dpi):
+    """The function that maps (x, y) (map coordinates) to (column, row) (pixels)
+    on a `size` x `size` canvas, as matplotlib lays it out (see above), with its
+    meters-to-pixels factor as `.scale`, and the map's box (left, top, right,
+    bottom, in pixels) as `.box`."""
+    pad = PAD_POINTS * dpi / 72
+    x_min, x_max = Gn.x.min(), Gn.x.max()
+    y_min, y_max = Gn.y.min(), Gn.y.max()
+    scale = (size - 2 * pad) / max(x_max - x_min, y_max - y_min)
+    # (Centered, in whichever direction the map is smaller.)
+    left = (size - (x_max - x_min) * scale) / 2
+    top = (size - (y_max - y_min) * scale) / 2
+
+    def to_pixels(x, y):
+        return left + (x - x_min) * scale, top + (y_max - y) * scale
+
+    to_pixels.scale = scale
+    # (matplotlib clips everything to the map's box.)
+    to_pixels.box = (
+        left,
+        top,
+        left + (x_max - x_min) * scale,
+        top + (y_max - y_min) * scale,
+    )
+    return to_pixels
+
+
+def draw_segments(out, segments, radius, colors, alpha=1.0, clip=None):
+    """Draw line segments with round caps, antialiased, over the RGBA image `out`
+    (a uint8 array, in place; it can be a pane of a wider one, see
+    `compositing.Canvas`), in order. `segments` are (x1, y1, x2, y2) in pixels (a
+    zero-length one is a disc), `radius` is half of the width of each one
+    (pixels), and `colors` are RGB, 0-255. Nothing is drawn outside of the `clip`
+    box (left, top, right, bottom, in pixels; default: the whole image). Where
+    `out` is transparent, what's drawn is premultiplied by its alpha (coverage)."""
+    height, width = out.shape[:2]
+    pixels, pitch = _pixels_u32(out)
+    # (The clip box can be bigger than the image, e.g., when it's a band of one.)
+    clip_left, clip_top, clip_right, clip_bottom = (
+        np.round(clip if clip is not None else (0, 0, width, height))
+        .astype(np.int64)
+        .clip(0, [width, height, width, height])
+    )
+    x1, y1, x2, y2 = np.asarray(segments, dtype=np.float32).T
+    radius = np.asarray(radius, dtype=np.float32)
+    # (As RGBA uint32s, see `_paint_in_order`.)
+    colors = np.round(np.asarray(colors, dtype=float)).astype(np.uint8)
+    colors = np.hstack([colors, np.full((len(colors), 1), 255, np.uint8)])
+    colors = colors.view(np.uint32).ravel()
+
+    # The box of pixels that each segment might cover (clipped): the ones with
+    #  their centers less than radius + 1/2 away from it.
+    reach = radius + 0.5
+    left = np.floor(np.minimum(x1, x2) - reach).clip(clip_left, clip_right)
+    right = np.ceil(np.maximum(x1, x2) + reach).clip(clip_left, clip_right)
+    top = np.floor(np.minimum(y1, y2) - reach).clip(clip_top, clip_bottom)
+    bottom = np.ceil(np.maximum(y1, y2) + reach).clip(clip_top, clip_bottom)
+    left, top = left.astype(np.int64), top.astype(np.int64)
+    box_width = right.astype(np.int64) - left
+    box_height = bottom.astype(np.int64) - top
+    n_pixels = box_width * box_height
+    if not n_pixels.sum():
+        return
+
+    # Where the segments are, from the corners of their boxes.
+    x1, x2 = x1 - left, x2 - left
+    y1, y2 = y1 - top, y2 - top
+
+    # Batches of segments, of about BATCH_PIXELS pixels each.
+    drawable = np.flatnonzero(n_pixels)
+    ends = np.cumsum(n_pixels[drawable])
+    breaks = np.searchsorted(ends, np.arange(BATCH_PIXELS, ends[-1], BATCH_PIXELS))
+    first = np.empty(height * width, dtype=np.int32)
+    for batch in np.split(drawable, np.unique(breaks) + 1):
+        if not len(batch):
+            continue
+
+        # The segments with the same size of box are done together, as 3-D arrays
+        #  (segment, row, column) of the pixels of their boxes.
+        shape = box_width[batch] * (box_height.max() + 1) + box_height[batch]
+        order = np.argsort(shape, kind="stable")
+        found = []
+        for same in np.split(batch[order], np.flatnonzero(np.diff(shape[order])) + 1):
+            w, h = box_width[same[0]], box_height[same[0]]
+            # Distance from each pixel's center to the segment -> coverage.
+            px = np.arange(w, dtype=np.float32) + 0.5 - x1[same, None, None]
+            py = np.arange(h, dtype=np.float32)[:, None] + 0.5 - y1[same, None, None]
+            dx = (x2 - x1)[same, None, None]
+            dy = (y2 - y1)[same, None, None]
+            length2 = dx * dx + dy * dy
+            t = (px * dx + py * dy) / np.where(length2 > 0, length2, 1)
+            t = t.clip(0, 1)
+            distance = np.hypot(px - t * dx, py - t * dy)
+            coverage = (radius[same, None, None] + 0.5 - distance).clip(0, 1)
+
+            i, row, column = np.nonzero(coverage > 0)
+            seg = same[i]
+            pixel = (top[seg] + row) * width + left[seg] + column
+            found.append((pixel, seg, coverage[i, row, column]))
+        pixel, seg, coverage = (np.concatenate(a) for a in zip(*found))
+        # (Where they are in `pixels`, if that's not the same.)
+        address = pixel if pitch == width else pixel + pixel // width * (pitch - width)
+        _paint_in_order(pixels, pixel, seg, coverage * alpha, colors, first, address)
+
+
+def _pixels_u32(out):
+    """The pixels of `out` (an RGBA uint8 image, or a view of one, with its rows of
+    pixels `pitch` pixels apart) as one flat array of uint32s, and `pitch`: pixel
+    (row, column) is at row * pitch + column."""
+    height, width = out.shape[:2]
+    if (
+        out.dtype != np.uint8
+        or out.shape[2:] != (4,)
+        or out.strides[1:] != (4, 1)
+        or out.strides[0] % 4
+    ):
+        raise ValueError("Can only draw into RGBA (uint8) images, a row at a time.")
+    pitch = out.strides[0] // 4
+    pixels = np.lib.stride_tricks.as_strided(
+        out.view(np.uint32), shape=(max(height - 1, 0) * pitch + width,), strides=(4,)
+    )
+    return pixels, pitch
+
+
+def _paint_in_order(pixels, pixel, seg, coverage, colors, first, address):
+    """Paint (over) each `pixel` (numbered row by row; it's at `address` in
+    `pixels`, the image as one uint32 per RGBA pixel) with the color of `seg`
+    (also RGBA, as uint32s), by how much `coverage` (0-1) it has, in order of
+    `seg` where several segments cover the same pixel. That's done in rounds:
+    each pixel is painted with the first of the segments that are left over it,
+    and so on. (`first` is scratch space, an int array with room for every
+    pixel.)"""
+    coverage = coverage[:, None]
+    while len(pixel):
+        first[pixel] = len(colors)
+        np.minimum.at(first, pixel, seg)
+        now = seg == first[pixel]
+        at, a = address[now], coverage[now]
+        # (Whole pixels are moved around as uint32s, which is a lot faster than
+        #  as rows of bytes. Alpha is painted over like the colors are, so where
+        #  it's transparent, they're premultiplied.)
+        rgba = pixels[at].view(np.uint8).reshape(-1, 4)
+        color = colors[seg[now]].view(np.uint8).reshape(-1, 4)
+        blended = rgba.astype(np.float32)
+        blended += (color - blended) * a
+        rgba[:] = blended + 0.5  # (rounded)
+        pixels[at] = rgba.view(np.uint32).ravel()
+        # (Most pixels are only covered once, so the first round is most of it.)
+        later = ~now
+        pixel, seg, coverage = pixel[later], seg[later], coverage[later]
+        address = address[later]
+
+
+_session = None
+
+
+def _session_worker_init(session):
+    global _session
+    _session = session
+
+
+def _session_worker(style):
+    return _session.render(**style)
@@ -0,0 +1,128 @@
+"""A persistent store of everything we've worked out about the routes to (or from)
+an origin node: the transit time of every node, and the next step 'w' of every
+edge (u, v). It's keyed by origin node, routing profile and direction, not by
+request, so a later run for the same center (e.g., a bigger map, or a re-render)
+loads what's already known, and only has to query what's new.
+
+It's a SQLite database (in the cache directory by default; see
+`config.ROUTING_STORE`), with one row per node and one row per edge."""
+
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from motorshed import config
+from motorshed.algos import compact
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transit_times (
+    origin INTEGER, profile TEXT, towards INTEGER, node INTEGER, transit_time REAL,
+    PRIMARY KEY (origin, profile, towards, node)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS successors (
+    origin INTEGER, profile TEXT, towards INTEGER, u INTEGER, v INTEGER, w INTEGER,
+    PRIMARY KEY (origin, profile, towards, u, v)
+) WITHOUT ROWID;
+"""
+
+
+class RoutingStore:
+    """The routing store in the SQLite file `path` (default: `config.ROUTING_STORE`).
+    `profile` is whatever identifies how the routes were calculated (e.g.,
+    "osrm/driving"); results from different profiles are kept apart."""
+
+    def __init__(self, path=None):
+        self.path = path or config.ROUTING_STORE
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def _select(self, sql, args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _insert(self, sql, rows):
+        with self._lock, self._db:
+            self._db.executemany(sql, rows)
+
+    def load_transit_times(self, origin, nodes, towards_origin=True, profile=""):
+        """Known transit times of `nodes` (node IDs). Returns (times, known): the
+        transit times (NaN where unknown, or unreachable), and which ones we know."""
+        rows = self._select(
+            "SELECT node, transit_time FROM transit_times"
+            " WHERE origin=? AND profile=? AND towards=?",
+            (int(origin), profile, int(towards_origin)),
+        )
+        times = pd.Series(dict(rows), dtype=float)
+        times = times.reindex(np.asarray(nodes, dtype=np.int64)).to_numpy(
+            float, copy=True
+        )
+        known = ~np.isnan(times)
+        # (Unreachable nodes are stored as infinitely far away.)
+        times[np.isinf(times)] = np.nan
+        return times, known
+
+    def save_transit_times(self, origin, nodes, times, towards_origin=True, profile=""):
+        """Remember the transit times of `nodes` (NaN means unreachable)."""
+        times = np.asarray(times, dtype=float)
+        key = (int(origin), profile, int(towards_origin))
+        rows = (
+            key + (node, np.inf if np.isnan(t) else t)
+            for node, t in zip(np.asarray(nodes, dtype=np.int64).tolist(), times)
+        )
+        self._insert("INSERT OR REPLACE INTO transit_times VALUES (?,?,?,?,?)", rows)
+
+    def load_successors(self, origin, towards_origin=True, profile=""):
+        """The known routings, as arrays (u, v, w) of node IDs (in the direction of
+        the routing, as in Ge)."""
+        rows = self._select(
+            "SELECT u, v, w FROM successors WHERE origin=? AND profile=? AND towards=?",
+            (int(origin), profile, int(towards_origin)),
+        )
+        u, v, w = np.array(rows, dtype=np.int64).reshape(-1, 3).T
+        return u, v, w
+
+    def save_successors(self, origin, Ge, towards_origin=True, profile=""):
+        """Remember the routing of every edge of Ge that goes on to another edge.
+        (Not the sinks: an edge that leaves the map might not, on a bigger map.)"""
+        graph = compact.graph_of(Ge)
+        successor = compact.successors_of(Ge, graph)
+        routed = successor >= 0
+        u = graph.node_ids[graph.ui[routed]]
+        v = graph.node_ids[graph.vi[routed]]
+        w = graph.node_ids[graph.vi[successor[routed]]]
+        key = (int(origin), profile, int(towards_origin))
+        rows = (key + edge for edge in zip(u.tolist(), v.tolist(), w.tolist()))
+        self._insert("INSERT OR REPLACE INTO successors VALUES (?,?,?,?,?,?)", rows)
+
+    def apply_successors(self, origin, Ge, towards_origin=True, profile=""):
+        """Route the edges of Ge (in place) that we know the routing of, as long as
+        their next edge (v, w) is in Ge too. Returns how many edges were routed."""
+        u, v, w = self.load_successors(origin, towards_origin, profile)
+        graph = compact.graph_of(Ge)
+        successor = compact.successors_of(Ge, graph)
+
+        edges = graph.find_edges(graph.node_index(u), graph.node_index(v))
+        next_edges = graph.find_edges(graph.node_index(v), graph.node_index(w))
+        known = (edges >= 0) & (next_edges >= 0)
+        successor[edges[known]] = next_edges[known]
+
+        compact.set_successors(Ge, graph, successor)
+        return known.sum()
+
+
+_store = None
+
+
+def get_store():
+    """The shared RoutingStore (in `config.ROUTING_STORE`)."""
+    global _store
+    if _store is None:
+        _store = RoutingStore()
+    return _store
@@ -0,0 +1,125 @@
+"""Compare loading a map from the old cache (a bz2 pickle of the networkx graph) with
+the columnar graph cache (`motorshed.graph_cache`): load time, and peak memory
+(RSS), each in a fresh process. (Linux only: memory use comes from /proc.)
+
+    python -m motorshed.scripts.benchmark_graph_cache [grid size, default 300]
+
+The map is a synthetic street grid (grid size x grid size nodes), with the same
+kinds of attributes (and edge geometries) as the maps from `overpass.get_map`."""
+
+import bz2
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+import networkx as nx
+import numpy as np
+from contexttimer import Timer
+from shapely.geometry import LineString
+
+from motorshed import graph_cache
+
+# Each of these runs in its own process, and prints (seconds, peak RSS in MB, and
+#  how much of that is more than just the imports). (ru_maxrss would include
+#  whatever this process used, so it's from /proc instead.)
+_MEASURE = """
+import sys, time
+def rss(field):
+    status = open("/proc/self/status").read()
+    return int(status.split(field + ":")[1].split()[0]) / 1024
+rss0 = rss("VmRSS")
+t0 = time.perf_counter()
+%s
+print(time.perf_counter() - t0, rss("VmHWM"), rss("VmHWM") - rss0)
+"""
+_IMPORTS = "import bz2, pickle; from motorshed import graph_cache; from motorshed.algos import gen2"
+LOADERS = {
+    "(just the imports)": "pass",
+    "pickle -> networkx": "G = pickle.load(bz2.BZ2File(sys.argv[1] + '.pkl.bz2'))",
+    "pickle -> networkx -> dataframes": (
+        "G = pickle.load(bz2.BZ2File(sys.argv[1] + '.pkl.bz2'))\n"
+        "Gn, Ge = gen2.create_initial_dataframes(G)"
+    ),
+    "columnar -> networkx": (
+        "G = graph_cache.load_graph('map', cache_dir=sys.argv[1]).to_networkx()"
+    ),
+    "columnar -> dataframes": (
+        "G = graph_cache.load_graph('map', cache_dir=sys.argv[1])\n"
+        "Gn, Ge = gen2.create_initial_dataframes(G)"
+    ),
+    "columnar -> lean dataframes": (
+        "G = graph_cache.load_graph('map', cache_dir=sys.argv[1])\n"
+        "Gn, Ge = gen2.create_initial_dataframes(G, lean=True)"
+    ),
+}
+
+
+def make_map(n):
+    G = nx.MultiDiGraph(crs="epsg:32610")
+    for i in range(n):
+        for j in range(n):
+            node = 10_000_000 + i * n + j
+            G.add_node(
+                node,
+                osmid=node,
+                x=j * 100.0,
+                y=i * 100.0,
+                lat=37.5 + i / 1110,
+                lon=-122.3 + j / 880,
+                calculated=False,
+                highway="traffic_signals" if (i * j) % 17 == 0 else np.nan,
+            )
+    for node in list(G.nodes):
+        i, j = divmod(node - 10_000_000, n)
+        for i2, j2 in ((i, j + 1), (i + 1, j)):
+            if i2 < n and j2 < n:
+                node2 = 10_000_000 + i2 * n + j2
+                geometry = LineString([(j * 100, i * 100), (j2 * 100, i2 * 100)])
+                data = dict(
+                    osmid=node * 10 + i2,
+                    name="Street %d" % (i if i2 == i else j),
+                    highway="secondary" if i % 10 == 0 else "residential",
+                    oneway=False,
+                    length=100.0,
+                    through_traffic=1,
+                    geometry=geometry,
+                )
+                G.add_edge(node, node2, **data)
+                G.add_edge(node2, node, **data)
+    return G
+
+
+def main(n=300):
+    with Timer(prefix="Make a %d x %d grid map" % (n, n)):
+        G = make_map(n)
+    print("%d nodes, %d edges" % (G.number_of_nodes(), G.number_of_edges()))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base = os.path.join(tmp_dir, "map")
+        with Timer(prefix="Save as a bz2 pickle"):
+            with bz2.BZ2File(base + ".pkl.bz2", "wb") as f:
+                pickle.dump(G, f, pickle.HIGHEST_PROTOCOL)
+        with Timer(prefix="Save as columns"):
+            graph_cache.save_graph("map", G, cache_dir=tmp_dir)
+        del G
+
+        print(
+            "%-35s %10s %14s %14s" % ("Load", "seconds", "peak RSS, MB", "for the map")
+        )
+        for name, loader in LOADERS.items():
+            code = _IMPORTS + "\n" + _MEASURE % loader
+            arg = base if "pickle" in loader else tmp_dir
+            out = subprocess.run(
+                [sys.executable, "-c", code, arg],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            seconds, rss, map_rss = map(float, out.split()[-3:])
+            print("%-35s %10.2f %14.0f %14.0f" % (name, seconds, rss, map_rss))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,94 @@
+"""Compare rendering a layer with matplotlib (`render_mpl.render_layer`) and with the
+numpy rasterizer (`render_np.render_layer`): render time, and peak memory (RSS),
+each in a fresh process. (Linux only: memory use comes from /proc.) Also prints
+how different the two images are.
+
+    python -m motorshed.scripts.benchmark_render [grid size, default 500] [dpi, default 300]
+
+The map is a synthetic street grid (grid size x grid size nodes, so about 4 x grid
+size**2 edges), with made-up traffic, already in the dataframes (Gn, Gge) that
+`pipeline.motorshed` returns."""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Each of these runs in its own process, and prints (seconds, peak RSS in MB, and
+#  how much of that is more than loading the map).
+_MEASURE = """
+import sys, time
+import numpy as np, pandas as pd
+from motorshed import render_mpl, render_np
+def rss(field):
+    status = open("/proc/self/status").read()
+    return int(status.split(field + ":")[1].split()[0]) / 1024
+Gn = pd.read_pickle(sys.argv[1] + "/Gn.pkl")
+Gge = pd.read_pickle(sys.argv[1] + "/Gge.pkl")
+center_node, dpi = int(sys.argv[2]), int(sys.argv[3])
+rss0 = rss("VmRSS")
+t0 = time.perf_counter()
+rgba_arr = %s.render_layer(Gn, Gge, center_node, dpi=dpi)
+print(time.perf_counter() - t0, rss("VmHWM"), rss("VmHWM") - rss0)
+np.save(sys.argv[1] + "/%s.npy", rgba_arr)
+"""
+RENDERERS = ["render_mpl", "render_np"]
+
+
+def make_motorshed(n, seed=0):
+    """Gn and Gge of an n x n street grid, 100 m apart, with two-way streets, and
+    traffic that grows towards the center."""
+    rng = np.random.default_rng(seed)
+    i, j = np.divmod(np.arange(n * n), n)
+    node_ids = 10_000_000 + np.arange(n * n)
+    Gn = pd.DataFrame(dict(x=j * 100.0, y=i * 100.0), index=node_ids)
+
+    east = np.flatnonzero(j < n - 1)
+    north = np.flatnonzero(i < n - 1)
+    u = np.concatenate([east, east + 1, north, north + n])
+    v = np.concatenate([east + 1, east, north + n, north])
+    distance = np.hypot(i[u] - n / 2, j[u] - n / 2) + 1
+    traffic = np.round(n * n / distance**1.5 * rng.uniform(0.5, 1.5, len(u)))
+    Gge = pd.DataFrame(
+        dict(u=node_ids[u], v=node_ids[v], through_traffic=traffic.astype(int))
+    )
+    center_node = int(node_ids[(n // 2) * n + n // 2])
+    return Gn, Gge, center_node
+
+
+def main(n=500, dpi=300):
+    Gn, Gge, center_node = make_motorshed(n)
+    print("%d nodes, %d edges, rendered at %d dpi" % (len(Gn), len(Gge), dpi))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        Gn.to_pickle(os.path.join(tmp_dir, "Gn.pkl"))
+        Gge.to_pickle(os.path.join(tmp_dir, "Gge.pkl"))
+        del Gn, Gge
+
+        print(
+            "%-15s %10s %14s %14s"
+            % ("Renderer", "seconds", "peak RSS, MB", "to render")
+        )
+        for renderer in RENDERERS:
+            code = _MEASURE % (renderer, renderer)
+            out = subprocess.run(
+                [sys.executable, "-c", code, tmp_dir, str(center_node), str(dpi)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            seconds, rss, render_rss = map(float, out.split()[-3:])
+            print("%-15s %10.2f %14.0f %14.0f" % (renderer, seconds, rss, render_rss))
+
+        images = [np.load(os.path.join(tmp_dir, r + ".npy")) for r in RENDERERS]
+        print(
+            "Mean difference between the images: %.2f (of 255)"
+            % np.abs(np.subtract(*images, dtype=float)).mean()
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,52 @@
+import numpy as np
+
+from motorshed.algos import compact, gen2
+
+
+def test_compact_graph(grid_map):
+    G, center_node, origin_point = grid_map
+    Gn, Ge = gen2.create_initial_dataframes(G)
+
+    graph = compact.graph_of(Ge)
+    assert graph is Ge.attrs["graph"]
+    assert (graph.node_ids == np.sort(Gn.index)).all()
+    assert (graph.node_ids[graph.ui] == Ge.u).all()
+    assert (graph.node_ids[graph.vi] == Ge.v).all()
+
+    # Every edge can be found by its nodes, and the CSR out-edges are right.
+    assert (graph.find_edges(graph.ui, graph.vi) == np.arange(len(Ge))).all()
+    for i in range(graph.n_nodes):
+        out = graph.out_edges[graph.indptr[i] : graph.indptr[i + 1]]
+        assert set(out) == set(np.flatnonzero(graph.ui == i))
+    assert (graph.node_index([-5, graph.node_ids[3]]) == [-1, 3]).all()
+
+
+def test_successors_round_trip(grid_map):
+    G, center_node, origin_point = grid_map
+    Gn, Ge = gen2.create_initial_dataframes(G)
+    graph = compact.graph_of(Ge)
+
+    successor = np.full(graph.n_edges, compact.UNROUTED, dtype=compact.ID_DTYPE)
+    successor[:5] = compact.SINK
+    for e in range(5, graph.n_edges):
+        out = graph.out_edges[graph.indptr[graph.vi[e]] : graph.indptr[graph.vi[e] + 1]]
+        if len(out):
+            successor[e] = out[0]
+
+    w = graph.next_nodes(successor)
+    assert (w[:5] == -1).all()
+    assert (graph.successors(w) == successor).all()
+
+
+def test_graph_of_filtered_frame(grid_map):
+    G, center_node, origin_point = grid_map
+    Gn, Ge = gen2.create_initial_dataframes(G)
+
+    # Without one of the nodes (and its edges), the attached graph doesn't match
+    #  any more, and we get a new one that does.
+    Ge2 = Ge[(Ge.u != center_node) & (Ge.v != center_node)]
+    graph = compact.graph_of(Ge2)
+    assert graph is not Ge.attrs["graph"]
+    assert center_node not in graph.node_ids
+    assert (graph.node_index(Ge2.u) >= 0).all()
+    assert (graph.find_edges(graph.ui, graph.vi) == np.arange(len(Ge2))).all()
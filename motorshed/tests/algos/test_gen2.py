@@ -1,3 +1,5 @@
+import numpy as np
+import pandas as pd
 import pytest
 
 from motorshed import osrm
@@ -64,7 +66,7 @@ def test_gen2_routing_r(lebanon_map):
     Gn, Ge = gen2.create_initial_dataframes(G, towards_origin=False)
 
     assert Gn.shape[1] == 10
-    assert Ge.shape[1] == 17
+    assert Ge.shape[1] == 21  # + ui, vi, road_class, speed_mps
     assert len(Gn)
     assert len(Ge)
 
@@ -85,3 +87,234 @@ def test_gen2_routing_r(lebanon_map):
 
     assert (Gge[Gge.ignore == False].through_traffic >= 0).all()
     assert (Gge["current_traffic"] == 0).all()
+
+
+def noisy_transit_times(G, center_node, sigma=8, seed=0):
+    """Transit times with some noise added, so that initial_routing can't do it
+    all."""
+    from motorshed import local_routing
+
+    local_routing.get_transit_times(G, center_node)
+    rng = np.random.default_rng(seed)
+    for node in G.nodes:
+        if node != center_node:
+            G.nodes[node]["transit_time"] += rng.normal(0, sigma)
+
+
+def test_followup_heuristic_routing(grid_map):
+    G, center_node, origin_point = grid_map
+    noisy_transit_times(G, center_node)
+
+    Gn, Ge = gen2.create_initial_dataframes(G)
+    Ge2, Gn2 = gen2.initial_routing(Ge.copy(), Gn.copy())
+    ambiguous = (Ge2.w == 0) & (Ge2.ignore == False)
+    assert ambiguous.any()
+
+    Ge3, Gn3 = gen2.followup_heuristic_routing(Ge2.copy(), Gn2.copy())
+
+    # Edges that were already routed are left alone...
+    assert (Ge3.w[~ambiguous] == Ge2.w[~ambiguous]).all()
+    # ... and the ones that we fixed now continue on to a real edge (v, w).
+    fixed = Ge3[ambiguous & (Ge3.w != 0)]
+    assert len(fixed) > ambiguous.sum() / 2
+    edges = set(Ge3.index)
+    assert all(
+        (v, w) in edges for v, w in zip(fixed.index.get_level_values("v"), fixed.w)
+    )
+
+
+def route_one_at_a_time(Ge, max_depth=3):
+    """The follow-up routing, done the slow way: one ambiguous edge at a time,
+    farthest first, each taking the most efficient option (the first one, on a
+    tie) at the shallowest depth that has one. Returns the new w's."""
+    w = Ge.w.to_dict()
+    end_time = Ge.end_time.to_dict()
+    # (Not `Ge.length`: that's the GeoDataFrame's geometries' lengths.)
+    length = Ge["length"].to_dict()
+    out_edges = {}
+    for u, v in Ge.index:
+        out_edges.setdefault(u, []).append((u, v))
+
+    def options(edge, depth):
+        # (Every way on from `edge`, `depth` steps deep, depth-first, following
+        #  the edges that are already routed.)
+        next_edges = [e for e in out_edges.get(edge[1], []) if w[edge] in (0, e[1])]
+        if depth == 0 or not next_edges:
+            return [[edge]]
+        return [[edge] + option for e in next_edges for option in options(e, depth - 1)]
+
+    to_fix = Ge[(Ge.w == 0) & ~Ge.ignore]
+    for edge in to_fix.sort_values("end_time", ascending=False, kind="stable").index:
+        if w[edge] != 0:
+            continue
+        for depth in range(1, max_depth + 1):
+            best = None
+            for option in options(edge, depth):
+                dt = end_time[option[-1]] - end_time[edge]
+                efficiency = dt / sum(length[e] for e in option)
+                if dt < 0 and (best is None or efficiency < best[0]):
+                    best = efficiency, option
+            if best is not None:
+                for step, next_step in zip(best[1][:-1], best[1][1:]):
+                    w[step] = next_step[1]
+                break
+    return pd.Series(w).loc[Ge.index]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_followup_heuristic_routing_one_at_a_time(seed):
+    from motorshed.tests.conftest import make_grid_graph
+
+    # (Lots of noise, so that the ambiguous edges' options overlap, and the order
+    #  they're routed in matters.)
+    G = make_grid_graph(8)
+    noisy_transit_times(G, 1000 + 4 * 8 + 4, sigma=40, seed=seed)
+    Gn, Ge = gen2.create_initial_dataframes(G)
+    Ge2, Gn2 = gen2.initial_routing(Ge.copy(), Gn.copy())
+
+    Ge3, Gn3 = gen2.followup_heuristic_routing(Ge2.copy(), Gn2.copy())
+    assert (Ge3.w.to_numpy() == route_one_at_a_time(Ge2).to_numpy()).all()
+
+
+def test_followup_heuristic_routing_ties():
+    import networkx as nx
+
+    # 1 -> 2 -> 3, and then on, via 4 (short) or 5 (long), to somewhere closer.
+    #  Neither (1, 2) nor (2, 3) gets any closer in one step, and they're tied (2
+    #  and 3 are just as far away). (1, 2) is routed first, so it decides where
+    #  (2, 3) goes (via 5), even though (2, 3) finds its own way (via 4) sooner.
+    G = nx.MultiDiGraph(crs="epsg:32610")
+    transit_times = {1: 20, 2: 10, 3: 10, 4: 15, 5: 15, 6: 9, 7: 0}
+    for node, transit_time in transit_times.items():
+        G.add_node(
+            node,
+            osmid=node,
+            x=node * 10.0,
+            y=0.0,
+            lat=37.55,
+            lon=-122.27 + node / 1e4,
+            calculated=True,
+            highway=np.nan,
+            transit_time=transit_time,
+        )
+    for u, v, length in [
+        (1, 2, 100),
+        (2, 3, 1),
+        (3, 4, 1),
+        (4, 6, 1),
+        (3, 5, 20),
+        (5, 7, 20),
+    ]:
+        G.add_edge(
+            u,
+            v,
+            key=0,
+            osmid=u * 10 + v,
+            highway="residential",
+            maxspeed=np.nan,
+            oneway=True,
+            length=float(length),
+            through_traffic=1,
+        )
+
+    Gn, Ge = gen2.create_initial_dataframes(G)
+    Ge2, Gn2 = gen2.initial_routing(Ge.copy(), Gn.copy())
+    assert (Ge2.w.loc[[(1, 2), (2, 3)]] == 0).all()
+
+    Ge3, Gn3 = gen2.followup_heuristic_routing(Ge2.copy(), Gn2.copy())
+    assert Ge3.w[(1, 2)] == 3 and Ge3.w[(2, 3)] == 5
+    assert (Ge3.w == route_one_at_a_time(Ge2)).all()
+
+
+def test_propagate_edges(grid_map):
+    G, center_node, origin_point = grid_map
+    from motorshed import pipeline
+
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="local")
+
+    assert (Gge["current_traffic"] == 0).all()
+    assert Gge.attrs["cycles"] == []
+
+    # Compare with following each edge's traffic all the way, one step at a time.
+    Ge = Gge.set_index(["u", "v"])
+    spawn = Ge["length"] / 50 * 5  # the grid is all residential/secondary
+    expected = pd.Series(0.0, index=Ge.index)
+    for edge in Ge.index:
+        for i in range(len(Ge)):
+            expected[edge] += spawn[edge]
+            w = Ge.w[edge]
+            if w <= 0:
+                break
+            edge = (Ge.v2[edge], w)
+    assert np.allclose(Ge.through_traffic, expected.loc[Ge.index])
+
+
+def test_lean_dataframes(grid_map, monkeypatch):
+    G, center_node, origin_point = grid_map
+    from motorshed import config, pipeline
+
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="local")
+    monkeypatch.setattr(config, "LEAN_DATAFRAMES", True)
+    Gn_lean, Gge_lean = pipeline.motorshed(G, center_node, backend="local")
+
+    assert "osmid" not in Gn_lean.columns and "maxspeed" not in Gge_lean.columns
+    assert Gn_lean.x.dtype == np.float32 and Gn_lean.transit_time.dtype == np.float32
+    assert Gge_lean["length"].dtype == np.float32
+    assert (Gge_lean.road_class == gen2.ROAD_CLASS["residential"]).sum() == (
+        Gge.highway == "residential"
+    ).sum()
+    # The same speeds, routes and traffic.
+    assert np.allclose(Gge_lean.speed_mps, Gge.speed_mps)
+    assert (Gge_lean.w.to_numpy() == Gge.w.to_numpy()).all()
+    assert np.allclose(Gge_lean.through_traffic, Gge.through_traffic)
+
+
+def test_accumulate_traffic_cycles():
+    # 0 -> 1 -> 2 -> 3 -> 1 (a loop), and 4 -> 5 (no loop)
+    successor = np.array([1, 2, 3, 1, 5, -1])
+    end_time = np.array([50, 40, 10, 30, 20, 0.0])
+
+    through_traffic, cycles = gen2._accumulate_traffic(successor, np.ones(6), end_time)
+
+    assert len(cycles) == 1
+    # The loop is broken after edge 2 (the closest to the center).
+    assert list(cycles[0]) == [3, 1, 2]
+    assert list(through_traffic) == [1, 3, 4, 1, 1, 2]
+
+
+def test_followup_osrm_routing(grid_map, osrm_server, local_client):
+    G, center_node, origin_point = grid_map
+    from motorshed import local_routing
+
+    # The 'OSRM' routes are the local routing engine's.
+    node_ids, transit_time, next_node = local_routing.shortest_path_tree(G, center_node)
+    next_node = dict(zip(node_ids.tolist(), next_node.tolist()))
+
+    def router(start, end):
+        route = [local_routing.nearest_node(G, start)]
+        while next_node[route[-1]] > 0:
+            route.append(next_node[route[-1]])
+        return route
+
+    osrm_server.router = router
+
+    noisy_transit_times(G, center_node)
+    Gn, Ge = gen2.create_initial_dataframes(G)
+    Ge2, Gn2 = gen2.initial_routing(Ge.copy(), Gn.copy())
+    ambiguous = (Ge2.w == 0) & (Ge2.ignore == False)
+
+    Ge3 = gen2.followup_osrm_routing_parallel(
+        G, Ge2.copy(), Gn2, center_node, max_iter=10, client=local_client
+    )
+
+    assert not len(Ge3.query("w==0 and ignore==False"))
+    fixed = Ge3[ambiguous]
+    assert all(
+        w == next_node[v] for v, w in zip(fixed.index.get_level_values("v"), fixed.w)
+    )
+
+    # One call per node that we routed from, and none once everything is solved.
+    report = Ge3.attrs["osrm_routing"]
+    assert report["solved"] == ambiguous.sum() and report["unsolved"] == 0
+    assert report["calls"] == len(osrm_server.paths)
+    assert report["calls"] <= len(set(Ge2[ambiguous].index.get_level_values("v")))
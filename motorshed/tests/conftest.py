@@ -0,0 +1,181 @@
+import http.server
+import json
+import threading
+import urllib.parse
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from motorshed.osrm import decode_polyline
+
+
+def make_grid_graph(n=6, spacing_m=100.0):
+    """A small, synthetic, projected street grid that looks like what
+    `overpass.get_map` returns, so that tests can run without any network
+    access. Row 0 is a one-way street (heading east)."""
+    G = nx.MultiDiGraph(crs="epsg:32610")
+    lat0, lon0 = 37.55, -122.27
+    for i in range(n):
+        for j in range(n):
+            node = 1000 + i * n + j
+            x, y = j * spacing_m, i * spacing_m
+            G.add_node(
+                node,
+                osmid=node,
+                x=x,
+                y=y,
+                lat=lat0 + y / 111_000,
+                lon=lon0 + x / (111_000 * np.cos(np.radians(lat0))),
+                calculated=False,
+                highway="traffic_signals" if (i, j) == (2, 2) else np.nan,
+            )
+
+    def add_street(a, b, highway, maxspeed, oneway=False):
+        data = dict(
+            osmid=a * 10 + b,
+            highway=highway,
+            maxspeed=maxspeed,
+            oneway=oneway,
+            length=spacing_m,
+            through_traffic=1,
+        )
+        G.add_edge(a, b, key=0, **data)
+        if not oneway:
+            G.add_edge(b, a, key=0, **data)
+
+    for i in range(n):
+        for j in range(n):
+            node = 1000 + i * n + j
+            if j < n - 1:
+                highway = "secondary" if i == n // 2 else "residential"
+                add_street(
+                    node,
+                    node + 1,
+                    highway,
+                    "35 mph" if i == n // 2 else np.nan,
+                    oneway=(i == 0),
+                )
+            if i < n - 1:
+                add_street(node, node + n, "residential", np.nan)
+    return G
+
+
+@pytest.fixture()
+def grid_map():
+    G = make_grid_graph()
+    center_node = 1000 + 3 * 6 + 3
+    origin_point = (G.nodes[center_node]["lat"], G.nodes[center_node]["lon"])
+    return G, center_node, origin_point
+
+
+class FakeOSRMHandler(http.server.BaseHTTPRequestHandler):
+    """Answers OSRM 'route' and 'table' requests with made-up (but consistent)
+    results: the duration between two points is 1000 * |lon1 - lon2|.
+    Failures can be injected by adding HTTP status codes (or "bad json") to
+    `server.failures`; each request uses up one of them. Tables with more
+    than `server.max_table_size`**2 sources x destinations (if set) are refused,
+    like osrm-routed does. Routes go
+    through nodes 1, 2, 3, unless `server.router` is set to a function of the start
+    and end (lat, lon) that gives the node IDs of the route."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        with server.lock:
+            server.paths.append(self.path)
+            server.connections.add(self.client_address)
+            failure = server.failures.pop(0) if server.failures else None
+
+        if failure == "bad json":
+            return self.send_body(200, b'{"code": "Ok", "dura')
+        elif failure is not None:
+            return self.send_json(failure, {"code": "TooBig", "message": "failure"})
+
+        service, version, profile, coordinates = url.path.strip("/").split("/")
+        coordinates = urllib.parse.unquote(coordinates)
+        if coordinates.startswith("polyline("):
+            lat_lon = decode_polyline(coordinates[len("polyline(") : -1])
+        else:
+            lon_lat = [c.split(",") for c in coordinates.split(";")]
+            lat_lon = np.array(lon_lat, dtype=float)[:, ::-1]
+        lon = lat_lon[:, 1]
+        params = urllib.parse.parse_qs(url.query)
+        n_sources, n_destinations = (
+            len(params[name][0].split(";")) if name in params else len(lon)
+            for name in ("sources", "destinations")
+        )
+        if (
+            server.max_table_size
+            and n_sources * n_destinations > server.max_table_size**2
+        ):
+            return self.send_json(400, {"code": "TooBig", "message": "Too many"})
+
+        if service == "route":
+            nodes = server.router(*lat_lon) if server.router else [1, 2, 3]
+            body = {
+                "code": "Ok",
+                "routes": [
+                    {
+                        "duration": 1000 * abs(lon[1] - lon[0]),
+                        "legs": [{"annotation": {"nodes": nodes}}],
+                    }
+                ],
+            }
+        else:
+            durations = 1000 * np.abs(lon[:, None] - lon[None, :])
+            for name, axis in (("sources", 0), ("destinations", 1)):
+                if name in params:
+                    index = [int(i) for i in params[name][0].split(";")]
+                    durations = durations.take(index, axis=axis)
+            body = {"code": "Ok", "durations": durations.tolist()}
+
+        self.send_json(200, body)
+
+    def send_json(self, status, body):
+        self.send_body(status, json.dumps(body).encode())
+
+    def send_body(self, status, data):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def osrm_server():
+    """A local stand-in for an osrm-routed server. Yields the server; its URL is
+    `server.url`, and it records the requested paths and the client connections."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeOSRMHandler)
+    server.url = "http://127.0.0.1:%d" % server.server_address[1]
+    server.lock = threading.Lock()
+    server.paths = []
+    server.connections = set()
+    server.failures = []
+    server.max_table_size = None
+    server.router = None
+
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def local_client(osrm_server):
+    """An osrm.OSRMClient for the `osrm_server`."""
+    from motorshed import osrm
+
+    client = osrm.OSRMClient(osrm_server.url, max_in_flight=4, backoff_s=0.001)
+    yield client
+    client.close()
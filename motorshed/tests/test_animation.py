@@ -0,0 +1,64 @@
+import os
+
+import imageio.v2 as imageio
+import numpy as np
+import pytest
+
+from motorshed import animation, pipeline, render_np
+
+
+@pytest.fixture()
+def motorshed_layers(grid_map):
+    G, center_node, origin_point = grid_map
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="local")
+    return Gn, Gge, center_node
+
+
+def test_build_up_frames(motorshed_layers):
+    Gn, Gge, center_node = motorshed_layers
+    frames = list(animation.build_up_frames(Gge))
+    traffic = Gge.through_traffic.to_numpy(float)
+
+    # It only ever builds up, and ends up where `propagate_edges` did.
+    assert len(frames) > 2
+    assert all((b >= a).all() for a, b in zip(frames, frames[1:]))
+    assert np.allclose(frames[-1], traffic)
+    assert frames[0].sum() < traffic.sum()
+
+    sampled = list(animation.build_up_frames(Gge, n_frames=3))
+    assert len(sampled) == 3
+    assert np.array_equal(sampled[0], frames[0])
+    assert any(np.array_equal(sampled[1], frame) for frame in frames[1:-1])
+    assert np.array_equal(sampled[-1], frames[-1])
+
+
+def test_fill_in_frames(motorshed_layers):
+    Gn, Gge, center_node = motorshed_layers
+    frames = list(animation.fill_in_frames(Gn, Gge, n_frames=5))
+
+    assert len(frames) == 5
+    assert all((b >= a).all() for a, b in zip(frames, frames[1:]))
+    assert 0 < (frames[1] > 0).sum() < (frames[-1] > 0).sum()
+    assert np.array_equal(frames[-1], Gge.through_traffic.to_numpy(float))
+
+
+def test_save_animation(motorshed_layers, tmp_path):
+    Gn, Gge, center_node = motorshed_layers
+    session = render_np.RenderSession(Gn, Gge, center_node, canvas_inches=2, dpi=50)
+    frames = list(animation.fill_in_frames(Gn, Gge, n_frames=4))
+
+    # The last frame is the whole motorshed.
+    expected = session.render(max_edge_width=3)[..., :3]
+    for n_workers in (1, 2):
+        fn = os.path.join(tmp_path, "fill_in_%d.gif" % n_workers)
+        n_frames = animation.save_animation(
+            fn, session, iter(frames), n_workers=n_workers, max_edge_width=3
+        )
+        assert n_frames == 4
+
+        written = imageio.mimread(fn)
+        assert len(written) == 4
+        assert written[-1].shape[:2] == expected.shape[:2]
+        # (GIFs have a palette of 256 colors.)
+        assert np.abs(written[-1][..., :3].astype(int) - expected).mean() < 5
+        assert not np.array_equal(written[0], written[-1])
@@ -0,0 +1,104 @@
+import matplotlib
+import numpy as np
+import pytest
+
+matplotlib.use("Agg")
+
+from motorshed import compositing, pipeline, render_mpl, render_np
+
+
+@pytest.fixture()
+def sessions(grid_map):
+    G, center_node, origin_point = grid_map
+    Gn, Gge_to, Gge_from = pipeline.bidirectional_motorshed(
+        G, center_node, backend="local"
+    )
+    return [
+        render_np.RenderSession(Gn, Gge, center_node, dpi=50)
+        for Gge in (Gge_to, Gge_from)
+    ]
+
+
+def test_blend():
+    dst = np.array([[[10, 200, 0, 255], [100, 100, 100, 255]]], dtype=np.uint8)
+    src = np.array([[[20, 100, 0, 255], [0, 50, 100, 128]]], dtype=np.uint8)
+
+    out = dst.copy()
+    compositing.blend(out, src, "max")
+    assert out.tolist() == [[[20, 200, 0, 255], [100, 100, 100, 255]]]
+
+    out = dst.copy()
+    compositing.blend(out, src, "add")
+    assert out.tolist() == [[[30, 255, 0, 255], [100, 150, 200, 255]]]
+
+    # (src is premultiplied: the second pixel is (0, 100, 200) at half alpha.)
+    out = dst.copy()
+    compositing.blend(out, src, "over")
+    assert out.tolist() == [[[20, 100, 0, 255], [50, 100, 150, 255]]]
+
+    with pytest.raises(ValueError):
+        compositing.blend(out, src, "multiply")
+
+
+def test_draw_into_pane():
+    # Drawing into a pane of a wider image is the same as into an image of its own.
+    wide = np.zeros((10, 30, 4), dtype=np.uint8)
+    alone = np.zeros((10, 10, 4), dtype=np.uint8)
+    segments, radius, colors = [[-2, 5, 12, 5], [5, -2, 5, 12]], [2, 1], [[255] * 3] * 2
+    for out in (wide[:, 10:20], alone):
+        render_np.draw_segments(out, segments, radius, colors)
+
+    assert np.array_equal(wide[:, 10:20], alone)
+    assert (wide[:, :10] == 0).all() and (wide[:, 20:] == 0).all()
+    with pytest.raises(ValueError):
+        render_np.draw_segments(wide[:, ::2], segments, radius, colors)
+
+
+@pytest.mark.parametrize("horizontal", [True, False])
+def test_tri_pane(sessions, horizontal):
+    to_session, from_session = sessions
+    red = to_session.layer(cmap=render_mpl.cm_red)
+    blue = from_session.layer(cmap=render_mpl.cm_blue)
+    red_arr = to_session.render(cmap=render_mpl.cm_red)
+    blue_arr = from_session.render(cmap=render_mpl.cm_blue)
+
+    canvas = compositing.Canvas(red.size, n_panes=3, horizontal=horizontal)
+    canvas.add(blue, pane=0)
+    canvas.add(red, pane=2)
+    canvas.add(canvas.pane(0), pane=1)
+    canvas.add(canvas.pane(2), pane=1, mode="max")
+
+    concat = (
+        render_mpl.concat_layers_horiz if horizontal else render_mpl.concat_layers_vert
+    )
+    expected = concat(
+        [blue_arr, render_mpl.combine_layers_max([red_arr, blue_arr]), red_arr]
+    )
+    assert np.array_equal(canvas.image, expected)
+    assert np.shares_memory(canvas.pane(1), canvas.image)
+
+    # Drawn layers are blended in, too (through the scratch pane).
+    canvas = compositing.Canvas(red.size)
+    canvas.add(blue)
+    canvas.add(red, mode="add")
+    added = blue_arr.copy()
+    compositing.blend(added, red_arr, "add")
+    assert np.array_equal(canvas.image, added)
+
+
+def test_over(sessions):
+    # A layer on a transparent background, laid over another, is (about) the same
+    #  as drawing it straight over that one.
+    to_session, from_session = sessions
+    red = to_session.layer(cmap=render_mpl.cm_red)
+    clear = to_session.render(cmap=render_mpl.cm_red, bgcolor="none")
+    assert clear[0, 0].tolist() == [0, 0, 0, 0]
+
+    canvas = compositing.Canvas(red.size)
+    canvas.add(from_session.layer(cmap=render_mpl.cm_blue))
+    canvas.add(red, mode="over")
+    blended = from_session.render(cmap=render_mpl.cm_blue)
+    compositing.blend(blended, clear, "over")
+
+    assert (canvas.image[..., 3] == 255).all() and (blended[..., 3] == 255).all()
+    assert np.abs(canvas.image.astype(int) - blended).max() <= 2
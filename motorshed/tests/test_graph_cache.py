@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+from motorshed import graph_cache
+from motorshed.algos import gen2
+
+
+@pytest.fixture()
+def cached_map(grid_map, tmp_path):
+    G, center_node, origin_point = grid_map
+    # A few of the kinds of attributes that real maps have, too.
+    u, v, key = next(iter(G.edges(keys=True)))
+    G.edges[u, v, key]["geometry"] = LineString([(0, 0), (50, 10), (100, 0)])
+    G.edges[u, v, key]["osmid"] = [1, 2]
+    G.edges[u, v, key]["lanes"] = 2
+    graph_cache.save_graph(
+        "grid",
+        G,
+        cache_dir=tmp_path,
+        center_node=center_node,
+        origin_point=origin_point,
+    )
+    return G, graph_cache.load_graph("grid", cache_dir=tmp_path)
+
+
+def test_round_trip(cached_map):
+    G, CG = cached_map
+    assert CG.extra["center_node"] == 1000 + 3 * 6 + 3
+    assert CG.graph["crs"] == G.graph["crs"]
+    # Memory-mapped (read-only), not read.
+    assert not CG.u.flags.writeable and not CG.node_column("x").flags.writeable
+
+    G2 = CG.to_networkx()
+    assert list(G2.nodes) == list(G.nodes)
+    assert list(G2.edges(keys=True)) == list(G.edges(keys=True))
+    for node, data in G.nodes(data=True):
+        # (Missing values, like NaN highways, are just left out.)
+        assert G2.nodes[node] == {
+            k: x for k, x in data.items() if not (isinstance(x, float) and np.isnan(x))
+        }
+    for u, v, key, data in G.edges(keys=True, data=True):
+        data2 = G2.edges[u, v, key]
+        if "geometry" in data:
+            assert data2.pop("geometry").equals(data["geometry"])
+        assert data2 == {
+            k: x
+            for k, x in data.items()
+            if k != "geometry" and not (isinstance(x, float) and np.isnan(x))
+        }
+
+
+def test_initial_dataframes_without_networkx(cached_map):
+    G, CG = cached_map
+    Gn, Ge = gen2.create_initial_dataframes(G)
+    Gn2, Ge2 = gen2.create_initial_dataframes(CG)
+
+    # (osmnx's Gn is a GeoDataFrame, even without geometry.)
+    pd.testing.assert_frame_equal(Gn2[Gn.columns], Gn, check_frame_type=False)
+    columns = ["u", "v", "key", "ui", "vi", "length", "oneway", "w", "v2"]
+    pd.testing.assert_frame_equal(
+        Ge2[columns], Ge[columns], check_dtype=False, check_frame_type=False
+    )
+    # (Strings stay categorical.)
+    assert Ge2.highway.astype(str).tolist() == Ge.highway.tolist()
+    assert Ge2.geometry.iloc[0].length == pytest.approx(2 * np.hypot(50, 10))
+    assert Ge2.geometry.iloc[1:].isna().all()
+    assert np.array_equal(Ge2.attrs["graph"].node_ids, Ge.attrs["graph"].node_ids)
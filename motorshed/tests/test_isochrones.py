@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import shapely
+
+from motorshed import compositing, isochrones, pipeline, render_np
+
+
+@pytest.fixture()
+def motorshed_layers(grid_map):
+    G, center_node, origin_point = grid_map
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="local")
+    return Gn, Gge, center_node
+
+
+@pytest.mark.parametrize("method", isochrones.METHODS)
+def test_isochrone_grid(motorshed_layers, method):
+    Gn, Gge, center_node = motorshed_layers
+    grid = isochrones.IsochroneGrid(Gn, cells=50, method=method)
+    transit_time = Gn.transit_time.to_numpy(float)
+
+    # The cells right on the nodes (every 10 cells) have their transit times.
+    on_nodes = grid.times[::10, ::10].ravel()
+    by_position = Gn.sort_values(["y", "x"]).transit_time.to_numpy(float)
+    assert np.allclose(on_nodes, by_position)
+    assert np.nanmin(grid.times) == 0
+    assert np.nanmax(grid.times) == pytest.approx(transit_time.max())
+
+    # Isochrones grow with the transit time, and have the nodes that are well
+    #  within them (and none of the ones that are well outside).
+    levels = [10, 20, 30]
+    polygons = grid.isochrones(levels)
+    assert polygons.transit_time.tolist() == levels
+    areas = shapely.area(polygons.geometry.to_numpy())
+    assert 0 < areas[0] < areas[1] < areas[2]
+    points = shapely.points(Gn[["x", "y"]].to_numpy(float))
+    for level, geometry in zip(levels, polygons.geometry):
+        inside = shapely.contains(geometry.buffer(1), points)
+        assert inside[transit_time < level - 2].all()
+        assert not inside[transit_time > level + 8].any()
+
+    # Other transit times, and other levels, from the same grid.
+    grid.set_times(transit_time * 2)
+    doubled = grid.isochrones([2 * level for level in levels])
+    assert np.allclose(shapely.area(doubled.geometry.to_numpy()), areas)
+
+
+def test_far_from_nodes(motorshed_layers):
+    Gn, Gge, center_node = motorshed_layers
+    grid = isochrones.IsochroneGrid(Gn, cells=50, max_distance_m=30)
+
+    # (Cells in the middle of the blocks are more than 30 m from any node.)
+    assert np.isnan(grid.times[5, 5]) and not np.isnan(grid.times[0, 0])
+    everything = grid.isochrones([1000]).geometry[0]
+    assert 0 < everything.area < 500 * 500
+
+
+def test_isochrone_layer(motorshed_layers):
+    Gn, Gge, center_node = motorshed_layers
+    grid = isochrones.IsochroneGrid(Gn, cells=50)
+    session = render_np.RenderSession(Gn, Gge, center_node, dpi=50)
+    layer = grid.layer(Gn, [10, 20, 30], dpi=50, line_width=2)
+    assert layer.size == session.size and len(layer.segments)
+
+    canvas = compositing.Canvas(session.size)
+    motorshed = canvas.add(session.layer()).copy()
+    with_isochrones = canvas.add(layer, mode="over")
+    assert (with_isochrones != motorshed).any(axis=2).sum() > 100
+
+    # Drawn a band at a time, just the same (apart from rounding).
+    bands = motorshed.copy()
+    for top in range(0, session.size, 37):
+        layer.draw(bands[top : top + 37], top)
+    assert np.abs(bands.astype(int) - with_isochrones).max() <= 1
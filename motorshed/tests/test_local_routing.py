@@ -0,0 +1,112 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import dijkstra
+
+from motorshed import local_routing
+from motorshed.algos import gen2
+
+
+def test_estimate_speeds():
+    speeds = local_routing.estimate_speeds_mps(
+        ["residential", "primary", ["secondary", "tertiary"], "motorway", "footway"],
+        ["25 mph", "50", np.nan, ["65 mph", "55 mph"], None],
+    )
+    assert np.allclose(speeds[:2], [25 * 1609 / 3600, 50 / 3.6])
+    assert np.isclose(speeds[2], 55 / 3.6)  # default for 'secondary'
+    assert np.isclose(speeds[3], 65 * 1609 / 3600)
+    assert np.isclose(speeds[4], local_routing.FALLBACK_SPEED_KPH / 3.6)
+
+
+def test_transit_times_match_networkx(grid_map):
+    G, center_node, origin_point = grid_map
+
+    node_ids, adjacency = local_routing.graph_to_csr(G, towards_origin=False)
+    index = {node: i for i, node in enumerate(node_ids)}
+    H = nx.DiGraph()
+    for u, v in G.edges():
+        assert adjacency[index[u], index[v]] > 0
+        H.add_edge(u, v, t=adjacency[index[u], index[v]])
+
+    for towards_origin in (True, False):
+        local_routing.get_transit_times(G, center_node, towards_origin=towards_origin)
+
+        expected = nx.single_source_dijkstra_path_length(
+            H.reverse() if towards_origin else H, center_node, weight="t"
+        )
+        for node, t in expected.items():
+            assert np.isclose(G.nodes[node]["transit_time"], t)
+
+
+def test_transit_times_from_lat_lon(grid_map):
+    G, center_node, origin_point = grid_map
+    local_routing.get_transit_times(G, origin_point)
+    assert G.nodes[center_node]["transit_time"] == 0
+    assert all(G.nodes[n]["transit_time"] > 0 for n in G.nodes if n != center_node)
+
+
+def test_shortest_path_tree(grid_map):
+    G, center_node, origin_point = grid_map
+
+    for towards_origin in (True, False):
+        node_ids, transit_time, next_node = local_routing.shortest_path_tree(
+            G, center_node, towards_origin=towards_origin
+        )
+        times = dict(zip(node_ids, transit_time))
+        for node, nxt in zip(node_ids, next_node):
+            if node == center_node:
+                assert nxt == -1
+                continue
+            # Every step is along an existing edge, and gets us closer.
+            assert G.has_edge(node, nxt) if towards_origin else G.has_edge(nxt, node)
+            assert times[nxt] < times[node]
+
+
+def test_followup_local_routing(grid_map):
+    G, center_node, origin_point = grid_map
+
+    edges = pd.DataFrame(list(G.edges()), columns=["u", "v"])
+    Ge = edges.assign(w=0, v2=edges.v).set_index(["u", "v"])
+
+    Ge = gen2.followup_local_routing(G, Ge, None, center_node)
+
+    assert (Ge.w != 0).all()
+    assert (Ge.loc[pd.IndexSlice[:, [center_node]], "w"] == -1).all()
+    for (u, v), w in Ge.w.items():
+        if w != -1:
+            assert (v, w) in Ge.index
+
+
+def test_transit_times_bidirectional(grid_map):
+    G, center_node, origin_point = grid_map
+
+    times_to, times_from = local_routing.get_transit_times_bidirectional(
+        G, center_node
+    )
+    for towards_origin, times in ((True, times_to), (False, times_from)):
+        node_ids, expected, next_node = local_routing.shortest_path_tree(
+            G, center_node, towards_origin=towards_origin
+        )
+        assert np.allclose(times, expected)
+    assert [G.nodes[n]["transit_time"] for n in G.nodes] == list(times_to)
+
+
+def test_one_search_per_motorshed(grid_map, monkeypatch):
+    G, center_node, origin_point = grid_map
+    from motorshed import pipeline
+
+    calls = []
+
+    def counting_dijkstra(*args, **kwargs):
+        calls.append(kwargs["indices"])
+        return dijkstra(*args, **kwargs)
+
+    monkeypatch.setattr(local_routing, "dijkstra", counting_dijkstra)
+
+    # The transit times and the routing come from the same search.
+    pipeline.motorshed(G, center_node, backend="local")
+    assert len(calls) == 1
+    pipeline.bidirectional_motorshed(G, center_node, backend="local")
+    assert len(calls) == 2  # ('to' was already done)
+    pipeline.motorshed(G, 1000, backend="local")
+    assert len(calls) == 3
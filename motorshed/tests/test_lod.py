@@ -0,0 +1,88 @@
+import matplotlib
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+matplotlib.use("Agg")
+
+from motorshed import lod, pipeline, render_mpl, render_np
+
+
+def test_edge_chains():
+    # 1 -> 2 -> 3 -> 4 -> 5, with 3 -> 4 busier; 6 <-> 2 branches off; 7 -> 8 -> 7
+    #  goes around in a loop.
+    u = np.array([1, 2, 3, 4, 2, 6, 7, 8])
+    v = np.array([2, 3, 4, 5, 6, 2, 8, 7])
+    traffic = np.array([5, 5, 9, 9, 1, 1, 3, 3])
+    order, starts = lod.edge_chains(u, v, traffic, 9)
+
+    chains = [c.tolist() for c in np.split(order, starts[1:])]
+    # (2 has three neighbors, so nothing goes through it; 3 -> 4 is busier than
+    #  2 -> 3. And 7 -> 8 -> 7 would go straight back.)
+    assert chains == [[0], [1], [2, 3], [4], [5], [6], [7]]
+
+    # Through a node with two neighbors, both ways.
+    u = np.array([1, 2, 3, 2])
+    v = np.array([2, 3, 2, 1])
+    order, starts = lod.edge_chains(u, v, np.ones(4), 4)
+    assert [c.tolist() for c in np.split(order, starts[1:])] == [[0, 1], [2, 3]]
+
+
+def test_level_of_detail():
+    # A half circle (radius 100 m), as 50 little edges (like an unsimplified map),
+    #  and one edge (4 -> 5) with the same curve as its geometry, drawn backwards
+    #  (like a reversed edge).
+    angle = np.linspace(0, np.pi, 51)
+    arc = np.stack([100 * np.cos(angle), 100 * np.sin(angle)], axis=1)
+    nodes = list(range(100, 151))
+    Gn = pd.DataFrame(dict(x=arc[:, 0], y=arc[:, 1]), index=nodes)
+    Gn.loc[4] = arc[0] + [0, 500]
+    Gn.loc[5] = arc[-1] + [0, 500]
+    Gn.loc[6] = [0.0, 1000.0]  # (For a faint one.)
+    gdf = pd.DataFrame(
+        dict(
+            u=nodes[:-1] + [5, 6],
+            v=nodes[1:] + [4, 4],
+            through_traffic=10,
+            geometry=[None] * 50 + [shapely.LineString(arc + [0, 500]), None],
+        )
+    )
+    radius = np.ones(len(gdf))
+    colors = np.full((len(gdf), 3), 200.0)
+    colors[-1] = 1  # (Nearly the black background.)
+
+    # With 1 m pixels, the curves are kept, to within half of a pixel.
+    segments, edge = lod.level_of_detail(Gn, gdf, radius, colors, [0, 0, 0], 1.0)
+    assert set(edge.tolist()) == {0, 50}
+    for e, offset in ((0, 0), (50, 500)):
+        ends = segments[edge == e].reshape(-1, 2) - [0, offset]
+        assert 5 < (edge == e).sum() < 50
+        assert np.allclose(np.hypot(*ends.T), 100)
+        # (Middles of the segments are within half of a pixel of the curve.)
+        middles = (segments[edge == e, :2] + segments[edge == e, 2:]) / 2
+        assert (np.hypot(*(middles - [0, offset]).T) > 99.5).all()
+    # Edge 50 goes from 5 to 4, so from the end of the arc back to its start.
+    assert np.allclose(segments[edge == 50][0, :2], arc[-1] + [0, 500])
+    assert np.allclose(segments[edge == 50][-1, 2:], arc[0] + [0, 500])
+
+    # With 1 km pixels, each is just a dot; and with a little width, they're gone.
+    segments, edge = lod.level_of_detail(Gn, gdf, radius, colors, [0, 0, 0], 1000.0)
+    assert len(segments) == 2
+    segments, edge = lod.level_of_detail(
+        Gn, gdf, radius / 10, colors, [0, 0, 0], 1000.0
+    )
+    assert len(segments) == 0
+
+
+@pytest.mark.parametrize("renderer", [render_mpl, render_np])
+def test_render_lod(grid_map, renderer):
+    G, center_node, origin_point = grid_map
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="local")
+
+    expected = renderer.render_layer(Gn, Gge, center_node, dpi=50)
+    rgba_arr = renderer.render_layer(Gn, Gge, center_node, dpi=50, lod=True)
+
+    # A grid of straight streets looks the same.
+    assert rgba_arr.shape == expected.shape
+    assert np.abs(rgba_arr.astype(float) - expected).mean() < 1
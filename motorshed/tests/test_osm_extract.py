@@ -0,0 +1,97 @@
+import bz2
+
+import pytest
+
+from motorshed import osm_extract, pipeline
+from motorshed.algos import gen2
+
+
+def write_osm_xml(fn, G, extra_ways=()):
+    """Write the grid map G as an OSM XML extract: its nodes, and its streets as
+    ways (a way per row, and per column), plus `extra_ways` ((way ID, node IDs, tags)).
+    """
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    for node, data in G.nodes(data=True):
+        lines.append(
+            '<node id="%d" lat="%.7f" lon="%.7f">' % (node, data["lat"], data["lon"])
+        )
+        if isinstance(data.get("highway"), str):
+            lines.append('<tag k="highway" v="%s"/>' % data["highway"])
+        lines.append("</node>")
+    # (A node outside of the maps.)
+    lines.append('<node id="1" lat="0" lon="0"/>')
+
+    n = 6
+    ways = [
+        (10 + i, [1000 + i * n + j for j in range(n)], {"highway": "residential"})
+        for i in range(n)
+    ]
+    ways += [
+        (20 + j, [1000 + i * n + j for i in range(n)], {"highway": "residential"})
+        for j in range(n)
+    ]
+    ways[0][2]["oneway"] = "yes"
+    ways[3][2].update(highway="secondary", maxspeed="35 mph", name="Main St")
+    for way_id, refs, tags in ways + list(extra_ways):
+        lines.append('<way id="%d">' % way_id)
+        lines += ['<nd ref="%d"/>' % ref for ref in refs]
+        lines += ['<tag k="%s" v="%s"/>' % kv for kv in tags.items()]
+        lines.append("</way>")
+    lines.append('<relation id="1"><member type="way" ref="10" role=""/></relation>')
+    lines.append("</osm>")
+
+    with bz2.open(fn, "wt") as f:
+        f.write("\n".join(lines))
+
+
+def test_load_extract(grid_map, tmp_path):
+    G, center_node, origin_point = grid_map
+    fn = str(tmp_path / "grid.osm.bz2")
+    write_osm_xml(
+        fn,
+        G,
+        extra_ways=[
+            (30, [1000, 1007], {"highway": "footway"}),  # Not drivable
+            (31, [1000, 1], {"highway": "residential"}),  # Leaves the map
+            (32, [1001, 1000], {"highway": "service", "service": "driveway"}),
+        ],
+    )
+
+    CG = osm_extract.load_extract(
+        fn, center=origin_point, distance=1000, cache_dir=tmp_path
+    )
+    assert CG.extra["center_node"] == center_node
+    assert CG.graph["crs"] == "epsg:32610"
+    assert sorted(CG.node_ids.tolist()) == sorted(G.nodes)
+    # The same streets as the grid map (whose row 0 is one-way, too).
+    assert sorted(zip(CG.u.tolist(), CG.v.tolist())) == sorted(G.edges())
+    assert (CG.key == 0).all()
+
+    Gn, Ge = gen2.create_initial_dataframes(CG)
+    assert Ge["length"].to_numpy() == pytest.approx(100, rel=0.01)
+    main_st = Ge[Ge.u.between(1018, 1023) & Ge.v.between(1018, 1023)]
+    assert (main_st.highway == "secondary").all() and (main_st.name == "Main St").all()
+    assert Gn.loc[1014, "highway"] == "traffic_signals"
+    # Projected, 100 m apart.
+    assert Gn.loc[1001, "x"] - Gn.loc[1000, "x"] == pytest.approx(100, rel=0.01)
+
+    # A smaller map (the middle 3x3 nodes).
+    small = osm_extract.load_extract(
+        fn, center=origin_point, distance=150, cache_dir=tmp_path
+    )
+    assert small.number_of_nodes() == 9
+
+
+def test_motorshed_from_extract(grid_map, tmp_path):
+    G, center_node, origin_point = grid_map
+    fn = str(tmp_path / "grid.osm.bz2")
+    write_osm_xml(fn, G)
+    CG = osm_extract.load_extract(fn, center=origin_point, cache_dir=tmp_path)
+
+    Gn1, Gge1 = pipeline.motorshed(G, center_node, backend="local")
+    G2 = CG.to_networkx()
+    Gn2, Gge2 = pipeline.motorshed(G2, center_node, backend="local")
+    traffic1 = Gge1.set_index(["u", "v"]).through_traffic.sort_index()
+    traffic2 = Gge2.set_index(["u", "v"]).through_traffic.sort_index()
+    # (The same routes; traffic is by length, which is a bit different.)
+    assert traffic2.to_numpy() == pytest.approx(traffic1.to_numpy(), rel=0.01)
@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 
 from motorshed import osrm
@@ -36,6 +37,7 @@ def test_get_transit_times(example_map):
         assert "transit_time" in nnode
         assert (nnode["transit_time"] > 0) or (node == center_node)
 
+
 def test_get_transit_times_r(example_map):
     G, center_node, origin_point = example_map
     G2 = G.copy()
@@ -58,11 +60,14 @@ def test_get_directions(example_map):
 
     route, transit_time, r = osrm.osrm(G2, nnode, center_node)
 
-    assert abs(transit_time - nnode["transit_time"]) < 2 # biggest allowable difference is 2 seconds
+    assert (
+        abs(transit_time - nnode["transit_time"]) < 2
+    )  # biggest allowable difference is 2 seconds
     assert len(route) > 2
     assert route[0] == node_id
     assert route[-1] == center_node
 
+
 def test_get_directions_r(example_map):
     G, center_node, origin_point = example_map
     G2 = G.copy()
@@ -79,6 +84,7 @@ def test_get_directions_r(example_map):
     assert route[-1] == node_id
     assert route[0] == center_node
 
+
 def test_get_directions_parallel(example_map):
     G, center_node, origin_point = example_map
     G2 = G.copy()
@@ -86,12 +92,12 @@ def test_get_directions_parallel(example_map):
 
     N_NODES = 10
 
-
     node_ids = list(G2.nodes)[:N_NODES]
     node_pairs = [(G2.nodes[node_id], center_node) for node_id in node_ids]
 
     results = osrm.osrm_parallel(G2, node_pairs)
 
+
 def test_get_directions_parallel_r(example_map):
     G, center_node, origin_point = example_map
     G2 = G.copy()
@@ -105,3 +111,180 @@ def test_get_directions_parallel_r(example_map):
     results = osrm.osrm_parallel(G2, node_pairs)
 
 
+def test_client_route(osrm_server, local_client):
+    route, transit_time, r = local_client.route((-122.0, 37.0), (-122.5, 37.0))
+
+    assert route == [1, 2, 3]
+    assert transit_time == pytest.approx(500)
+    # Only ask for what we use.
+    assert "steps=false" in osrm_server.paths[0]
+    assert "annotations=nodes" in osrm_server.paths[0]
+
+
+def test_client_table(local_client):
+    coords = ["%f,37.0" % lon for lon in (-122.0, -122.1, -122.3)]
+
+    durations, r = local_client.table(coords, destinations=[0])
+    assert durations.shape == (3, 1)
+    assert durations[:, 0] == pytest.approx([0, 100, 300])
+
+    durations, r = local_client.table(coords, sources=[0])
+    assert durations.shape == (1, 3)
+
+
+def test_client_reuses_connections(osrm_server, local_client):
+    starts = [(-122.0 - i / 1000, 37.0) for i in range(200)]
+    results = list(local_client.map(local_client.route, starts, starts[::-1]))
+
+    assert len(results) == 200
+    assert len(osrm_server.paths) == 200
+    # Keep-alive: never more connections than requests in flight.
+    assert len(osrm_server.connections) <= local_client.max_in_flight
+
+
+def test_get_transit_times_local_server(grid_map, local_client):
+    G, center_node, origin_point = grid_map
+    osrm.get_transit_times(G, center_node, client=local_client)
+
+    for node, data in G.nodes(data=True):
+        expected = 1000 * abs(data["lon"] - G.nodes[center_node]["lon"])
+        # (coordinates are sent with 5 decimals)
+        assert data["transit_time"] == pytest.approx(expected, abs=0.01)
+
+
+def test_osrm_parallel_local_server(grid_map, local_client):
+    G, center_node, origin_point = grid_map
+    node_pairs = [(node, center_node) for node in list(G.nodes)[:10]]
+
+    results = osrm.osrm_parallel(G, node_pairs, client=local_client)
+    assert len(results) == 10
+
+
+def test_client_retries(osrm_server):
+    client = osrm.OSRMClient(osrm_server.url, max_in_flight=4, backoff_s=0.001)
+    osrm_server.failures += [429, 503, "bad json", 500]
+
+    route, transit_time, r = client.route((-122.0, 37.0), (-122.5, 37.0))
+
+    assert transit_time == pytest.approx(500)
+    stats = client.stats.as_dict()
+    assert stats["requests"] == 5
+    assert stats["retries"] == 4
+    assert stats["throttles"] == 2
+    assert stats["errors"] == 2
+    assert stats["failures"] == 0
+    assert stats["mean_latency"] > 0
+    # ... and we backed off.
+    assert client.rate.limit < 4
+
+
+def test_client_gives_up(osrm_server):
+    client = osrm.OSRMClient(
+        osrm_server.url, max_in_flight=2, max_retries=2, backoff_s=0.001
+    )
+    osrm_server.failures += [502] * 3
+
+    with pytest.raises(osrm.OSRMError):
+        client.table(["-122.0,37.0", "-122.1,37.0"])
+    assert client.stats.failures == 1
+    assert len(osrm_server.paths) == 3
+
+
+def test_stats_mean_latency():
+    stats = osrm.OSRMStats()
+    # A connection error and a cache hit have no latency; they don't count.
+    stats.record(requests=1, errors=1)
+    stats.record(requests=1, cache_hits=1)
+    stats.record(requests=1, latency=0.2)
+    stats.record(requests=1, latency=0.4)
+    assert stats.mean_latency == pytest.approx(0.3)
+
+
+def test_client_retry_after(osrm_server):
+    client = osrm.OSRMClient(osrm_server.url, max_retries=1)
+    assert client._backoff(0, retry_after="2") == 2
+    assert 0 <= client._backoff(3) <= client.backoff_s * 8
+
+
+def test_rate_controller():
+    rate = osrm.RateController(max_in_flight=16, initial=4)
+    for i in range(500):
+        rate.on_success(0.01)
+    assert rate.limit == 16
+
+    rate.on_failure()
+    assert rate.limit == 8
+    rate.on_failure()  # same 'round'; don't collapse
+    assert rate.limit == 8
+
+    # Latency blowing up counts as congestion, too.
+    rate._last_decrease = 0
+    rate.on_success(10.0)
+    assert rate.limit == 4
+
+
+def test_polyline():
+    lat_lon = np.array([[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]])
+    # The example from Google's documentation.
+    assert osrm.encode_polyline(lat_lon) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert np.allclose(osrm.decode_polyline(osrm.encode_polyline(lat_lon)), lat_lon)
+
+
+def test_table_chunks(grid_map):
+    G, center_node, origin_point = grid_map
+    lat_lon = np.array([(d["lat"], d["lon"]) for n, d in G.nodes(data=True)])
+
+    chunks = osrm.table_chunks(lat_lon, origin_point, 9, 8000)
+    assert max(len(c) for c in chunks) == 9  # plus the origin makes 10
+    assert sorted(np.concatenate(chunks)) == list(range(len(lat_lon)))
+
+    # With the default limits, one-to-many chunks are only limited by the URL.
+    rng = np.random.default_rng(0)
+    lat_lon = origin_point + rng.uniform(-0.2, 0.2, size=(20_000, 2))
+    max_points = osrm.max_table_points(100)
+    assert max_points == 9999 and osrm.max_table_points(100, True) == 99
+    chunks = osrm.table_chunks(lat_lon, origin_point, max_points, 8000)
+    assert len(chunks) < 40
+    for chunk in chunks:
+        points = np.vstack([origin_point, lat_lon[chunk]])
+        assert 7000 < len(osrm.format_coordinates(points)) <= 8000 - 200 or (
+            chunk is chunks[-1]
+        )
+
+    # Short URLs make for smaller chunks.
+    chunks = osrm.table_chunks(lat_lon, origin_point, 100, 300)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        points = np.vstack([origin_point, lat_lon[chunk]])
+        assert len(osrm.format_coordinates(points)) <= 300 - 200
+
+
+def test_get_transit_times_chunks(osrm_server, grid_map, local_client):
+    G, center_node, origin_point = grid_map
+    osrm_server.max_table_size = 5  # smaller than we think
+
+    osrm.get_transit_times(
+        G, center_node, towards_origin=False, client=local_client, max_table_size=8
+    )
+
+    for node, data in G.nodes(data=True):
+        expected = 1000 * abs(data["lon"] - G.nodes[center_node]["lon"])
+        assert data["transit_time"] == pytest.approx(expected, abs=0.01)
+    assert all("polyline(" in path for path in osrm_server.paths)
+
+
+def test_get_transit_times_bidirectional(osrm_server, grid_map, local_client):
+    G, center_node, origin_point = grid_map
+
+    times_to, times_from = osrm.get_transit_times_bidirectional(
+        G, center_node, client=local_client, max_table_size=20
+    )
+
+    # One (many-to-many) request per chunk, for both directions.
+    assert len(osrm_server.paths) == 2
+    assert not any("sources" in path for path in osrm_server.paths)
+    for n, (node, data) in enumerate(G.nodes(data=True)):
+        expected = 1000 * abs(data["lon"] - G.nodes[center_node]["lon"])
+        assert times_to[n] == pytest.approx(expected, abs=0.01)
+        assert times_from[n] == pytest.approx(expected, abs=0.01)
+        assert data["transit_time"] == times_to[n]
@@ -0,0 +1,70 @@
+import os
+
+import imageio.v2 as imageio
+import numpy as np
+import pytest
+
+from motorshed import output, render_mpl
+
+
+@pytest.fixture()
+def rgba_arr():
+    # Some lines on a black background, like a (tiny) map.
+    rgba_arr = np.zeros((60, 80, 4), dtype=np.uint8)
+    rgba_arr[..., 3] = 255
+    rgba_arr[10:14, 5:70] = [250, 120, 30, 255]
+    rgba_arr[5:55, 40:43] = [90, 20, 120, 255]
+    return rgba_arr
+
+
+@pytest.mark.parametrize("profile", list(output.PROFILES))
+@pytest.mark.parametrize("format", output.FORMATS)
+def test_save_image(rgba_arr, tmp_path, format, profile):
+    fn = os.path.join(tmp_path, "map")
+    fn_out, n_bytes, seconds = output.save_image(fn, rgba_arr, format, profile)
+
+    assert fn_out == fn + output.EXTENSIONS[format]
+    assert n_bytes == os.path.getsize(fn_out) and seconds >= 0
+    if format == "npy":
+        assert np.array_equal(np.load(fn_out), rgba_arr)
+    elif format == "jpeg":
+        # (Lossy, and without the alpha channel.)
+        read = imageio.imread(fn_out)
+        assert read.shape == (60, 80, 3)
+        assert np.abs(read.astype(int) - rgba_arr[..., :3]).mean() < 5
+    else:
+        # (Lossless. WebPs leave out the alpha channel, when it's all opaque.)
+        read = imageio.imread(fn_out)
+        assert np.array_equal(read, rgba_arr[..., : read.shape[2]])
+
+
+def test_save_image_errors(rgba_arr, tmp_path):
+    fn = os.path.join(tmp_path, "map")
+    with pytest.raises(ValueError):
+        output.save_image(fn, rgba_arr, format="tiff")
+    with pytest.raises(ValueError):
+        output.save_image(fn, rgba_arr, profile="tiny")
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_image_writer(rgba_arr, tmp_path, processes):
+    fns = [os.path.join(tmp_path, "map_%d" % n) for n in range(3)]
+    with output.ImageWriter("fast", n_workers=2, processes=processes) as writer:
+        futures = [writer.save(fn, rgba_arr * (n + 1)) for n, fn in enumerate(fns)]
+        written = writer.wait()
+        writer.save(fns[0], rgba_arr, format="webp")
+
+    assert [fn for fn, _, _ in written] == [fn + ".png" for fn in fns]
+    assert [future.result() for future in futures] == written
+    for n, (fn, n_bytes, seconds) in enumerate(written):
+        assert n_bytes == os.path.getsize(fn)
+        assert np.array_equal(imageio.imread(fn), rgba_arr * (n + 1))
+    # (Written by the time the writer's closed.)
+    assert os.path.exists(fns[0] + ".webp")
+
+
+def test_save_layer(rgba_arr, tmp_path):
+    fn = os.path.join(tmp_path, "map")
+    assert render_mpl.save_layer(fn, rgba_arr) == fn + ".png"
+    assert np.array_equal(imageio.imread(fn + ".png"), rgba_arr)
+    assert render_mpl.save_layer(fn, rgba_arr, "webp", "fast") == fn + ".webp"
@@ -1,4 +1,4 @@
-from motorshed import overpass
+from motorshed import graph_cache, overpass
 from motorshed.example_parameters import (
     example_maps,
     example_maps_list,
@@ -31,3 +31,67 @@ def test_get_map_with_place():
     G, center_node, origin_point = overpass.get_map(
         example["center_address"], place=example["place"]
     )
+
+
+def cache_grid_region(G, cache_dir, name, nodes):
+    """Cache the part of G with `nodes`, as a map of their bounding box."""
+    G = G.subgraph(nodes).copy()
+    lat, lon = zip(*((d["lat"], d["lon"]) for n, d in G.nodes(data=True)))
+    bbox = (min(lon), min(lat), max(lon), max(lat))
+    graph_cache.save_graph(name, G, cache_dir, bbox=bbox)
+    return bbox
+
+
+def test_map_cut_from_cached_region(grid_map, tmp_path):
+    G, center_node, origin_point = grid_map
+    bbox = cache_grid_region(G, tmp_path, "big", list(G.nodes))
+
+    # The middle 4x4 nodes (of 6x6), 100 m apart.
+    small_bbox = overpass.bbox_around(origin_point, 150)
+    CG = overpass.map_from_cached_regions("small", small_bbox, origin_point, tmp_path)
+    assert CG.extra["center_node"] == center_node
+    assert CG.number_of_nodes() == 9
+    assert CG.number_of_edges() == 2 * 12
+    assert graph_cache.cached_regions(tmp_path) == [
+        ("big", bbox),
+        ("small", small_bbox),
+    ]
+
+    # Nothing cached there.
+    far_away = overpass.bbox_around((0, 0), 100)
+    assert overpass.map_from_cached_regions("far", far_away, (0, 0), tmp_path) is None
+
+
+def test_map_partly_from_cached_region(grid_map, tmp_path, monkeypatch):
+    G, center_node, origin_point = grid_map
+    west = [n for n in G.nodes if (n - 1000) % 6 < 3]
+    cache_grid_region(G, tmp_path, "west", west)
+
+    downloaded = []
+
+    def graph_from_bbox(box):
+        # What osmnx would download: the nodes in the box, and the edges that
+        #  cross into it (with the nodes at their other end), in lat/lon.
+        downloaded.append(box)
+        inside = {
+            n
+            for n, d in G.nodes(data=True)
+            if overpass._in_bbox(d["lat"], d["lon"], box)
+        }
+        edges = [e for e in G.edges(keys=True) if e[0] in inside or e[1] in inside]
+        G_box = G.edge_subgraph(edges).copy()
+        G_box.graph["crs"] = "epsg:4326"
+        for node, data in G_box.nodes(data=True):
+            data["x"], data["y"] = data.pop("lon"), data.pop("lat")
+        return G_box
+
+    monkeypatch.setattr(overpass, "_graph_from_bbox", graph_from_bbox)
+    lat, lon = zip(*((d["lat"], d["lon"]) for n, d in G.nodes(data=True)))
+    bbox = (min(lon), min(lat), max(lon), max(lat))
+    CG = overpass.map_from_cached_regions("all", bbox, origin_point, tmp_path)
+
+    # Only the east half was downloaded, and the map is all of G.
+    assert len(downloaded) == 1 and downloaded[0][0] > bbox[0]
+    assert sorted(CG.node_ids.tolist()) == sorted(G.nodes)
+    assert sorted(zip(CG.u.tolist(), CG.v.tolist())) == sorted(G.edges())
+    assert CG.extra["center_node"] == center_node
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from motorshed import pipeline
+
+
+def test_get_router():
+    from motorshed import local_routing, osrm
+
+    assert pipeline.get_router("local") is local_routing
+    assert pipeline.get_router("osrm") is osrm
+    with pytest.raises(ValueError):
+        pipeline.get_router("carrier pigeon")
+
+
+def test_motorshed_local(grid_map):
+    G, center_node, origin_point = grid_map
+
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="local")
+
+    assert len(Gn) == len(G)
+    assert (Gge.w != 0).all()
+    assert (Gge.through_traffic >= 0).all()
+
+
+def test_bidirectional_local(grid_map):
+    G, center_node, origin_point = grid_map
+
+    Gn, Gge_to, Gge_from = pipeline.bidirectional_motorshed(
+        G, center_node, backend="local"
+    )
+
+    assert (Gn.loc[center_node, ["transit_time_to", "transit_time_from"]] == 0).all()
+    assert not Gge_to.reversed.any()
+    assert Gge_from.reversed.all()
+    # Same edges, opposite directions.
+    assert set(zip(Gge_to.u, Gge_to.v)) == set(zip(Gge_from.v, Gge_from.u))
+
+    Gn_from, Gge_from_2 = pipeline.motorshed(
+        G, center_node, towards_origin=False, backend="local"
+    )
+    Gge_from = Gge_from.set_index(["u", "v"]).sort_index()
+    Gge_from_2 = Gge_from_2.set_index(["u", "v"]).sort_index()
+    assert np.allclose(Gge_from.through_traffic, Gge_from_2.through_traffic)
+    assert (Gge_from.w == Gge_from_2.w).all()
+
+
+@pytest.mark.parametrize("towards_origin", [True, False])
+def test_batch_motorsheds(grid_map, towards_origin):
+    G, center_node, origin_point = grid_map
+    center_nodes = [center_node, 1000, 1035]
+
+    edges = pipeline.batch_motorsheds(
+        G, center_nodes, towards_origin=towards_origin, backend="local", n_workers=2
+    )
+
+    assert list(edges.columns) == center_nodes
+    assert set(edges.index) == set(G.edges())
+    for c in center_nodes:
+        Gn, Gge = pipeline.motorshed(
+            G, c, towards_origin=towards_origin, backend="local"
+        )
+        u, v = ("u", "v") if towards_origin else ("v", "u")
+        expected = Gge.set_index([u, v]).through_traffic
+        assert np.allclose(edges.loc[expected.index, c], expected)
+
+
+def test_batch_motorsheds_points(grid_map):
+    G, center_node, origin_point = grid_map
+
+    edges = pipeline.batch_motorsheds(G, [origin_point], backend="local", n_workers=1)
+    assert list(edges.columns) == [center_node]
+
+    edges = pipeline.batch_motorsheds(G, [], backend="local")
+    assert edges.empty and set(edges.index) == set(G.edges())
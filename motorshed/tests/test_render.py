@@ -0,0 +1,124 @@
+import imageio.v2 as imageio
+import matplotlib
+import numpy as np
+import pytest
+
+matplotlib.use("Agg")
+
+from motorshed import pipeline, png_stream, render_mpl, render_np
+
+
+@pytest.fixture()
+def motorshed_layers(grid_map):
+    G, center_node, origin_point = grid_map
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="local")
+    return Gn, Gge, center_node
+
+
+def test_draw_segments():
+    out = np.zeros((10, 20, 4), dtype=np.uint8)
+    red, green = [255, 0, 0], [0, 255, 0]
+    # A horizontal line, 2 pixels wide, and a green one over the end of it.
+    render_np.draw_segments(
+        out, [[2, 5, 15, 5], [15, 2, 15, 8]], [1, 1], [red, green], clip=(0, 0, 16, 10)
+    )
+
+    assert (out[4:6, 3:13] == [255, 0, 0, 255]).all()
+    assert (out[:3, 3:13] == 0).all() and (out[7:, 3:13] == 0).all()
+    # (Antialiased: half of the pixels at the round cap; premultiplied, on a
+    #  transparent image.)
+    assert 0 < out[4, 1, 0] < 255 and out[4, 1, 0] == out[4, 1, 3]
+    # The green one was drawn last, and nothing to the right of the clip box.
+    assert (out[4:6, 14:16] == [0, 255, 0, 255]).all()
+    assert (out[:, 16:] == 0).all()
+
+
+def test_render_like_matplotlib(motorshed_layers):
+    Gn, Gge, center_node = motorshed_layers
+
+    expected = render_mpl.render_layer(Gn, Gge, center_node, dpi=50)
+    out = np.zeros_like(expected)
+    rgba_arr = render_np.render_layer(Gn, Gge, center_node, dpi=50, out=out)
+
+    assert rgba_arr is out
+    assert rgba_arr.shape == expected.shape and rgba_arr.dtype == np.uint8
+    assert (rgba_arr[..., 3] == 255).all()
+    # The same picture, apart from the edges of the lines (which matplotlib snaps
+    #  to the pixels, when they're straight up or across).
+    lit = rgba_arr[..., :3].sum(axis=2) > 30
+    lit_expected = expected[..., :3].sum(axis=2) > 30
+    assert (lit & lit_expected).sum() / (lit | lit_expected).sum() > 0.9
+    assert np.abs(rgba_arr.astype(float) - expected).mean() < 5
+
+    # With the same parameters.
+    white = render_np.render_layer(
+        Gn, Gge, center_node, bgcolor="white", dpi=50, cmap=render_mpl.cm_blue
+    )
+    assert (white[0, 0] == 255).all()
+
+
+def test_png_writer(tmp_path):
+    rng = np.random.default_rng(0)
+    expected = rng.integers(0, 256, (50, 30, 4), dtype=np.uint8)
+    expected[10:20] = 7  # (Something that compresses.)
+
+    fn = str(tmp_path / "bands.png")
+    with png_stream.PNGWriter(fn, 30, 50) as png:
+        for top in range(0, 50, 16):
+            png.write_rows(expected[top : top + 16])
+
+    assert np.array_equal(imageio.imread(fn), expected)
+    with pytest.raises(ValueError):
+        with png_stream.PNGWriter(fn, 30, 50) as png:
+            png.write_rows(expected[:10])
+
+
+def test_render_poster(motorshed_layers, tmp_path):
+    Gn, Gge, center_node = motorshed_layers
+    blue = render_np.RenderSession(Gn, Gge, center_node, dpi=50).layer(
+        cmap=render_mpl.cm_blue
+    )
+    red = render_np.RenderSession(Gn, Gge.iloc[::2], center_node, dpi=50).layer(
+        cmap=render_mpl.cm_red
+    )
+    expected = render_mpl.combine_layers_max(
+        [
+            render_np.render_layer(
+                Gn, Gge, center_node, dpi=50, cmap=render_mpl.cm_blue
+            ),
+            render_np.render_layer(
+                Gn, Gge.iloc[::2], center_node, dpi=50, cmap=render_mpl.cm_red
+            ),
+        ]
+    )
+
+    # (In bands that don't divide the image evenly, across the lines.)
+    fn = render_np.render_poster(
+        str(tmp_path / "poster.png"), [blue, red], band_height=37
+    )
+    poster = imageio.imread(fn)
+    assert poster.shape == expected.shape
+    assert np.abs(poster.astype(int) - expected).max() <= 1
+
+
+@pytest.mark.parametrize("lod", [False, True])
+def test_render_session(motorshed_layers, lod):
+    Gn, Gge, center_node = motorshed_layers
+    session = render_np.RenderSession(Gn, Gge, center_node, dpi=50, lod=lod)
+    styles = [
+        dict(),
+        dict(cmap=render_mpl.cm_red, max_edge_width=10),
+        dict(cmap=render_mpl.cm_blue, bgcolor="white"),
+    ]
+
+    # Restyled, just like rendering it from scratch.
+    expected = [
+        render_np.render_layer(Gn, Gge, center_node, dpi=50, lod=lod, **style)
+        for style in styles
+    ]
+    for n_workers in (1, 2):
+        images = session.render_batch(styles, n_workers=n_workers)
+        assert len(images) == len(styles)
+        for rgba_arr, expected_arr in zip(images, expected):
+            assert np.array_equal(rgba_arr, expected_arr)
+    assert not np.array_equal(images[0], images[1])
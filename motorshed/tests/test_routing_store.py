@@ -0,0 +1,80 @@
+import urllib.parse
+
+import numpy as np
+import pytest
+
+from motorshed import osrm, pipeline, routing_store
+
+
+@pytest.fixture()
+def store(tmp_path):
+    store = routing_store.RoutingStore(str(tmp_path / "routing_store.sqlite"))
+    yield store
+    store.close()
+
+
+@pytest.fixture()
+def osrm_client(local_client):
+    previous = osrm._default_client
+    osrm.set_client(local_client)
+    yield local_client
+    osrm.set_client(previous)
+
+
+def test_transit_times_round_trip(store):
+    store.save_transit_times(7, [1, 2, 3], [0.0, 12.5, np.nan], profile="x/driving")
+
+    times, known = store.load_transit_times(7, [3, 2, 4], profile="x/driving")
+    assert list(known) == [True, True, False]
+    assert np.isnan(times[0]) and times[1] == 12.5 and np.isnan(times[2])
+
+    # Other directions, profiles and origins are kept apart.
+    assert not store.load_transit_times(7, [2], towards_origin=False)[1].any()
+    assert not store.load_transit_times(7, [2], profile="y/driving")[1].any()
+    assert not store.load_transit_times(8, [2], profile="x/driving")[1].any()
+
+
+def table_points(paths):
+    """Number of points (besides the origin) in each Table API request."""
+    n = []
+    for path in paths:
+        if path.startswith("/table"):
+            coordinates = urllib.parse.unquote(path.split("/")[4].split("?")[0])
+            n.append(len(osrm.decode_polyline(coordinates[len("polyline(") : -1])) - 1)
+    return n
+
+
+def test_motorshed_with_store(grid_map, osrm_server, osrm_client, store):
+    G, center_node, origin_point = grid_map
+    from motorshed import local_routing
+
+    # Real routes (the local routing engine's), so that every edge gets routed.
+    node_ids, transit_time, next_node = local_routing.shortest_path_tree(G, center_node)
+    next_node = dict(zip(node_ids.tolist(), next_node.tolist()))
+
+    def router(start, end):
+        route = [local_routing.nearest_node(G, start)]
+        while next_node[route[-1]] > 0:
+            route.append(next_node[route[-1]])
+        return route
+
+    osrm_server.router = router
+
+    # A smaller map around the same center first...
+    small = G.subgraph(
+        n for n, d in G.nodes(data=True) if abs(d["lon"] - origin_point[1]) < 0.002
+    ).copy()
+    pipeline.motorshed(small, center_node, backend="osrm", store=store)
+    assert sum(table_points(osrm_server.paths)) == len(small)
+
+    # ... and then the whole map only needs the nodes that weren't on it.
+    osrm_server.paths.clear()
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="osrm", store=store)
+    assert sum(table_points(osrm_server.paths)) == len(G) - len(small)
+
+    # A re-run doesn't need any table (or route) requests at all.
+    osrm_server.paths.clear()
+    Gn2, Gge2 = pipeline.motorshed(G, center_node, backend="osrm", store=store)
+    assert not osrm_server.paths
+    assert (Gge2.w == Gge.w).all()
+    assert np.allclose(Gge2.through_traffic, Gge.through_traffic)
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from motorshed import graph_cache, local_routing, osrm, pipeline, tiling
+
+
+@pytest.fixture()
+def cached_map(grid_map, tmp_path):
+    G, center_node, origin_point = grid_map
+    graph_cache.save_graph("grid", G, cache_dir=tmp_path, center_node=center_node)
+    return G, graph_cache.load_graph("grid", cache_dir=tmp_path), center_node
+
+
+def through_traffic(Gge):
+    return Gge.set_index(["u", "v"]).through_traffic.sort_index()
+
+
+def test_tile_grid():
+    x = np.array([0.0, 50, 150, 260, 10])
+    y = np.array([0.0, 0, 40, 10, 120])
+    tile_of_node, tiles = tiling.tile_grid(x, y, 100)
+    assert tiles == [(0, 0), (0, 1), (1, 0), (2, 0)]
+    assert tile_of_node.tolist() == [0, 0, 2, 3, 1]
+
+
+def test_subgraph(cached_map):
+    G, CG, center_node = cached_map
+    nodes = CG.node_column("x") < 250
+    tile = CG.subgraph(nodes)
+
+    assert tile.node_ids.tolist() == CG.node_ids[nodes].tolist()
+    G_tile = G.subgraph(CG.node_ids[nodes].tolist())
+    assert set(zip(tile.u.tolist(), tile.v.tolist())) == set(G_tile.edges())
+    # Just its own rows of the columns.
+    assert np.array_equal(tile.node_column("x"), CG.node_column("x")[nodes])
+    Gn, Ge = tile.to_gdfs()
+    assert Ge.length.tolist() == [G.edges[e]["length"] for e in zip(Ge.u, Ge.v, Ge.key)]
+    assert Ge.highway.tolist() == [
+        G.edges[e]["highway"] for e in zip(Ge.u, Ge.v, Ge.key)
+    ]
+
+
+@pytest.mark.parametrize("towards_origin", [True, False])
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_tiled_motorshed_local(cached_map, towards_origin, n_workers):
+    G, CG, center_node = cached_map
+    Gn, Gge = pipeline.motorshed(
+        G, center_node, towards_origin=towards_origin, backend="local"
+    )
+
+    # 100 m apart, in 3 x 3 tiles, with a halo of just over one edge.
+    Gn_tiled, Gge_tiled = tiling.tiled_motorshed(
+        CG,
+        center_node,
+        towards_origin=towards_origin,
+        backend="local",
+        tile_size_m=250,
+        halo_m=150,
+        n_workers=n_workers,
+    )
+
+    assert np.allclose(Gn_tiled.transit_time, Gn.transit_time.loc[Gn_tiled.index])
+    # Every edge, once, with the same traffic as if it had been done in one piece
+    #  (so the traffic from tile to tile was carried over).
+    assert np.allclose(through_traffic(Gge_tiled), through_traffic(Gge))
+    assert through_traffic(Gge_tiled).index.equals(through_traffic(Gge).index)
+
+
+def test_tiled_motorshed_osrm(cached_map, osrm_server, local_client):
+    G, CG, center_node = cached_map
+    # Real routes (the local routing engine's), so that every edge gets routed.
+    node_ids, transit_time, next_node = local_routing.shortest_path_tree(G, center_node)
+    next_node = dict(zip(node_ids.tolist(), next_node.tolist()))
+
+    def router(start, end):
+        route = [local_routing.nearest_node(G, start)]
+        while next_node[route[-1]] > 0:
+            route.append(next_node[route[-1]])
+        return route
+
+    osrm_server.router = router
+    previous = osrm._default_client
+    osrm.set_client(local_client)
+    try:
+        Gn, Gge = pipeline.motorshed(G, center_node, backend="osrm")
+        Gn_tiled, Gge_tiled = tiling.tiled_motorshed(
+            CG, center_node, backend="osrm", tile_size_m=250, halo_m=150, n_workers=1
+        )
+    finally:
+        osrm.set_client(previous)
+
+    assert np.allclose(through_traffic(Gge_tiled), through_traffic(Gge))
@@ -0,0 +1,80 @@
+import os
+
+import imageio.v2 as imageio
+import numpy as np
+import pytest
+
+from motorshed import pipeline, web_tiles
+
+
+@pytest.fixture()
+def motorshed_layers(grid_map):
+    G, center_node, origin_point = grid_map
+    Gn, Gge = pipeline.motorshed(G, center_node, backend="local")
+    return Gn, Gge, center_node
+
+
+def test_mercator():
+    x, y = web_tiles.mercator([0, 85.0511287798, -85.0511287798], [0, -180, 90])
+    assert np.allclose(x, [0.5, 0, 0.75])
+    assert np.allclose(y, [0.5, 0, 1])
+
+
+def test_tile_index():
+    # At zoom 2 (4 x 4 tiles): one in tile (0, 0), one across (1, 1) and (2, 1),
+    #  and one that only reaches into (1, 2) by its width.
+    segments = [[0.1, 0.1, 0.2, 0.2], [0.3, 0.3, 0.6, 0.4], [0.3, 0.49, 0.3, 0.49]]
+    tiles, starts, edges = web_tiles.tile_index(segments, [0.01, 0.01, 0.02], 2)
+
+    assert tiles.tolist() == [[0, 0], [1, 1], [1, 2], [2, 1]]
+    assert [edges[a:b].tolist() for a, b in zip(starts[:-1], starts[1:])] == [
+        [0],
+        [1, 2],
+        [2],
+        [1],
+    ]
+
+
+def test_export_tiles(motorshed_layers, tmp_path):
+    Gn, Gge, center_node = motorshed_layers
+    out_dir = str(tmp_path / "tiles")
+    zooms = [13, 16, 17]
+
+    n_written = web_tiles.export_tiles(
+        out_dir, Gn, Gge, center_node, zooms=zooms, n_workers=1
+    )
+    files = sorted(
+        os.path.relpath(os.path.join(d, fn), out_dir)
+        for d, _, fns in os.walk(out_dir)
+        for fn in fns
+    )
+    assert len(files) == n_written
+    assert {fn.split(os.sep)[0] for fn in files} == {"13", "16", "17"}
+    assert all(fn.endswith(".png") for fn in files)
+    # (The map is about 500 m across.)
+    assert sum(fn.startswith("13" + os.sep) for fn in files) == 1
+    assert 1 < sum(fn.startswith("17" + os.sep) for fn in files) <= 9
+
+    # Each tile, with just its own edges, is just like it is with all of them.
+    style = web_tiles.TileStyle(Gn, Gge, center_node)
+    all_edges = np.arange(len(style.segments))
+    for fn in files:
+        zoom, column, row = map(int, fn[: -len(".png")].split(os.sep))
+        tile = imageio.imread(os.path.join(out_dir, fn))
+        assert tile.shape == (256, 256, 4)
+        assert tile[..., :3].max() > 50
+        assert np.array_equal(
+            tile, web_tiles.render_tile(style, zoom, column, row, all_edges)
+        )
+    # Lines are wider when zoomed in (but not as much as the map).
+    assert style.reach(17)[0] / style.reach(16)[0] == pytest.approx(2**-0.5, rel=0.1)
+
+    # Picking up where it left off; and the same, on a pool of processes.
+    assert web_tiles.export_tiles(out_dir, Gn, Gge, center_node, zooms=zooms) == 0
+    for fn in files[-2:]:
+        os.remove(os.path.join(out_dir, fn))
+    assert (
+        web_tiles.export_tiles(out_dir, Gn, Gge, center_node, zooms=zooms, n_workers=2)
+        == 2
+    )
+    assert not any(fn.endswith(".tmp") for _, _, fns in os.walk(out_dir) for fn in fns)
@@ -0,0 +1,226 @@
+"""Tiled motorsheds, for maps that are too big (e.g., a whole metro area) to route
+in one piece.
+
+Only the transit times are worked out for the whole map at once (they're just a
+number per node: one Dijkstra search with the local routing engine, or Table API
+queries with OSRM). The routing is done a tile at a time: the map is cut into a
+grid of square tiles, and each tile, plus a margin around it (its 'halo'), is
+routed with the usual gen2 steps (see `pipeline.find_successors`), straight from
+the memory-mapped `graph_cache.ColumnarGraph`, in a pool of processes. The halo is
+there so that routing the edges near the side of a tile can look ahead into the
+next one; only the edges that start in the tile itself (its 'core') are kept.
+
+The routings of all of the tiles are then stitched together, and the traffic is
+propagated over all of them at once, so traffic that crosses from tile to tile is
+carried over. That last step only needs a few numbers per edge (not the whole
+dataframes, and no networkx graph), so peak memory depends on the size of the
+tiles (and the number of workers), not of the map."""
+
+import concurrent.futures
+import os
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+from contexttimer import Timer
+
+from motorshed import graph_cache, local_routing, osrm, pipeline
+from motorshed.algos import compact, gen2
+
+# What's kept of each tile's edges, for stitching them together.
+TILE_EDGE_COLUMNS = ["u", "v", "key", "length", "road_class", "end_time", "w", "v2"]
+
+
+def tile_grid(x, y, tile_size_m):
+    """Cut the map into a grid of `tile_size_m` squares, from the south-west corner
+    of the nodes at (x, y) (projected coordinates, in meters). Returns
+    (tile_of_node, tiles): the number of each node's tile, and the (column, row) of
+    each tile that has any nodes in it."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    column = ((x - x.min()) // tile_size_m).astype(np.int64)
+    row = ((y - y.min()) // tile_size_m).astype(np.int64)
+    tiles, tile_of_node = np.unique(
+        np.stack([column, row], axis=1), axis=0, return_inverse=True
+    )
+    return tile_of_node.ravel(), [tuple(tile) for tile in tiles.tolist()]
+
+
+def tile_nodes(x, y, edge_nodes, core, tile, tile_size_m, halo_m):
+    """The nodes (a boolean mask) that routing a tile needs: its `core` nodes, the
+    ones within `halo_m` of its square (the `tile`'s (column, row) in `tile_grid`),
+    and the ones up to two edges away from the core, however long the edges are
+    (so that the next edge (v, w) of each edge of the core is in the tile, too).
+    `edge_nodes` is `ColumnarGraph.edge_node_index()`."""
+    ui, vi = edge_nodes
+    nodes = core.copy()
+    for step in range(2):
+        touching = nodes[ui] | nodes[vi]
+        nodes[ui[touching]] = True
+        nodes[vi[touching]] = True
+
+    column, row = tile
+    west = np.min(x) + column * tile_size_m - halo_m
+    south = np.min(y) + row * tile_size_m - halo_m
+    size = tile_size_m + 2 * halo_m
+    return nodes | (x >= west) & (x <= west + size) & (y >= south) & (y <= south + size)
+
+
+def tiled_motorshed(
+    CG,
+    center_node,
+    towards_origin=True,
+    backend=None,
+    tile_size_m=5000,
+    halo_m=1000,
+    n_workers=None,
+):
+    """Calculate a one-way motorshed on a ColumnarGraph (see `graph_cache`), a tile
+    at a time (see above), on a pool of `n_workers` processes (default: one per CPU;
+    1 means don't use a pool). The halo (see `tile_nodes`) should be longer than
+    the few steps that `gen2.followup_heuristic_routing` looks ahead.
+    Returns (Gn, Gge), like `pipeline.motorshed`, but lean: Gn has the nodes' x, y,
+    lat, lon and transit_time, and Gge the TILE_EDGE_COLUMNS of the edges, with
+    their successor and through_traffic."""
+    router = pipeline.get_router(backend)
+    Gn = CG.to_gdfs(["x", "y", "lat", "lon"], [])[0]
+
+    with Timer(prefix="Get transit times (whole map)"):
+        tree = None
+        if router is local_routing:
+            tree = local_routing.shortest_path_tree(CG, center_node, towards_origin)
+            transit_time = tree[1]
+        else:
+            lat_lon = Gn[["lat", "lon"]].to_numpy(float)
+            transit_time = osrm.table_transit_times(
+                lat_lon,
+                lat_lon[CG.node_index([center_node])[0]],
+                towards_origin=towards_origin,
+            )
+    Gn["transit_time"] = transit_time
+
+    tile_of_node, tiles = tile_grid(Gn.x, Gn.y, tile_size_m)
+    n_workers = min(n_workers or os.cpu_count(), len(tiles))
+    shared = (
+        CG if n_workers <= 1 else CG.path,
+        tile_of_node,
+        tiles,
+        transit_time,
+        tree,
+        center_node,
+        towards_origin,
+        backend,
+        tile_size_m,
+        halo_m,
+    )
+
+    with Timer(prefix="Route %d tiles" % len(tiles)):
+        if n_workers <= 1:
+            _tile_worker_init(*shared)
+            results = list(map(_tile_worker, range(len(tiles))))
+        else:
+            # The shared arrays are sent once per worker, not once per tile. (The
+            #  map itself is just opened again, by its path, in each of them.)
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_tile_worker_init,
+                initargs=shared,
+            ) as executor:
+                results = list(executor.map(_tile_worker, range(len(tiles))))
+
+    with Timer(prefix="Stitch tiles"):
+        Ge = pd.concat([Ge for Ge in results if Ge is not None], ignore_index=True)
+        node_ids, ui, vi = compact.dense_node_ids(Ge.u, Ge.v, node_ids=CG.node_ids)
+        graph = compact.CompactGraph(node_ids, ui, vi)
+        Ge["ui"], Ge["vi"] = ui, vi
+        compact.set_successors(Ge, graph, graph.successors(Ge.w, Ge.v2))
+
+    return Gn, gen2.propagate_edges(Ge)
+
+
+_tile_state = None
+
+
+def _tile_worker_init(
+    CG,
+    tile_of_node,
+    tiles,
+    transit_time,
+    tree,
+    center_node,
+    towards_origin,
+    backend,
+    tile_size_m,
+    halo_m,
+):
+    global _tile_state
+    if isinstance(CG, str):
+        CG = graph_cache.ColumnarGraph(CG)
+    x, y = CG.node_column("x"), CG.node_column("y")
+    _tile_state = (
+        CG,
+        x,
+        y,
+        tile_of_node,
+        tiles,
+        transit_time,
+        tree,
+        center_node,
+        towards_origin,
+        backend,
+        tile_size_m,
+        halo_m,
+    )
+
+
+def _tile_worker(n):
+    (
+        CG,
+        x,
+        y,
+        tile_of_node,
+        tiles,
+        transit_time,
+        tree,
+        center_node,
+        towards_origin,
+        backend,
+        tile_size_m,
+        halo_m,
+    ) = _tile_state
+
+    core = tile_of_node == n
+    nodes = tile_nodes(x, y, CG.edge_node_index(), core, tiles[n], tile_size_m, halo_m)
+    tile = CG.subgraph(nodes)
+    print(
+        "Tile %d of %d: %d nodes (%d with the halo), %d edges."
+        % (n + 1, len(tiles), core.sum(), nodes.sum(), tile.number_of_edges())
+    )
+    if not tile.number_of_edges():
+        return None
+
+    Gn, Ge = gen2.create_initial_dataframes(tile, towards_origin, lean=True)
+    # (The tile's nodes are in the same order as in the whole map.)
+    Gn["transit_time"] = transit_time[nodes]
+    G = tile
+    if pipeline.get_router(backend) is osrm:
+        # OSRM only needs to know where the nodes are (and the center node might
+        #  not be in this tile).
+        lat, lon = CG.node_column("lat"), CG.node_column("lon")
+        G = nx.Graph()
+        G.add_nodes_from(
+            (node, dict(osmid=node, lat=node_lat, lon=node_lon))
+            for node, node_lat, node_lon in zip(
+                tile.node_ids.tolist(), lat[nodes].tolist(), lon[nodes].tolist()
+            )
+        )
+        i_center = CG.node_index([center_node])[0]
+        center_node = dict(
+            osmid=center_node, lat=float(lat[i_center]), lon=float(lon[i_center])
+        )
+    Ge = pipeline.find_successors(
+        G, Gn, Ge, center_node, towards_origin, backend, tree=tree
+    ).reset_index()
+
+    # Only the edges that start in the core; the others are in another tile's.
+    in_core = np.isin(Ge.u.to_numpy(), CG.node_ids[core])
+    return pd.DataFrame(Ge.loc[in_core, TILE_EDGE_COLUMNS]).reset_index(drop=True)
@@ -0,0 +1,243 @@
+"""Export a motorshed as a pyramid of web map ('slippy map') tiles: 256 x 256 PNGs
+at out_dir/{z}/{x}/{y}.png, in the usual XYZ scheme (Web Mercator, with tile (0, 0)
+in the north-west corner), e.g., for Leaflet or OpenLayers.
+
+The edges are projected and styled once (like `render_mpl.style_edges` does for a
+layer), and then, for each zoom level, every edge is listed under the tiles that it
+reaches (see `tile_index`), so each tile is drawn (with `render_np.draw_segments`)
+from just its own edges, and tiles with no edges at all aren't drawn or written.
+Lines get wider as you zoom in, but not as fast as the map does (see
+`width_scale`), so the quiet streets don't vanish when zoomed out, and the busy ones
+don't swamp the map when zoomed in.
+
+Tiles are rendered on a pool of processes. Each one is written to a temporary file
+that's only renamed once it's done, so an export that's interrupted picks up where
+it left off, when it's run again: the tiles that are already there are skipped."""
+
+import concurrent.futures
+import os
+
+import matplotlib.cm
+import numpy as np
+from contexttimer import Timer
+
+from motorshed import png_stream, render_mpl, render_np
+
+TILE_SIZE = 256
+EARTH_CIRCUMFERENCE_M = 40_075_016.686
+# Edges get their `max_edge_width` (like `render_mpl.render_layer`'s, in points at
+#  150 dpi) at the zoom where the whole map is as big as on render_layer's (8 inch,
+#  150 dpi) canvas...
+BASE_DPI = 150
+BASE_MAP_PIXELS = 8 * BASE_DPI
+# ... and twice as wide for every 1 / WIDTH_GROWTH zoom levels in from there (and
+#  narrower for every one out).
+WIDTH_GROWTH = 0.5
+
+
+def mercator(lat, lon):
+    """Web Mercator 'world coordinates' of (lat, lon) (in degrees): (x, y), from 0 to
+    1, from the west and from the north. At zoom z, they're pixels / (256 * 2**z)."""
+    lat = np.radians(np.asarray(lat, dtype=float))
+    x = (np.asarray(lon, dtype=float) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return x, y
+
+
+def width_scale(zoom, base_zoom):
+    """How much wider than at `base_zoom` lines are at `zoom` (see above)."""
+    return 2.0 ** ((zoom - base_zoom) * WIDTH_GROWTH)
+
+
+def tile_index(segments, reach, zoom):
+    """A spatial index of `segments` ((x1, y1, x2, y2) in world coordinates) for the
+    tiles at `zoom`: which of them each tile needs to draw, counting anything within
+    `reach` (world coordinates; e.g., half of each one's width) of them. Returns
+    (tiles, starts, edges): the (x, y) of each tile that has any, and the segments
+    of tile n are edges[starts[n]:starts[n + 1]], in their original order (the
+    order that they're drawn in)."""
+    n_tiles = 2**zoom
+    x1, y1, x2, y2 = np.asarray(segments, dtype=float).T * n_tiles
+    reach = np.asarray(reach, dtype=float) * n_tiles
+
+    def tile_range(a, b):
+        low = np.floor(np.minimum(a, b) - reach).clip(0, n_tiles - 1)
+        high = np.floor(np.maximum(a, b) + reach).clip(0, n_tiles - 1)
+        return low.astype(np.int64), high.astype(np.int64) - low.astype(np.int64) + 1
+
+    column, width = tile_range(x1, x2)
+    row, height = tile_range(y1, y2)
+
+    # One (tile, segment) pair for every tile in each one's box (mostly just one).
+    count = width * height
+    edge = np.repeat(np.arange(len(count)), count)
+    i = np.arange(len(edge)) - np.repeat(np.cumsum(count) - count, count)
+    tile = (column[edge] + i // height[edge]) * n_tiles + row[edge] + i % height[edge]
+
+    order = np.lexsort((edge, tile))
+    tile, edges = tile[order], edge[order]
+    keys, starts = np.unique(tile, return_index=True)
+    tiles = np.stack(np.divmod(keys, n_tiles), axis=1)
+    return tiles, np.append(starts, len(edges)), edges
+
+
+class TileStyle:
+    """The edges of a motorshed (and the rings around its center node), styled (see
+    `render_mpl.style_edges`) and in world coordinates (see `mercator`), ready to
+    be drawn into tiles at any zoom level (see `render_tile`)."""
+
+    def __init__(
+        self,
+        Gn,
+        Ge,
+        center_node=None,
+        bgcolor="black",
+        max_edge_width=None,
+        cmap=matplotlib.cm.magma,
+    ):
+        # If needed, guess a good edge width.
+        if max_edge_width is None:
+            max_edge_width = render_mpl.guess_max_edge_width(Gn, Ge)
+        gdf = render_mpl.style_edges(Ge, max_edge_width)
+
+        node_i = Gn.index.get_indexer
+        x, y = mercator(Gn.lat, Gn.lon)
+        ui, vi = node_i(gdf.u), node_i(gdf.v)
+        self.segments = np.stack([x[ui], y[ui], x[vi], y[vi]], axis=1)
+        self.colors = cmap(gdf.edge_intensity.to_numpy())[:, :3] * 255
+        self.bg = render_np.background(bgcolor)
+
+        # The zoom where the map is BASE_MAP_PIXELS across (not a whole number),
+        #  and the edges' half-widths there, in pixels.
+        extent = max(np.ptp(x), np.ptp(y))
+        self.base_zoom = np.log2(BASE_MAP_PIXELS / (extent * TILE_SIZE))
+        self.radius = gdf.edge_widths.to_numpy(float) * BASE_DPI / 72 / 2
+
+        # The 'center node', drawn over the edges (with its rings' radii in world
+        #  coordinates).
+        self.rings = []
+        if center_node is not None:
+            lat = Gn.lat.loc[center_node]
+            cx, cy = mercator(lat, Gn.lon.loc[center_node])
+            meter = 1 / (EARTH_CIRCUMFERENCE_M * np.cos(np.radians(lat)))
+            self.rings = [
+                (
+                    np.array([[cx, cy, cx, cy]]),
+                    ring_radius * meter,
+                    np.array([cmap(value)[:3]]) * 255,
+                    alpha,
+                )
+                for ring_radius, value, alpha in render_mpl.CENTER_RINGS
+            ]
+
+    def reach(self, zoom):
+        """How far (in world coordinates) each edge reaches, at `zoom`."""
+        pixel = 1 / (TILE_SIZE * 2**zoom)
+        return (self.radius * width_scale(zoom, self.base_zoom) + 1) * pixel
+
+
+def render_tile(style, zoom, column, row, edges, out=None):
+    """Draw tile (`column`, `row`) (its x and y) at `zoom`, with the `edges` (indices
+    of the `style`'s edges, in order; e.g., from `tile_index`), and return it (an
+    RGBA array, uint8). It's drawn into `out`, if given."""
+    if out is None:
+        out = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    out[:] = style.bg
+
+    # (Into the tile's pixels, while still in float64.)
+    scale = TILE_SIZE * 2**zoom
+    corner = np.array([column, row, column, row]) * TILE_SIZE
+    render_np.draw_segments(
+        out,
+        style.segments[edges] * scale - corner,
+        style.radius[edges] * width_scale(zoom, style.base_zoom),
+        style.colors[edges],
+    )
+    for segments, radius, colors, alpha in style.rings:
+        render_np.draw_segments(
+            out, segments * scale - corner, [radius * scale], colors, alpha
+        )
+    return out
+
+
+def export_tiles(
+    out_dir,
+    Gn,
+    Gge,
+    center_node=None,
+    zooms=range(10, 17),
+    bgcolor="black",
+    max_edge_width=None,
+    cmap=matplotlib.cm.magma,
+    n_workers=None,
+    compression=6,
+):
+    """Render the motorshed (Gn and Gge, e.g., from `pipeline.motorshed`; Gn needs
+    lat and lon) as XYZ tiles at each of the `zooms`, into out_dir/{z}/{x}/{y}.png
+    (see above), on a pool of `n_workers` processes (default: one per CPU; 1 means
+    don't use a pool). `max_edge_width` is like `render_mpl.render_layer`'s, for a
+    map that's 8 inches across (see BASE_MAP_PIXELS). Tiles that are already in
+    out_dir are skipped. Returns how many tiles were written."""
+    style = TileStyle(Gn, Gge, center_node, bgcolor, max_edge_width, cmap)
+
+    # The tiles to draw (with their edges), a zoom level at a time.
+    tasks = []
+    with Timer(prefix="Index tiles"):
+        for zoom in zooms:
+            tiles, starts, edges = tile_index(style.segments, style.reach(zoom), zoom)
+            todo = [
+                (zoom, column, row, edges[start:stop])
+                for (column, row), start, stop in zip(
+                    tiles.tolist(), starts[:-1], starts[1:]
+                )
+                if not os.path.exists(tile_path(out_dir, zoom, column, row))
+            ]
+            print(
+                "Zoom %d: %d tiles with edges, %d already done."
+                % (zoom, len(tiles), len(tiles) - len(todo))
+            )
+            tasks += todo
+
+    n_workers = min(n_workers or os.cpu_count(), max(len(tasks), 1))
+    shared = (style, out_dir, compression)
+    with Timer(prefix="Render %d tiles" % len(tasks)):
+        if n_workers <= 1:
+            _tile_worker_init(*shared)
+            list(map(_tile_worker, tasks))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_tile_worker_init,
+                initargs=shared,
+            ) as executor:
+                list(executor.map(_tile_worker, tasks, chunksize=16))
+
+    return len(tasks)
+
+
+def tile_path(out_dir, zoom, column, row):
+    return os.path.join(out_dir, str(zoom), str(column), "%d.png" % row)
+
+
+_tile_state = None
+
+
+def _tile_worker_init(style, out_dir, compression):
+    global _tile_state
+    out = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    _tile_state = (style, out_dir, compression, out)
+
+
+def _tile_worker(task):
+    style, out_dir, compression, out = _tile_state
+    zoom, column, row, edges = task
+
+    render_tile(style, zoom, column, row, edges, out=out)
+    fn = tile_path(out_dir, zoom, column, row)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    # (Only there once it's all there, for picking up where we left off.)
+    with png_stream.PNGWriter(
+        fn + ".tmp", TILE_SIZE, TILE_SIZE, compression=compression
+    ) as png:
+        png.write_rows(out)
+    os.replace(fn + ".tmp", fn)